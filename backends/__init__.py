@@ -0,0 +1,3 @@
+from backends.base import Backend
+from backends.log import LogBackend
+from backends.sqlite import SQLiteBackend
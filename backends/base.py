@@ -0,0 +1,89 @@
+import asyncio
+import os
+
+import structlog
+
+import commitlog
+
+
+logger = structlog.get_logger(__name__)
+
+
+class Backend(object):
+    # the store keeps every item in memory and hands each committed command
+    # to append() for durability. load() rebuilds the store on startup and
+    # flush() periodically moves pending changes into long term storage
+    conn = None
+    commit_log = None
+    # fsync the commit log after every commit. only worth turning off
+    # when measuring everything else
+    fsync = True
+    # load() leaves items in long term storage and the store reads them
+    # through fetch() on first access
+    lazy = False
+    # the store can start from a memory image instead of load(), provided
+    # nothing was flushed since the image was written
+    images = False
+    # flush() empties the commit log, so flushing is what bounds its size
+    flush_empties_log = False
+
+    def load(self, store, conn=None):
+        # populates the store and returns the last commit id
+        raise NotImplementedError
+
+    def replay(self, store, commit_log=None, after=None):
+        pass
+
+    def flushed_commit_id(self):
+        # the last commit in long term storage
+        raise NotImplementedError
+
+    def fetch(self, key):
+        # (flags, exptime, data, encoding) for a key in long term storage,
+        # or None
+        raise NotImplementedError
+
+    def may_contain(self, key):
+        return True
+
+    def keys(self):
+        raise NotImplementedError
+
+    def save(self, store, conn=None):
+        raise NotImplementedError
+
+    def flush(self, store, conn=None, commit_log=None):
+        self.save(store, conn)
+
+    def append(self, commit_id, opcode, data):
+        return commitlog.write_commit(self.commit_log, commit_id, opcode, data, self.fsync)
+
+    def commit_log_size(self):
+        # bytes of commits not yet flushed to long term storage
+        if self.commit_log is None:
+            return 0
+        self.commit_log.seek(0, os.SEEK_END)
+        return self.commit_log.tell()
+
+    def snapshot_point(self, store):
+        raise NotImplementedError
+
+    async def snapshot(self, store, path, point, pages, loop):
+        raise NotImplementedError
+
+    async def compact(self, store):
+        pass
+
+    async def compact_loop(self, store, timeout=60, scheduler=None):
+        try:
+            while True:
+                await asyncio.sleep(timeout)
+                if scheduler is not None:
+                    await scheduler.maintenance()
+                try:
+                    await self.compact(store)
+                except Exception as e:
+                    logger.exception('error compacting: {}'.format(e))
+
+        except asyncio.CancelledError as e:
+            logger.info('--cleanup--')
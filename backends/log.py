@@ -0,0 +1,334 @@
+import asyncio
+from collections import namedtuple
+import os
+import shutil
+import struct
+import uuid
+
+import structlog
+
+from backends.base import Backend
+import commitlog
+from compaction import CHUNK, RATE, Compaction, RateLimiter
+from utils import unpack_vls
+
+
+logger = structlog.get_logger(__name__)
+
+
+DATA_EXT = '.data'
+HINT_EXT = '.hint'
+MERGE_EXT = '.merge'
+# lists the files being merged while the merged file is swapped in, so a
+# crash part way through is finished on the next start
+MERGE_MANIFEST = 'merge.manifest'
+MAX_FILE_SIZE = 64 * 1024 * 1024
+MERGE_FILES = 2
+SNAPSHOT_CHUNK = 64 * 1024
+
+# hint entries are the opcode, offset and size of the record followed by
+# the length prefixed key
+HINT_ENTRY = '=HQI'
+
+
+KeyDirEntry = namedtuple('KeyDirEntry', 'file_id offset size')
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class LogBackend(Backend):
+    # bitcask style storage: the commit log *is* the data. records are
+    # appended to the active data file, which is rotated once it reaches
+    # max_file_size. immutable files get a hint file listing the key and
+    # location of each record, and are periodically merged into a single
+    # file containing only live records
+    def __init__(self, path, max_file_size=MAX_FILE_SIZE, merge_files=MERGE_FILES, compaction_rate=RATE):
+        self.path = path
+        self.max_file_size = max_file_size
+        self.merge_files = merge_files
+        self.limiter = RateLimiter(compaction_rate)
+        self.keydir = {}
+        self.readers = {}
+        self.merging = False
+        self.recover_merge()
+        self.file_ids = sorted(
+            int(name[:-len(DATA_EXT)])
+            for name in os.listdir(path)
+            if name.endswith(DATA_EXT))
+        if not self.file_ids:
+            self.file_ids.append(1)
+        self.open_active(self.file_ids[-1])
+
+    def recover_merge(self):
+        # a manifest means the merged file was complete, so the swap is
+        # finished. without one, leftover merge output is incomplete
+        manifest = os.path.join(self.path, MERGE_MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                file_ids = [int(file_id) for file_id in f.read().split()]
+            logger.info('finishing interrupted merge of data files %s', file_ids)
+            self.finish_merge(file_ids)
+            return
+        for name in os.listdir(self.path):
+            if name.endswith(MERGE_EXT):
+                os.remove(os.path.join(self.path, name))
+
+    def data_path(self, file_id, ext=DATA_EXT):
+        return os.path.join(self.path, '%08d%s' % (file_id, ext))
+
+    def open_active(self, file_id):
+        self.active_id = file_id
+        self.commit_log = open(self.data_path(file_id), 'a+b')
+
+    @property
+    def immutable_ids(self):
+        return [file_id for file_id in self.file_ids if file_id != self.active_id]
+
+    def reader(self, file_id):
+        if file_id not in self.readers:
+            self.readers[file_id] = open(self.data_path(file_id), 'rb')
+        return self.readers[file_id]
+
+    def close_reader(self, file_id):
+        f = self.readers.pop(file_id, None)
+        if f:
+            f.close()
+
+    def close(self):
+        for file_id in list(self.readers):
+            self.close_reader(file_id)
+        self.commit_log.close()
+
+    def update_keydir(self, command, entry):
+        if command.tombstone:
+            self.keydir.pop(command.key, None)
+        else:
+            self.keydir[command.key] = entry
+
+    def load(self, store, conn=None):
+        commit_id = None
+
+        # immutable files only contribute to the keydir, so superseded
+        # values are never read. hint files let us skip reading the data
+        # files entirely until the live values are fetched below
+        for file_id in self.immutable_ids:
+            if os.path.exists(self.data_path(file_id, HINT_EXT)):
+                commit_id = self.load_hint(file_id) or commit_id
+            else:
+                for commit_id, command, offset, size in commitlog.read_commits(self.reader(file_id)):
+                    self.update_keydir(command, KeyDirEntry(file_id, offset, size))
+
+        # fetch live values in file order so the reads are sequential
+        entries = sorted(self.keydir.values())
+        for entry in entries:
+            _, command = commitlog.read_commit_at(self.reader(entry.file_id), entry.offset)
+            command.visit(store)
+        logger.info('loaded {} keys from {} data files'.format(len(entries), len(self.immutable_ids)))
+
+        # the active file is the tail of the log and is replayed in full
+        for commit_id, command, offset, size in commitlog.read_commits(self.commit_log):
+            try:
+                command.visit(store)
+            except KeyError:
+                pass
+            self.update_keydir(command, KeyDirEntry(self.active_id, offset, size))
+
+        # everything loaded is already durable
+        store.clear_pending()
+
+        logger.info('commit_id: {}'.format(commit_id))
+        return commit_id
+
+    def load_hint(self, file_id):
+        with open(self.data_path(file_id, HINT_EXT), 'rb') as f:
+            commit_id = f.read(16)
+            commit_id = uuid.UUID(bytes=commit_id) if any(commit_id) else None
+            while True:
+                header = f.read(struct.calcsize(HINT_ENTRY))
+                if not header:
+                    break
+                opcode, offset, size = struct.unpack(HINT_ENTRY, header)
+                key = unpack_vls(f)
+                if commitlog.command_class(opcode).tombstone:
+                    self.keydir.pop(key, None)
+                else:
+                    self.keydir[key] = KeyDirEntry(file_id, offset, size)
+        return commit_id
+
+    def write_hint(self, file_id, entries, commit_id, path=None):
+        path = path or self.data_path(file_id, HINT_EXT)
+        with open(path, 'wb') as f:
+            f.write(commit_id.bytes if commit_id else bytes(16))
+            for opcode, key, offset, size in entries:
+                f.write(struct.pack(HINT_ENTRY, opcode, offset, size))
+                f.write(struct.pack('=I', len(key)))
+                f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def save(self, store, conn=None):
+        # every commit is already in a data file
+        pass
+
+    def flush(self, store, conn=None, commit_log=None):
+        self.save(store, conn)
+        self.commit_log.seek(0, os.SEEK_END)
+        if self.commit_log.tell() >= self.max_file_size:
+            self.rotate()
+
+    def rotate(self):
+        file_id = self.active_id
+        entries = []
+        commit_id = None
+        for commit_id, command, offset, size in commitlog.read_commits(self.reader(file_id)):
+            entries.append((command.opcode, command.key, offset, size))
+        self.write_hint(file_id, entries, commit_id)
+
+        self.commit_log.close()
+        self.open_active(file_id + 1)
+        self.file_ids.append(self.active_id)
+        logger.info('rotated data file %d', file_id)
+
+    def append(self, commit_id, opcode, data):
+        offset, size = super().append(commit_id, opcode, data)
+        key = commitlog.record_key(commitlog.record_parts(data)[0])
+        if commitlog.command_class(opcode).tombstone:
+            self.keydir.pop(key, None)
+        else:
+            self.keydir[key] = KeyDirEntry(self.active_id, offset, size)
+        return offset, size
+
+    async def compact(self, store):
+        file_ids = self.immutable_ids
+        if len(file_ids) < self.merge_files:
+            return
+        if store.snapshotting:
+            logger.info('snapshot in progress, deferring merge')
+            return
+        self.merging = True
+        try:
+            await self.merge(file_ids)
+        finally:
+            self.merging = False
+
+    async def merge(self, file_ids):
+        # the merged file takes the place of the newest input, so it still
+        # sorts before the active file. tombstones are dropped: every older
+        # record for the key is in one of the files being merged
+        target = file_ids[-1]
+        merging = set(file_ids)
+        live = sorted(
+            (entry, key)
+            for key, entry in self.keydir.items()
+            if entry.file_id in merging)
+        logger.info('merging data files %s (%d live keys)', file_ids, len(live))
+
+        before = sum(os.path.getsize(self.data_path(file_id)) for file_id in file_ids)
+        merged = {}
+        entries = []
+        commit_id = None
+        with Compaction(sum(entry.size for entry, _ in live)) as run:
+            with open(self.data_path(target, MERGE_EXT), 'wb') as f:
+                pending = 0
+                for entry, key in live:
+                    reader = self.reader(entry.file_id)
+                    reader.seek(entry.offset)
+                    record = reader.read(entry.size)
+                    offset = f.tell()
+                    f.write(record)
+                    record_id = uuid.UUID(bytes=record[:16])
+                    opcode = struct.unpack_from('=H', record, 16)[0]
+                    merged[key] = (entry, KeyDirEntry(target, offset, entry.size))
+                    entries.append((opcode, key, offset, entry.size))
+                    if commit_id is None or record_id.time > commit_id.time:
+                        commit_id = record_id
+                    run.advance(entry.size)
+                    pending += entry.size
+                    if pending >= CHUNK:
+                        await self.limiter.throttle(pending * 2)
+                        pending = 0
+                f.flush()
+                os.fsync(f.fileno())
+                after = f.tell()
+            run.reclaimed(before, after)
+        self.write_hint(target, entries, commit_id, self.data_path(target, HINT_EXT + MERGE_EXT))
+
+        # the merged file has no tombstones, so the older inputs would
+        # bring deleted keys back if a crash left them next to it. the
+        # manifest makes the swap all or nothing
+        manifest = os.path.join(self.path, MERGE_MANIFEST)
+        with open(manifest + MERGE_EXT, 'w') as f:
+            f.write(' '.join(str(file_id) for file_id in file_ids))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest + MERGE_EXT, manifest)
+        fsync_dir(self.path)
+        self.finish_merge(file_ids)
+
+        # keys written while we were merging already point somewhere newer
+        for key, (old, new) in merged.items():
+            if self.keydir.get(key) == old:
+                self.keydir[key] = new
+        for file_id in file_ids[:-1]:
+            self.file_ids.remove(file_id)
+        logger.info('merged data files %s into %d', file_ids, target)
+
+    def finish_merge(self, file_ids):
+        # swaps the merged file in and removes the other inputs. each step
+        # can be repeated, so it can be rerun after a crash part way. the
+        # old hint goes first so a crash can never pair it with the new
+        # data file
+        target = file_ids[-1]
+        for file_id in file_ids:
+            self.close_reader(file_id)
+        if os.path.exists(self.data_path(target, MERGE_EXT)):
+            if os.path.exists(self.data_path(target, HINT_EXT)):
+                os.remove(self.data_path(target, HINT_EXT))
+            os.replace(self.data_path(target, MERGE_EXT), self.data_path(target))
+        if os.path.exists(self.data_path(target, HINT_EXT + MERGE_EXT)):
+            os.replace(self.data_path(target, HINT_EXT + MERGE_EXT), self.data_path(target, HINT_EXT))
+        for file_id in file_ids[:-1]:
+            for ext in (HINT_EXT, DATA_EXT):
+                if os.path.exists(self.data_path(file_id, ext)):
+                    os.remove(self.data_path(file_id, ext))
+        fsync_dir(self.path)
+        os.remove(os.path.join(self.path, MERGE_MANIFEST))
+        fsync_dir(self.path)
+
+    def snapshot_point(self, store):
+        # rotation is deferred along with flush while the snapshot runs, so
+        # the active file and everything before it make up the snapshot
+        self.commit_log.seek(0, os.SEEK_END)
+        return store.commit_id, (self.active_id, self.commit_log.tell())
+
+    async def snapshot(self, store, path, point, pages, loop):
+        commit_id, (active_id, end) = point
+
+        # a merge that was already running replaces and removes immutable
+        # files, so let it finish. no new merge starts while we copy
+        while self.merging:
+            await asyncio.sleep(0.1)
+
+        for file_id in self.immutable_ids:
+            for ext in (DATA_EXT, HINT_EXT):
+                source = self.data_path(file_id, ext)
+                if os.path.exists(source):
+                    await loop.run_in_executor(None, shutil.copyfile, source, os.path.join(path, os.path.basename(source)))
+
+        reader = self.reader(active_id)
+        with open(os.path.join(path, os.path.basename(self.data_path(active_id))), 'wb') as f:
+            offset = 0
+            while offset < end:
+                reader.seek(offset)
+                chunk = reader.read(min(SNAPSHOT_CHUNK, end - offset))
+                f.write(chunk)
+                offset += len(chunk)
+                await asyncio.sleep(0)
+            f.flush()
+            os.fsync(f.fileno())
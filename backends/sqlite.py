@@ -0,0 +1,345 @@
+import asyncio
+import os
+import sqlite3
+import uuid
+
+from prometheus_client import Counter
+import structlog
+
+from backends.base import Backend
+import bloom
+from bloom import BloomFilter
+import commitlog
+from compaction import CHUNK, RATE, Compaction, RateLimiter
+import database
+import metrics
+
+
+logger = structlog.get_logger(__name__)
+
+
+NUM_DB_UPSERTS = Counter('storage_db_upserts', 'number of db upserts')
+NUM_DB_DELETES = Counter('storage_db_deletes', 'number of db deletes')
+READ_THROUGH = metrics.Counter('storage_read_through', 'Lazy lookups by outcome: found in the db, '
+                               'not in the db, or ruled out by the bloom filter', ['result'])
+
+
+SNAPSHOT_DB = 'items.db'
+SNAPSHOT_LOG = 'commit.log'
+SNAPSHOT_CHUNK = 64 * 1024
+COMPACT_EXT = '.compact'
+COMPACTION_MIN_SIZE = 1024 * 1024
+# what PRAGMA synchronous reads back as for normal
+SYNCHRONOUS_NORMAL = 1
+
+
+def db_path(conn):
+    for _, name, filename in conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return filename or None
+
+def backup_db(source, target, pages):
+    # runs in an executor thread, so both connections are opened here
+    # rather than shared with the event loop thread
+    source = sqlite3.connect(source)
+    target = sqlite3.connect(target)
+    try:
+        source.backup(target, pages=pages)
+    finally:
+        target.close()
+        source.close()
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class SQLiteBackend(Backend):
+    # items live in an sqlite table that is brought up to date on every
+    # flush. writes in between are made durable by a separate commit log
+    # that is replayed on startup and truncated after each flush
+    images = True
+    flush_empties_log = True
+
+    def __init__(self, conn, commit_log, batch_size=database.BATCH_SIZE, without_rowid=False,
+                 compaction_rate=RATE, compaction_min_size=COMPACTION_MIN_SIZE,
+                 lazy=False, bloom_error_rate=bloom.ERROR_RATE):
+        self.conn = conn
+        self.commit_log = commit_log
+        self.batch_size = batch_size
+        self.without_rowid = without_rowid
+        self.lazy = lazy
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom = None
+        self.limiter = RateLimiter(compaction_rate)
+        self.compaction_min_size = compaction_min_size
+        # bumped whenever the commit log is truncated, so a compaction that
+        # raced with a flush knows its output is stale
+        self.generation = 0
+
+    def load(self, store, conn=None):
+        conn = conn or self.conn
+        with conn:
+            c = conn.cursor()
+            c.execute('BEGIN')
+
+            database.create_schema(c, self.without_rowid)
+
+            if self.lazy:
+                self.load_bloom(c)
+            else:
+                c.execute(database.SELECT)
+                rows = c.fetchall()
+                for row in rows:
+                    store.load_item(row[0], *row[1:])
+                logger.info('loaded {} rows from db'.format(len(rows)))
+
+            commit_id = self.read_status(c)
+            logger.info('commit_id: {}'.format(commit_id))
+            c.execute('COMMIT')
+        return commit_id
+
+    def read_status(self, c):
+        c.execute('SELECT commit_id FROM status WHERE id = 1')
+        row = c.fetchone()
+        if row:
+            return uuid.UUID(bytes=row[0])
+        return None
+
+    def flushed_commit_id(self):
+        with self.conn:
+            c = self.conn.cursor()
+            c.execute('BEGIN')
+            database.create_schema(c, self.without_rowid)
+            commit_id = self.read_status(c)
+            c.execute('COMMIT')
+        return commit_id
+
+    def load_bloom(self, c):
+        # only keys written before startup can be in the db without also
+        # being in the store, so the filter is never added to afterwards
+        count = c.execute(database.COUNT).fetchone()[0]
+        self.bloom = BloomFilter(count, self.bloom_error_rate)
+        self.bloom.update(row[0] for row in c.execute(database.SELECT_KEYS))
+        logger.info('lazy load: {} keys in db, bloom filter of {} bytes'.format(count, len(self.bloom.bits)))
+
+    def may_contain(self, key):
+        return self.bloom is None or key in self.bloom
+
+    def fetch(self, key):
+        if not self.may_contain(key):
+            READ_THROUGH.labels('filtered').inc()
+            return None
+        row = self.conn.execute(database.SELECT_ONE, (key,)).fetchone()
+        READ_THROUGH.labels('hit' if row else 'miss').inc()
+        return row
+
+    def keys(self):
+        for row in self.conn.execute(database.SELECT_KEYS):
+            yield row[0]
+
+    def replay(self, store, commit_log=None, after=None):
+        commit_log = commit_log or self.commit_log
+        # replay the commits from the log, or only those made after a
+        # memory image was written
+        if after is None:
+            commits = commitlog.read_commits(commit_log)
+        else:
+            commits = commitlog.read_commits_after(commit_log, after)
+        for commit_id, command, _, _ in commits:
+            logger.info('replaying commit %s - %s', commit_id, command)
+            try:
+                command.visit(store)
+            except KeyError:
+                # a flush that was interrupted between batches may have
+                # already applied this delete to the database
+                logger.info('commit %s already applied', commit_id)
+            store.commit_id = commit_id
+
+    def flush(self, store, conn=None, commit_log=None):
+        commit_log = commit_log or self.commit_log
+        self.save(store, conn)
+        if not self.sync_wal(conn or self.conn):
+            # the commits are still in the log, and replaying them over
+            # the database is harmless. the next flush tries again
+            logger.warn('wal checkpoint incomplete, keeping the commit log')
+            return
+
+        # truncate commit log
+        commit_log.seek(0)
+        commit_log.truncate()
+        self.generation += 1
+
+    def sync_wal(self, conn):
+        # with synchronous=normal, wal mode doesn't fsync on commit, so
+        # the flush could still be lost in a power cut after the commit
+        # log is truncated. a checkpoint copies the wal into the database
+        # and fsyncs both. it's passive, so readers aren't waited for: False
+        # if one kept it from copying everything
+        if conn.execute('PRAGMA synchronous').fetchone()[0] != SYNCHRONOUS_NORMAL:
+            return True
+        if conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+            return True
+        _, frames, checkpointed = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        return frames == checkpointed
+
+    def save(self, store, conn=None):
+        conn = conn or self.conn
+
+        # large flushes are split into several transactions so a single
+        # flush never holds the write lock (or builds a journal) for the
+        # whole dirty set. status is only updated in the last one, so a
+        # crash part way through replays the whole commit log on restart
+        if store.pending_upsert:
+            for batch in database.chunks(store.pending_upsert, self.batch_size):
+                values = []
+                for key in batch:
+                    item = store.data[key]
+                    values.append((key, item.flags, item.exptime, item.data, item.encoding))
+                NUM_DB_UPSERTS.inc(len(values))
+                logger.debug('values to update: %d', len(values))
+                with conn:
+                    c = conn.cursor()
+                    c.execute('BEGIN')
+                    c.executemany(database.UPSERT, values)
+                    c.execute('COMMIT')
+        else:
+            logger.debug('no values to update')
+
+        if store.pending_delete:
+            for batch in database.chunks(store.pending_delete, self.batch_size):
+                NUM_DB_DELETES.inc(len(batch))
+                logger.debug('keys to delete: %s', batch)
+                with conn:
+                    c = conn.cursor()
+                    c.execute('BEGIN')
+                    c.executemany(database.DELETE, [(key,) for key in batch])
+                    c.execute('COMMIT')
+        else:
+            logger.debug('no keys to delete')
+
+        with conn:
+            c = conn.cursor()
+            c.execute('BEGIN')
+            logger.debug('saving commit %s', store.commit_id)
+            c.execute('INSERT OR REPLACE INTO status (id, commit_id) VALUES (1, ?)', (store.commit_id.bytes,))
+            c.execute('COMMIT')
+
+    def snapshot_point(self, store):
+        # everything up to this point in the commit log is part of the
+        # snapshot. flush is deferred while the snapshot runs, so the
+        # database and the log prefix stay consistent
+        self.commit_log.seek(0, os.SEEK_END)
+        return store.commit_id, self.commit_log.tell()
+
+    async def snapshot(self, store, path, point, pages, loop):
+        commit_id, end = point
+
+        target = os.path.join(path, SNAPSHOT_DB)
+        source = db_path(self.conn)
+        if source:
+            await loop.run_in_executor(None, backup_db, source, target, pages)
+        elif hasattr(self.conn, 'serialize'):
+            # in-memory databases can't be opened from another thread,
+            # but serialize() copies one in a single memcpy, already in
+            # the file format, and only the write is left for the executor
+            await loop.run_in_executor(None, write_file, target, self.conn.serialize())
+        else:
+            # before python 3.11 the copy has to happen in place, and it
+            # blocks the loop until the whole database is copied. pages
+            # only sets the size of each step
+            dest = sqlite3.connect(target)
+            try:
+                self.conn.backup(dest, pages=pages)
+            finally:
+                dest.close()
+
+        with open(os.path.join(path, SNAPSHOT_LOG), 'wb') as f:
+            offset = 0
+            while offset < end:
+                self.commit_log.seek(offset)
+                chunk = self.commit_log.read(min(SNAPSHOT_CHUNK, end - offset))
+                self.commit_log.seek(0, os.SEEK_END)
+                f.write(chunk)
+                offset += len(chunk)
+                await asyncio.sleep(0)
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def compact(self, store):
+        # only real files can be swapped out from under the store
+        path = getattr(self.commit_log, 'name', None)
+        if not isinstance(path, str):
+            return
+
+        self.commit_log.seek(0, os.SEEK_END)
+        end = self.commit_log.tell()
+        if end < self.compaction_min_size:
+            return
+        if store.snapshotting:
+            logger.info('snapshot in progress, deferring compaction')
+            return
+
+        generation = self.generation
+        tmp = path + COMPACT_EXT
+        with Compaction(end) as run, open(path, 'rb') as reader:
+            # find the latest record for every key. records appended after
+            # `end` are copied over verbatim once we are done
+            latest = {}
+            pending = 0
+            for commit_id, command, offset, size in commitlog.read_commits(reader):
+                if offset >= end:
+                    break
+                latest[command.key] = (offset, size, command.tombstone)
+                run.advance(size)
+                pending += size
+                if pending >= CHUNK:
+                    await self.limiter.throttle(pending)
+                    pending = 0
+                    if self.generation != generation:
+                        run.abort('commit log was flushed')
+                        return
+
+            # deletes only need to survive for keys that are in the
+            # database; anything else was inserted and removed since the
+            # last flush and can be dropped altogether
+            live = sorted(
+                (offset, size)
+                for key, (offset, size, tombstone) in latest.items()
+                if not tombstone or key in store.pending_delete)
+            run.total += sum(size for _, size in live)
+
+            with open(tmp, 'wb') as f:
+                pending = 0
+                for offset, size in live:
+                    reader.seek(offset)
+                    f.write(reader.read(size))
+                    run.advance(size)
+                    pending += size
+                    if pending >= CHUNK:
+                        await self.limiter.throttle(pending * 2)
+                        pending = 0
+                        if self.generation != generation:
+                            break
+
+                if self.generation != generation or store.snapshotting:
+                    run.abort('commit log was flushed or snapshotted')
+                    f.close()
+                    os.remove(tmp)
+                    return
+
+                # nothing below yields to the loop, so no commit can land
+                # between copying the tail and swapping the files
+                reader.seek(end)
+                tail = reader.read()
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+
+            os.replace(tmp, path)
+            self.commit_log.close()
+            self.commit_log = open(path, 'a+b')
+            run.reclaimed(end + len(tail), size)
@@ -1,2 +1,7 @@
 class Command(object):
     opcode = None
+    tombstone = False
+
+    def pack_parts(self):
+        # the record as a sequence of buffers, written one after the other
+        return (self.pack(),)
@@ -0,0 +1,86 @@
+import json
+import os
+import tempfile
+import time
+import uuid
+
+import click
+
+import database
+from main import do_configure_logging
+from store import Store, StorageItem
+
+
+PROFILES = {
+    # what main.py used before the persistence layer was tunable
+    'default': {
+        'pragmas': {'journal_mode': 'delete', 'synchronous': 'full', 'cache_size': -2000},
+        'batch_size': None,
+    },
+    'tuned': {
+        'pragmas': {'journal_mode': 'wal', 'synchronous': 'normal', 'mmap_size': 256 * 1024 * 1024},
+        'batch_size': database.BATCH_SIZE,
+    },
+    'tuned-without-rowid': {
+        'pragmas': {'journal_mode': 'wal', 'synchronous': 'normal', 'mmap_size': 256 * 1024 * 1024},
+        'batch_size': database.BATCH_SIZE,
+        'without_rowid': True,
+    },
+}
+
+
+def make_store(path, profile):
+    conn = database.connect(path, **profile['pragmas'])
+    store = Store(
+        conn,
+        open(os.devnull, 'a+b'),
+        batch_size=profile['batch_size'],
+        without_rowid=profile.get('without_rowid', False))
+    store.load_db()
+    return store
+
+def dirty(store, num_keys, value_size, prefix=b'key'):
+    value = b'x' * value_size
+    for i in range(num_keys):
+        store[b'%s_%d' % (prefix, i)] = StorageItem(0, 0, value)
+    store.commit_id = uuid.uuid1()
+
+def bench_flush(directory, profile, num_keys, value_size):
+    store = make_store(os.path.join(directory, 'bench.sqlite'), profile)
+
+    # first flush inserts every key, second one updates all of them
+    results = {}
+    for phase in ('insert', 'update'):
+        dirty(store, num_keys, value_size)
+        start = time.perf_counter()
+        store.save_db()
+        elapsed = time.perf_counter() - start
+        results[phase] = {
+            'seconds': elapsed,
+            'keys_per_sec': num_keys / elapsed,
+        }
+    store.conn.close()
+    return results
+
+@click.command()
+@click.option('--keys', '-n', multiple=True, type=int, default=[10000, 100000, 1000000],
+              help='dirty key counts to flush')
+@click.option('--value-size', default=100, help='bytes per value')
+@click.option('--profile', '-p', 'profiles', multiple=True, type=click.Choice(list(PROFILES)),
+              default=list(PROFILES))
+def main(keys, value_size, profiles):
+    do_configure_logging({'level': 'WARNING'})
+    results = []
+    for num_keys in keys:
+        for name in profiles:
+            with tempfile.TemporaryDirectory() as directory:
+                result = bench_flush(directory, PROFILES[name], num_keys, value_size)
+            for phase, stats in result.items():
+                click.echo('{:>8} keys {:<20} {:<6} {:8.3f}s {:>12,.0f} keys/s'.format(
+                    num_keys, name, phase, stats['seconds'], stats['keys_per_sec']), err=True)
+            results.append({'keys': num_keys, 'profile': name, **result})
+    click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
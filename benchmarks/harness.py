@@ -0,0 +1,93 @@
+import json
+import math
+import time
+
+
+PERCENTILES = (50, 90, 99, 99.9)
+# p99 changes smaller than this are timer jitter, whatever the ratio
+LATENCY_SLACK_US = 5.0
+
+
+def percentile(samples, p):
+    # samples must be sorted. nearest-rank, which is what HdrHistogram and
+    # most load tools report
+    if not samples:
+        return 0.0
+    rank = max(1, math.ceil(p / 100.0 * len(samples)))
+    return samples[min(rank, len(samples)) - 1]
+
+def summarize(samples, items=1):
+    # samples are per-operation durations in seconds. items is how many
+    # logical operations each sample covers (keys per flush, etc)
+    samples = sorted(samples)
+    total = sum(samples)
+    count = len(samples) * items
+    return {
+        'ops': count,
+        'seconds': total,
+        'ops_per_sec': count / total if total else 0.0,
+        'latency_us': dict(
+            [('p%s' % p, percentile(samples, p) * 1e6) for p in PERCENTILES] +
+            [('max', samples[-1] * 1e6 if samples else 0.0)]),
+    }
+
+def timeit(fn, ops, setup=None, rounds=1, reset=None):
+    # for cheap operations the timer itself is a large part of each sample,
+    # so those run several rounds and keep the fastest one
+    best = None
+    clock = time.perf_counter
+    for _ in range(rounds):
+        if reset:
+            reset()
+        samples = []
+        for i in range(ops):
+            if setup:
+                setup(i)
+            start = clock()
+            fn(i)
+            samples.append(clock() - start)
+        if best is None or sum(samples) < sum(best):
+            best = samples
+    return best
+
+async def atimeit(fn, ops, setup=None, rounds=1, reset=None):
+    best = None
+    clock = time.perf_counter
+    for _ in range(rounds):
+        if reset:
+            reset()
+        samples = []
+        for i in range(ops):
+            if setup:
+                setup(i)
+            start = clock()
+            await fn(i)
+            samples.append(clock() - start)
+        if best is None or sum(samples) < sum(best):
+            best = samples
+    return best
+
+def compare(results, baseline, tolerance):
+    # a benchmark regresses when its throughput drops, or its p99 rises, by
+    # more than `tolerance` relative to the baseline
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append('{}: {:,.0f} ops/s vs {:,.0f} baseline'.format(
+                name, result['ops_per_sec'], base['ops_per_sec']))
+        p99, base_p99 = result['latency_us']['p99'], base['latency_us']['p99']
+        if p99 > base_p99 * (1 + tolerance) and p99 - base_p99 > LATENCY_SLACK_US:
+            regressions.append('{}: p99 {:,.1f}us vs {:,.1f}us baseline'.format(
+                name, p99, base_p99))
+    return regressions
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+def dump(path, results, meta):
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
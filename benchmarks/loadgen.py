@@ -0,0 +1,361 @@
+import asyncio
+import bisect
+import itertools
+import json
+import math
+import random
+import time
+
+import click
+
+
+OPS = ('get', 'mget', 'set', 'delete')
+
+
+class Histogram(object):
+    # log-linear buckets in the style of HdrHistogram: each power of two is
+    # split into `precision` linear sub-buckets, so any recorded value is
+    # reported within 1/precision of its true value with fixed memory
+    def __init__(self, precision=64):
+        self.precision = precision
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        if value < 1:
+            return 0, int(value * self.precision)
+        exponent = int(math.log2(value))
+        return exponent + 1, int((value / 2 ** exponent - 1) * self.precision)
+
+    def value(self, bucket):
+        exponent, sub = bucket
+        if exponent == 0:
+            return (sub + 1) / self.precision
+        return 2 ** (exponent - 1) * (1 + (sub + 1) / self.precision)
+
+    def record(self, value):
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        target = max(1, math.ceil(p / 100.0 * self.count))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                return min(self.value(bucket), self.max)
+        return self.max
+
+    def summary(self, percentiles=(50, 90, 99, 99.9, 99.99)):
+        return dict(
+            [('count', self.count),
+             ('min', self.min or 0.0),
+             ('mean', self.total / self.count if self.count else 0.0),
+             ('max', self.max or 0.0)] +
+            [('p%s' % p, self.percentile(p)) for p in percentiles])
+
+
+class Zipf(object):
+    # key ranks drawn with probability proportional to 1 / rank ** s. s=0 is
+    # uniform, s around 1 is typical of cache workloads
+    def __init__(self, n, s, rng):
+        self.rng = rng
+        weights = [1.0 / (rank ** s) for rank in range(1, n + 1)]
+        self.cdf = list(itertools.accumulate(weights))
+
+    def __call__(self):
+        return bisect.bisect_left(self.cdf, self.rng.random() * self.cdf[-1])
+
+
+class ValueSize(object):
+    # fixed:N, uniform:MIN:MAX or pareto:MIN:ALPHA (heavy tailed, capped at
+    # 1MB like memcached's default item size)
+    def __init__(self, spec, rng):
+        self.rng = rng
+        kind, *args = spec.split(':')
+        self.kind = kind
+        self.args = [float(arg) for arg in args]
+        if kind not in ('fixed', 'uniform', 'pareto'):
+            raise click.BadParameter('unknown value size distribution: {}'.format(spec))
+
+    def __call__(self):
+        if self.kind == 'fixed':
+            return int(self.args[0])
+        if self.kind == 'uniform':
+            return self.rng.randint(int(self.args[0]), int(self.args[1]))
+        minimum, alpha = self.args
+        return min(1024 * 1024, int(minimum * self.rng.paretovariate(alpha)))
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        op, weight = part.split('=')
+        if op not in OPS:
+            raise click.BadParameter('unknown operation: {}'.format(op))
+        mix[op] = float(weight)
+    return mix
+
+
+class Connection(object):
+    def __init__(self, host, port, reader, writer):
+        self.host = host
+        self.port = port
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(host, port, reader, writer)
+
+    def close(self):
+        self.writer.close()
+
+    async def reconnect(self):
+        # after an error or unexpected reply the stream can be part way
+        # through a response, so nothing more read from it can be trusted
+        self.close()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def get(self, *keys):
+        self.writer.write(b'get %s\r\n' % b' '.join(keys))
+        hits = 0
+        while True:
+            line = await self.reader.readuntil(b'\r\n')
+            if line == b'END\r\n':
+                return hits
+            if not line.startswith(b'VALUE '):
+                raise IOError(line.strip().decode(errors='replace'))
+            await self.reader.readexactly(int(line.split()[3]) + 2)
+            hits += 1
+
+    async def set(self, key, value):
+        self.writer.write(b'set %s 0 0 %d\r\n%s\r\n' % (key, len(value), value))
+        line = await self.reader.readuntil(b'\r\n')
+        if line != b'STORED\r\n':
+            raise IOError(line.strip().decode(errors='replace'))
+
+    async def delete(self, key):
+        self.writer.write(b'delete %s\r\n' % key)
+        line = await self.reader.readuntil(b'\r\n')
+        if line not in (b'DELETED\r\n', b'NOT_FOUND\r\n'):
+            raise IOError(line.strip().decode(errors='replace'))
+
+
+class Workload(object):
+    def __init__(self, mix, keys, zipf, value_size, mget_size, seed=None):
+        self.rng = random.Random(seed)
+        self.ops = list(mix)
+        self.weights = list(itertools.accumulate(mix[op] for op in self.ops))
+        self.keys = [b'key:%d' % i for i in range(keys)]
+        self.pick = Zipf(keys, zipf, self.rng)
+        self.value_size = ValueSize(value_size, self.rng)
+        self.mget_size = mget_size
+        self.values = {}
+
+    def key(self):
+        return self.keys[self.pick()]
+
+    def value(self):
+        size = self.value_size()
+        if size not in self.values:
+            self.values[size] = b'v' * size
+        return self.values[size]
+
+    def next(self):
+        op = self.ops[bisect.bisect_left(self.weights, self.rng.random() * self.weights[-1])]
+        if op == 'get':
+            return op, (self.key(),)
+        if op == 'mget':
+            return op, tuple(self.key() for _ in range(self.mget_size))
+        if op == 'set':
+            return op, (self.key(), self.value())
+        return op, (self.key(),)
+
+
+class Stats(object):
+    def __init__(self):
+        self.latency = {op: Histogram() for op in OPS}
+        self.errors = 0
+        self.hits = 0
+        self.misses = 0
+
+    def all(self):
+        total = Histogram()
+        for histogram in self.latency.values():
+            total.merge(histogram)
+        return total
+
+
+ERRORS = (IOError, asyncio.IncompleteReadError, asyncio.LimitOverrunError)
+
+
+async def execute(conn, stats, op, args, start):
+    # returns False if the connection had to be given up
+    try:
+        if op in ('get', 'mget'):
+            hits = await conn.get(*args)
+            stats.hits += hits
+            stats.misses += len(args) - hits
+        elif op == 'set':
+            await conn.set(*args)
+        else:
+            await conn.delete(*args)
+    except ERRORS:
+        stats.errors += 1
+        try:
+            await conn.reconnect()
+        except OSError:
+            return False
+        return True
+    # microseconds
+    stats.latency[op].record((time.perf_counter() - start) * 1e6)
+    return True
+
+async def closed_loop(conns, workload, stats, deadline):
+    # every connection sends its next request as soon as the previous
+    # response arrives
+    async def worker(conn):
+        while time.perf_counter() < deadline:
+            op, args = workload.next()
+            if not await execute(conn, stats, op, args, time.perf_counter()):
+                return
+    await asyncio.gather(*(worker(conn) for conn in conns))
+
+async def open_loop(conns, workload, stats, deadline, rate):
+    # requests are scheduled at a fixed rate regardless of how fast the
+    # server answers. latency is measured from the scheduled time, so
+    # requests queued behind a slow one are charged for the wait instead of
+    # being silently delayed (coordinated omission)
+    queues = [asyncio.Queue() for _ in conns]
+
+    async def worker(conn, queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            op, args, scheduled = item
+            if not await execute(conn, stats, op, args, scheduled):
+                # count what this connection would have sent as errors
+                while await queue.get() is not None:
+                    stats.errors += 1
+                return
+
+    workers = [asyncio.ensure_future(worker(conn, queue)) for conn, queue in zip(conns, queues)]
+    interval = 1.0 / rate
+    start = time.perf_counter()
+    for i in itertools.count():
+        scheduled = start + i * interval
+        if scheduled >= deadline:
+            break
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        op, args = workload.next()
+        queues[i % len(queues)].put_nowait((op, args, scheduled))
+    for queue in queues:
+        queue.put_nowait(None)
+    await asyncio.gather(*workers)
+
+async def prefill(conns, workload):
+    keys = workload.keys
+    async def worker(conn, offset):
+        for key in keys[offset::len(conns)]:
+            await conn.set(key, workload.value())
+    await asyncio.gather(*(worker(conn, i) for i, conn in enumerate(conns)))
+
+async def run(host, port, connections, duration, rate, workload, fill):
+    conns = await asyncio.gather(*(Connection.open(host, port) for _ in range(connections)))
+    try:
+        if fill:
+            await prefill(conns, workload)
+        stats = Stats()
+        start = time.perf_counter()
+        deadline = start + duration
+        if rate:
+            await open_loop(conns, workload, stats, deadline, rate)
+        else:
+            await closed_loop(conns, workload, stats, deadline)
+        elapsed = time.perf_counter() - start
+    finally:
+        for conn in conns:
+            conn.close()
+    return stats, elapsed
+
+def report(stats, elapsed, settings):
+    total = stats.all()
+    return {
+        'settings': settings,
+        'seconds': elapsed,
+        'requests': total.count,
+        'throughput': total.count / elapsed if elapsed else 0.0,
+        'errors': stats.errors,
+        'hit_ratio': stats.hits / (stats.hits + stats.misses) if stats.hits + stats.misses else 0.0,
+        'latency_us': dict(
+            [('all', total.summary())] +
+            [(op, histogram.summary()) for op, histogram in stats.latency.items() if histogram.count]),
+    }
+
+@click.command()
+@click.option('--host', default='127.0.0.1', help='memcache server to load')
+@click.option('-p', '--port', default=11211)
+@click.option('-c', '--connections', default=50, help='number of connections')
+@click.option('-d', '--duration', default=10.0, help='seconds to run for')
+@click.option('-r', '--rate', default=0.0,
+              help='requests/sec across all connections (open loop). 0 runs closed loop')
+@click.option('--mix', default='get=80,mget=5,set=10,delete=5', callback=lambda ctx, param, value: parse_mix(value),
+              help='operation weights')
+@click.option('--keys', default=100000, help='size of the key space')
+@click.option('--zipf', default=0.99, help='zipf exponent for key popularity, 0 for uniform')
+@click.option('--value-size', default='pareto:100:1.5',
+              help='fixed:N, uniform:MIN:MAX or pareto:MIN:ALPHA')
+@click.option('--mget-size', default=10, help='keys per multi-get')
+@click.option('--prefill/--no-prefill', default=True, help='set every key before measuring')
+@click.option('--seed', type=int, default=None)
+@click.option('-o', '--output', type=click.Path(), help='also write the report as json to PATH')
+def main(host, port, connections, duration, rate, mix, keys, zipf, value_size, mget_size, prefill, seed, output):
+    workload = Workload(mix, keys, zipf, value_size, mget_size, seed)
+    settings = {
+        'host': host, 'port': port, 'connections': connections, 'duration': duration,
+        'mode': 'open' if rate else 'closed', 'rate': rate, 'mix': mix, 'keys': keys,
+        'zipf': zipf, 'value_size': value_size, 'mget_size': mget_size,
+    }
+    loop = asyncio.get_event_loop()
+    stats, elapsed = loop.run_until_complete(
+        run(host, port, connections, duration, rate, workload, prefill))
+    result = report(stats, elapsed, settings)
+
+    click.echo('{:,} requests in {:.1f}s, {:,.0f} req/s, {} errors, {:.1%} hits'.format(
+        result['requests'], elapsed, result['throughput'], result['errors'], result['hit_ratio']), err=True)
+    for op, summary in result['latency_us'].items():
+        click.echo('  {:<7} n={:<9,} p50 {:>9.1f}us  p99 {:>9.1f}us  p99.9 {:>9.1f}us  max {:>9.1f}us'.format(
+            op, summary['count'], summary['p50'], summary['p99'], summary['p99.9'], summary['max']), err=True)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+    click.echo(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
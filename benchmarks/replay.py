@@ -0,0 +1,186 @@
+import asyncio
+from collections import deque
+import json
+import time
+
+import click
+
+from benchmarks.loadgen import Histogram
+import capture
+
+
+ERRORS = (b'ERROR', b'CLIENT_ERROR', b'SERVER_ERROR')
+# seconds to wait for the last replies on a connection
+CLOSE_TIMEOUT = 10
+
+
+class Connection(object):
+    # one captured connection. requests go out when the capture says they
+    # were sent, without waiting for replies, and a reader task matches the
+    # replies to them in order
+    def __init__(self, reader, writer, stats):
+        self.reader = reader
+        self.writer = writer
+        self.stats = stats
+        self.waiting = deque()
+        self.done = asyncio.Event()
+        self.done.set()
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+
+    @classmethod
+    async def open(cls, host, port, stats):
+        reader, writer = await asyncio.open_connection(host, port, limit=2 ** 24)
+        return cls(reader, writer, stats)
+
+    def send(self, line, scheduled):
+        self.writer.write(line)
+        argv = line.split()
+        if not argv:
+            return
+        command = argv[0].lower()
+        if argv[-1] == b'noreply':
+            return
+        self.waiting.append((command.decode(errors='replace'), scheduled))
+        self.done.clear()
+
+    def send_value(self, size, data):
+        self.writer.write(data)
+        if size > len(data):
+            self.writer.write(b'x' * (size - len(data)))
+        self.writer.write(b'\r\n')
+
+    async def read_reply(self):
+        # a single line, or VALUE/STAT lines up to END
+        error = False
+        while True:
+            line = await self.reader.readuntil(b'\r\n')
+            if line.startswith(b'VALUE '):
+                await self.reader.readexactly(int(line.split()[3]) + 2)
+            elif not line.startswith(b'STAT '):
+                return error or line.startswith(ERRORS)
+
+    async def read_loop(self):
+        try:
+            while True:
+                error = await self.read_reply()
+                if not self.waiting:
+                    # more replies than requests that expect one
+                    self.stats.errors += 1
+                    continue
+                command, scheduled = self.waiting.popleft()
+                if error:
+                    self.stats.errors += 1
+                self.stats.latency(command).record((time.perf_counter() - scheduled) * 1e6)
+                if not self.waiting:
+                    self.done.set()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.stats.errors += len(self.waiting)
+            self.waiting.clear()
+            self.done.set()
+
+    async def close(self):
+        try:
+            await asyncio.wait_for(self.done.wait(), CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats.errors += len(self.waiting)
+        self.reader_task.cancel()
+        self.writer.close()
+
+
+class Stats(object):
+    def __init__(self):
+        self.commands = {}
+        self.errors = 0
+        # how far behind the capture's schedule requests went out
+        self.lag = Histogram()
+
+    def latency(self, command):
+        histogram = self.commands.get(command)
+        if histogram is None:
+            histogram = self.commands[command] = Histogram()
+        return histogram
+
+    def all(self):
+        total = Histogram()
+        for histogram in self.commands.values():
+            total.merge(histogram)
+        return total
+
+
+async def replay(host, port, records, speed=1.0):
+    # speed 2 replays twice as fast as captured, 0 as fast as possible.
+    # latency is measured from when a request was due rather than when it
+    # went out, so a replay that falls behind shows up in it
+    stats = Stats()
+    conns = {}
+    # connections waiting on their last replies, closed alongside the
+    # replay so they don't hold up the others' requests
+    closing = []
+    start = time.perf_counter()
+    for kind, seconds, conn_id, size, data in records:
+        scheduled = start + seconds / speed if speed else time.perf_counter()
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            stats.lag.record(-delay * 1e6)
+
+        conn = conns.get(conn_id)
+        if kind == capture.CLOSE:
+            if conn is not None:
+                del conns[conn_id]
+                closing.append(asyncio.ensure_future(conn.close()))
+            continue
+        if conn is None:
+            # connections opened before the capture started have no OPEN
+            conn = conns[conn_id] = await Connection.open(host, port, stats)
+        if kind == capture.LINE:
+            conn.send(data, scheduled)
+        elif kind == capture.VALUE:
+            conn.send_value(size, data)
+    await asyncio.gather(*closing, *(conn.close() for conn in conns.values()))
+    return stats, time.perf_counter() - start
+
+def report(stats, elapsed, settings):
+    total = stats.all()
+    return {
+        'settings': settings,
+        'seconds': elapsed,
+        'requests': total.count,
+        'throughput': total.count / elapsed if elapsed else 0.0,
+        'errors': stats.errors,
+        'schedule_lag_us': stats.lag.summary(),
+        'latency_us': dict(
+            [('all', total.summary())] +
+            [(command, histogram.summary()) for command, histogram in sorted(stats.commands.items())]),
+    }
+
+@click.command()
+@click.argument('capture_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--host', default='127.0.0.1', help='memcache server to replay against')
+@click.option('-p', '--port', default=11211)
+@click.option('-s', '--speed', default=1.0,
+              help='multiple of the captured speed, 0 to send every request as soon as possible')
+@click.option('-o', '--output', type=click.Path(), help='also write the report as json to PATH')
+def main(capture_file, host, port, speed, output):
+    settings = {'capture': capture_file, 'host': host, 'port': port, 'speed': speed}
+    loop = asyncio.get_event_loop()
+    with open(capture_file, 'rb') as f:
+        stats, elapsed = loop.run_until_complete(
+            replay(host, port, capture.read_records(f), speed))
+    result = report(stats, elapsed, settings)
+
+    click.echo('{:,} requests in {:.1f}s, {:,.0f} req/s, {} errors'.format(
+        result['requests'], elapsed, result['throughput'], result['errors']), err=True)
+    for command, summary in result['latency_us'].items():
+        click.echo('  {:<9} n={:<9,} p50 {:>9.1f}us  p99 {:>9.1f}us  p99.9 {:>9.1f}us  max {:>9.1f}us'.format(
+            command, summary['count'], summary['p50'], summary['p99'], summary['p99.9'], summary['max']), err=True)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+    click.echo(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+import asyncio
+from collections import OrderedDict
+import io
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+import click
+import prometheus_client
+
+from backends import SQLiteBackend
+from benchmarks import harness
+import commands
+import database
+from main import do_configure_logging
+import metrics
+from server import MemcacheServer
+from store import Store, StorageItem
+from valuecache import ValueCache
+
+
+BENCHMARKS = OrderedDict()
+
+# (quick, full) parameters
+SIZES = {
+    'ops': (2000, 20000),
+    'fsync_ops': (200, 2000),
+    'flush_keys': ((1000, 10000), (1000, 10000, 100000)),
+    'log_commits': ((1000, 10000), (1000, 10000, 100000)),
+    'repeat': (3, 5),
+    'rounds': (3, 5),
+}
+
+VALUE = b'x' * 100
+
+
+def benchmark(name):
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return decorator
+
+def size(ctx, name):
+    return SIZES[name][0 if ctx['quick'] else 1]
+
+def make_store(directory, name='bench', fsync=False):
+    conn = database.connect(os.path.join(directory, name + '.sqlite'))
+    store = Store(conn, open(os.path.join(directory, name + '.log'), 'a+b'))
+    store.backend.fsync = fsync
+    store.load_db()
+    return store
+
+def fill(store, num_keys, prefix=b'key'):
+    for i in range(num_keys):
+        store[b'%s_%d' % (prefix, i)] = StorageItem(0, 0, VALUE)
+    store.commit_id = uuid.uuid1()
+
+def write_log(store, num_commits, num_keys=1000):
+    for i in range(num_commits):
+        store.apply(commands.SetCommand(b'key_%d' % (i % num_keys), 0, 0, VALUE))
+
+
+@benchmark('store.setitem')
+def bench_setitem(ctx):
+    store = Store(None, io.BytesIO())
+    keys = [b'key_%d' % i for i in range(size(ctx, 'ops'))]
+    item = StorageItem(0, 0, VALUE)
+    def reset():
+        store.data.clear()
+        store.clear_pending()
+    def op(i):
+        store[keys[i]] = item
+    samples = harness.timeit(op, len(keys), rounds=size(ctx, 'rounds'), reset=reset)
+    yield 'store.setitem', harness.summarize(samples)
+
+@benchmark('store.getitem')
+def bench_getitem(ctx):
+    store = Store(None, io.BytesIO())
+    fill(store, size(ctx, 'ops'))
+    keys = list(store.keys())
+    def op(i):
+        store[keys[i]]
+    samples = harness.timeit(op, len(keys), rounds=size(ctx, 'rounds'))
+    yield 'store.getitem', harness.summarize(samples)
+
+@benchmark('store.apply')
+def bench_apply(ctx):
+    for fsync in (False, True):
+        store = make_store(ctx['dir'], 'apply_%s' % fsync, fsync=fsync)
+        ops = size(ctx, 'fsync_ops' if fsync else 'ops')
+        def op(i):
+            store.apply(commands.SetCommand(b'key_%d' % i, 0, 0, VALUE))
+        name = 'store.apply.%s' % ('fsync' if fsync else 'nofsync')
+        yield name, harness.summarize(harness.timeit(op, ops))
+
+@benchmark('store.save_db')
+def bench_save_db(ctx):
+    for num_keys in size(ctx, 'flush_keys'):
+        store = make_store(ctx['dir'], 'save_%d' % num_keys)
+        def setup(i):
+            fill(store, num_keys)
+        def op(i):
+            store.save_db()
+        samples = harness.timeit(op, size(ctx, 'repeat'), setup)
+        yield 'store.save_db.%d' % num_keys, harness.summarize(samples, num_keys)
+
+@benchmark('store.load_db')
+def bench_load_db(ctx):
+    for num_keys in size(ctx, 'flush_keys'):
+        store = make_store(ctx['dir'], 'load_%d' % num_keys)
+        fill(store, num_keys)
+        store.save_db()
+        def op(i):
+            Store(store.conn, store.commit_log).load_db()
+        samples = harness.timeit(op, size(ctx, 'repeat'))
+        yield 'store.load_db.%d' % num_keys, harness.summarize(samples, num_keys)
+        def lazy(i):
+            Store(SQLiteBackend(store.conn, store.commit_log, lazy=True)).load_db()
+        samples = harness.timeit(lazy, size(ctx, 'repeat'))
+        yield 'store.load_db.lazy.%d' % num_keys, harness.summarize(samples, num_keys)
+
+@benchmark('store.sync_commit_log')
+def bench_sync_commit_log(ctx):
+    for num_commits in size(ctx, 'log_commits'):
+        store = make_store(ctx['dir'], 'replay_%d' % num_commits)
+        write_log(store, num_commits)
+        def op(i):
+            Store(store.conn, store.commit_log).sync_commit_log()
+        samples = harness.timeit(op, size(ctx, 'repeat'))
+        yield 'store.sync_commit_log.%d' % num_commits, harness.summarize(samples, num_commits)
+
+@benchmark('metrics')
+def bench_metrics(ctx):
+    # the instrumentation dispatch and handler do per request: time the
+    # command, count its errors and bytes out
+    ops = size(ctx, 'ops')
+    for name, module in (('prometheus_client', prometheus_client), ('local', metrics)):
+        duration = module.Histogram('duration', 'Duration', ['command'], registry=None)
+        errors = module.Counter('errors', 'Errors', ['command'], registry=None)
+        bytes_out = module.Counter('bytes', 'Bytes', registry=None)
+        def op(i):
+            start = time.perf_counter()
+            errors.labels('get')
+            duration.labels('get').observe(time.perf_counter() - start)
+            bytes_out.inc(100)
+        samples = harness.timeit(op, ops, rounds=size(ctx, 'rounds'))
+        yield 'metrics.request.%s' % name, harness.summarize(samples)
+
+@benchmark('server.dispatch')
+def bench_dispatch(ctx):
+    ops = size(ctx, 'ops')
+    store = Store(sqlite3.connect(':memory:'), io.BytesIO())
+    store.backend.fsync = False
+    store.load_db()
+    server = MemcacheServer(store)
+    reader = asyncio.StreamReader()
+    sets = [b'SET key_%d 0 0 %d' % (i, len(VALUE)) for i in range(ops)]
+    gets = [b'GET key_%d' % i for i in range(ops)]
+
+    def feed(i):
+        reader.feed_data(VALUE + b'\r\n')
+    async def do_set(i):
+        await server.dispatch(reader, sets[i])
+    async def do_get(i):
+        await server.dispatch(reader, gets[i])
+
+    loop = ctx['loop']
+    yield 'server.dispatch.set', harness.summarize(loop.run_until_complete(harness.atimeit(do_set, ops, feed)))
+    samples = loop.run_until_complete(harness.atimeit(do_get, ops, rounds=size(ctx, 'rounds')))
+    yield 'server.dispatch.get', harness.summarize(samples)
+    # keys are admitted on their second miss, so the first two rounds
+    # fill the cache
+    store.value_cache = ValueCache(max_items=ops)
+    samples = loop.run_until_complete(harness.atimeit(do_get, ops, rounds=size(ctx, 'rounds') + 2))
+    yield 'server.dispatch.get.cached', harness.summarize(samples)
+
+@benchmark('server.handler')
+def bench_handler(ctx):
+    ops = size(ctx, 'ops')
+    store = Store(sqlite3.connect(':memory:'), io.BytesIO())
+    store.backend.fsync = False
+    store.load_db()
+    server = MemcacheServer(store)
+    sets = [b'set key_%d 0 0 %d\r\n%s\r\n' % (i, len(VALUE), VALUE) for i in range(ops)]
+    gets = [b'get key_%d\r\n' % i for i in range(ops)]
+
+    async def run():
+        listener = await asyncio.start_server(server.handler, '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+        async def do_set(i):
+            writer.write(sets[i])
+            await reader.readuntil(b'\r\n')
+        async def do_get(i):
+            writer.write(gets[i])
+            await reader.readuntil(b'END\r\n')
+
+        results = [
+            ('server.handler.set', harness.summarize(await harness.atimeit(do_set, ops))),
+            ('server.handler.get', harness.summarize(await harness.atimeit(do_get, ops))),
+        ]
+        writer.close()
+        await writer.wait_closed()
+        listener.close()
+        await listener.wait_closed()
+        # let the handler see the eof and return
+        await asyncio.sleep(0.1)
+        return results
+
+    yield from ctx['loop'].run_until_complete(run())
+
+
+def run(names, quick=False):
+    results = OrderedDict()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            ctx = {'dir': directory, 'quick': quick, 'loop': loop}
+            for name in names:
+                for result_name, result in BENCHMARKS[name](ctx):
+                    results[result_name] = result
+                    click.echo('{:<32} {:>14,.0f} ops/s  p50 {:>9.1f}us  p99 {:>9.1f}us'.format(
+                        result_name, result['ops_per_sec'],
+                        result['latency_us']['p50'], result['latency_us']['p99']), err=True)
+    finally:
+        loop.close()
+    return results
+
+@click.command()
+@click.option('--quick', is_flag=True, help='smaller sizes, for a fast sanity check')
+@click.option('-k', '--only', multiple=True, type=click.Choice(list(BENCHMARKS)),
+              help='benchmarks to run (default: all)')
+@click.option('-o', '--output', type=click.Path(), help='write results as json to PATH')
+@click.option('--baseline', type=click.Path(), default='benchmarks/baseline.json',
+              help='compare against the results in PATH')
+@click.option('--save-baseline', is_flag=True, help='write the results to the baseline instead of comparing')
+@click.option('--tolerance', default=0.25, help='allowed regression, as a fraction of the baseline')
+@click.option('--require-baseline', is_flag=True, help='fail instead of warning when there is no baseline')
+def main(quick, only, output, baseline, save_baseline, tolerance, require_baseline):
+    do_configure_logging({'level': 'WARNING'})
+    results = run(only or list(BENCHMARKS), quick)
+    meta = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'quick': quick,
+    }
+
+    if output:
+        harness.dump(output, results, meta)
+    if save_baseline:
+        harness.dump(baseline, results, meta)
+        click.echo('saved baseline to {}'.format(baseline), err=True)
+        return
+    if not output:
+        click.echo(json.dumps({'meta': meta, 'results': results}, indent=2))
+
+    # baselines are machine specific so none is committed. say so loudly
+    # rather than pass without having compared anything
+    if not os.path.exists(baseline):
+        click.echo('WARNING: no baseline at {}, nothing was checked for regressions '
+                   '(save one with --save-baseline)'.format(baseline), err=True)
+        if require_baseline:
+            sys.exit(1)
+        return
+
+    regressions = harness.compare(results, harness.load(baseline), tolerance)
+    if regressions:
+        click.echo('PERFORMANCE REGRESSIONS against {}:'.format(baseline), err=True)
+        for regression in regressions:
+            click.echo('  ' + regression, err=True)
+        sys.exit(1)
+    click.echo('no regressions against {}'.format(baseline), err=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import math
+
+
+ERROR_RATE = 0.01
+
+
+class BloomFilter(object):
+    # a set of keys that answers "definitely not present" or "maybe
+    # present". num_bits and num_hashes are the optimum for holding
+    # `capacity` keys at `error_rate` false positives; adding more keys
+    # than that raises the false positive rate but never gives a false
+    # negative
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        capacity = max(1, capacity)
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def positions(self, key):
+        # Kirsch and Mitzenmacher: k positions from two hashes as h1 + i*h2,
+        # here the two halves of python's (siphash) hash. it's salted per
+        # process, which is fine for a filter that is never persisted
+        h = hash(key)
+        h1, h2 = h & 0xffffffff, ((h >> 32) & 0xffffffff) | 1
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for position in self.positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def update(self, keys):
+        # add() inlined, for building the filter from a whole table
+        bits, num_bits, hashes = self.bits, self.num_bits, range(self.num_hashes)
+        for key in keys:
+            h = hash(key)
+            h1, h2 = h & 0xffffffff, ((h >> 32) & 0xffffffff) | 1
+            for i in hashes:
+                position = (h1 + i * h2) % num_bits
+                bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self.positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
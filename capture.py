@@ -0,0 +1,101 @@
+import struct
+import time
+
+import metrics
+
+
+CAPTURED_RECORDS = metrics.Counter('capture_records', 'Records written to the traffic capture')
+CAPTURED_BYTES = metrics.Counter('capture_bytes', 'Bytes written to the traffic capture')
+
+
+MAGIC = b'KVCAP\x01'
+# kind, seconds since the capture started, connection id, size of what was
+# read and how much of it follows the header (less than size for truncated
+# values)
+RECORD = struct.Struct('=BdIII')
+
+OPEN = 1
+CLOSE = 2
+LINE = 3
+VALUE = 4
+
+# commands about the server rather than its data, which replaying would
+# only repeat against the target (snapshots, profiles, captures) or get
+# errors for
+ADMIN = {b'stats', b'slowlog', b'capture', b'snapshot', b'profile', b'dump', b'dumplog', b'dumpcommit'}
+
+# bytes of each value kept, the rest is replayed as padding. None keeps
+# whole values
+MAX_VALUE = 64
+BUFFER_SIZE = 1024 * 1024
+
+
+class Capture(object):
+    # what every connection sent, in the order the server read it, for
+    # benchmarks/replay.py. the server calls line() for each request line and
+    # value() for each set's value, so replay gets the same request
+    # boundaries the server saw. writes are buffered, so a record usually
+    # costs a struct.pack and two copies into the buffer
+    def __init__(self, path, max_value=MAX_VALUE, buffer_size=BUFFER_SIZE, clock=time.monotonic):
+        self.path = path
+        self.max_value = max_value
+        self.clock = clock
+        self.start = clock()
+        self.records = 0
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.file.write(MAGIC)
+
+    def record(self, kind, conn, data=b'', size=None):
+        if self.file.closed:
+            # stopped while a request it saw the start of was in progress
+            return
+        header = RECORD.pack(kind, self.clock() - self.start, conn,
+                             len(data) if size is None else size, len(data))
+        self.file.write(header)
+        self.file.write(data)
+        self.records += 1
+        CAPTURED_RECORDS.inc()
+        CAPTURED_BYTES.inc(len(header) + len(data))
+
+    def opened(self, conn):
+        self.record(OPEN, conn)
+
+    def closed(self, conn):
+        self.record(CLOSE, conn)
+
+    def line(self, conn, line):
+        argv = line.split(None, 1)
+        if argv and argv[0].lower() in ADMIN:
+            return
+        self.record(LINE, conn, line)
+
+    def value(self, conn, size, data=b''):
+        if self.max_value is not None:
+            data = data[:self.max_value]
+        self.record(VALUE, conn, data, size)
+
+    def close(self):
+        self.file.close()
+
+    def info(self):
+        return {
+            'path': self.path,
+            'seconds': self.clock() - self.start,
+            'records': self.records,
+        }
+
+
+def read_records(f):
+    # (kind, seconds, conn, size, data) for each record in a capture file
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a capture file')
+    while True:
+        header = f.read(RECORD.size)
+        if len(header) < RECORD.size:
+            # the end, or a capture cut off mid-record
+            return
+        kind, seconds, conn, size, stored = RECORD.unpack(header)
+        data = f.read(stored)
+        if len(data) < stored:
+            return
+        yield kind, seconds, conn, size, data
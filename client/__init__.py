@@ -0,0 +1,4 @@
+from client.aio import AsyncClient
+from client.hashring import HashRing
+from client.protocol import ClientError, ProtocolError, ServerError
+from client.sync import Client
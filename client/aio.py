@@ -0,0 +1,203 @@
+import asyncio
+from collections import deque
+
+from client import protocol
+from client.hashring import HashRing
+
+
+POOL_SIZE = 2
+# start waiting for the socket once this much is queued for a server
+HIGH_WATER = 64 * 1024
+
+
+class Connection(object):
+    # requests are written as soon as they're made and replies are matched
+    # to them in order by a single reader task, so any number of callers can
+    # have requests in flight on one connection (pipelining)
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.waiting = deque()
+        self.drain_lock = asyncio.Lock()
+        self.closed = False
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    @property
+    def in_flight(self):
+        return len(self.waiting)
+
+    async def request(self, data, parse):
+        if self.closed:
+            raise ConnectionError('connection closed')
+        future = asyncio.get_event_loop().create_future()
+        self.writer.write(data)
+        self.waiting.append((parse, future))
+        if self.writer.transport.get_write_buffer_size() > HIGH_WATER:
+            async with self.drain_lock:
+                await self.writer.drain()
+        return await future
+
+    async def read_loop(self):
+        try:
+            while True:
+                # always reading, so a connection the server closes is
+                # noticed before it's used again
+                line = await self.reader.readuntil(protocol.SEP)
+                if not self.waiting:
+                    raise protocol.ProtocolError('unexpected reply: {!r}'.format(line))
+                parse, future = self.waiting[0]
+                try:
+                    result = await parse(line, self.reader)
+                except (protocol.ClientError, protocol.ServerError) as e:
+                    # an error reply, so the stream is still in step
+                    self.waiting.popleft()
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                self.waiting.popleft()
+                # a caller that timed out has cancelled its future
+                if not future.done():
+                    future.set_result(result)
+        except asyncio.CancelledError:
+            self.fail(ConnectionError('connection closed'))
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, protocol.ProtocolError) as e:
+            self.fail(ConnectionError('connection lost: {}'.format(e)))
+
+    def fail(self, exc):
+        self.closed = True
+        self.writer.close()
+        while self.waiting:
+            _, future = self.waiting.popleft()
+            if not future.done():
+                future.set_exception(exc)
+
+    async def close(self):
+        self.reader_task.cancel()
+        try:
+            await self.reader_task
+        except asyncio.CancelledError:
+            pass
+        self.fail(ConnectionError('connection closed'))
+
+
+async def read_values(line, reader):
+    values = {}
+    while line != b'END\r\n':
+        key, flags, size = protocol.parse_value(line)
+        values[key] = (await reader.readexactly(size + 2))[:-2]
+        line = await reader.readuntil(protocol.SEP)
+    return values
+
+async def read_stored(line, reader):
+    return protocol.parse_stored(line)
+
+async def read_deleted(line, reader):
+    return protocol.parse_deleted(line)
+
+
+class Pool(object):
+    # up to `size` connections to one server. each request goes to the
+    # connection with the fewest requests in flight, and new connections are
+    # only opened while every open one is busy
+    def __init__(self, host, port, size=POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connections = []
+        self.lock = asyncio.Lock()
+
+    def least_busy(self):
+        self.connections = [conn for conn in self.connections if not conn.closed]
+        conn = min(self.connections, key=lambda conn: conn.in_flight, default=None)
+        if conn is not None and (conn.in_flight == 0 or len(self.connections) >= self.size):
+            return conn
+
+    async def connection(self):
+        conn = self.least_busy()
+        if conn is not None:
+            return conn
+        async with self.lock:
+            # another request may have opened one while we waited
+            conn = self.least_busy()
+            if conn is None:
+                conn = await Connection.open(self.host, self.port)
+                self.connections.append(conn)
+            return conn
+
+    async def request(self, data, parse):
+        conn = await self.connection()
+        return await conn.request(data, parse)
+
+    async def close(self):
+        connections, self.connections = self.connections, []
+        await asyncio.gather(*(conn.close() for conn in connections))
+
+
+class AsyncClient(object):
+    def __init__(self, servers, pool_size=POOL_SIZE, timeout=None):
+        if isinstance(servers, tuple):
+            servers = [servers]
+        servers = [tuple(server) for server in servers]
+        self.ring = HashRing(servers)
+        self.pools = {server: Pool(server[0], server[1], pool_size) for server in servers}
+        self.timeout = timeout
+
+    async def request(self, server, data, parse):
+        coro = self.pools[server].request(data, parse)
+        if self.timeout:
+            return await asyncio.wait_for(coro, self.timeout)
+        return await coro
+
+    async def get(self, key):
+        key = protocol.check_key(key)
+        values = await self.request(self.ring.get(key), protocol.get_request([key]), read_values)
+        return values.get(key)
+
+    async def get_many(self, keys):
+        # one multi-get per server, all in flight at once
+        keys = [protocol.check_key(key) for key in keys]
+        groups = self.ring.group(keys)
+        results = await asyncio.gather(*(
+            self.request(server, protocol.get_request(group), read_values)
+            for server, group in groups.items()))
+        values = {}
+        for result in results:
+            values.update(result)
+        return values
+
+    async def set(self, key, value, flags=0, exptime=0):
+        key = protocol.check_key(key)
+        value = protocol.check_value(value)
+        return await self.request(
+            self.ring.get(key), protocol.set_request(key, value, flags, exptime), read_stored)
+
+    async def set_many(self, items, flags=0, exptime=0):
+        # every set is written before any reply is read, so a batch costs
+        # about one round trip per server
+        items = dict(items)
+        results = await asyncio.gather(*(
+            self.set(key, value, flags, exptime) for key, value in items.items()))
+        return dict(zip(items, results))
+
+    async def delete(self, key):
+        key = protocol.check_key(key)
+        return await self.request(self.ring.get(key), protocol.delete_request(key), read_deleted)
+
+    async def delete_many(self, keys):
+        keys = list(keys)
+        results = await asyncio.gather(*(self.delete(key) for key in keys))
+        return dict(zip(keys, results))
+
+    async def close(self):
+        await asyncio.gather(*(pool.close() for pool in self.pools.values()))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
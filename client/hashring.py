@@ -0,0 +1,45 @@
+import bisect
+import hashlib
+import struct
+
+
+POINTS_PER_SERVER = 160
+
+
+class HashRing(object):
+    # ketama consistent hashing, as in libketama and most memcached
+    # clients: every server gets POINTS_PER_SERVER points on a 32 bit
+    # circle (four per md5 of "host:port-i"), and a key belongs to the first
+    # point at or after the hash of the key. adding or removing a server
+    # only moves the keys on the arcs it gains or loses
+    def __init__(self, servers, weights=None):
+        self.servers = list(servers)
+        weights = weights or {}
+        total = sum(weights.get(server, 1) for server in self.servers)
+        points = []
+        for server in self.servers:
+            share = weights.get(server, 1) / total
+            name = '%s:%d' % server
+            for i in range(int(POINTS_PER_SERVER / 4 * len(self.servers) * share)):
+                digest = hashlib.md5(('%s-%d' % (name, i)).encode()).digest()
+                for point in struct.unpack('<4I', digest):
+                    points.append((point, server))
+        points.sort()
+        self.points = [point for point, _ in points]
+        self.owners = [server for _, server in points]
+
+    @staticmethod
+    def hash(key):
+        return struct.unpack_from('<I', hashlib.md5(key).digest())[0]
+
+    def get(self, key):
+        if len(self.servers) == 1:
+            return self.servers[0]
+        i = bisect.bisect_left(self.points, self.hash(key))
+        return self.owners[i if i < len(self.owners) else 0]
+
+    def group(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.get(key), []).append(key)
+        return groups
@@ -0,0 +1,67 @@
+SEP = b'\r\n'
+
+
+class ClientError(Exception):
+    pass
+
+class ServerError(Exception):
+    pass
+
+class ProtocolError(Exception):
+    # a reply that doesn't fit the request. the connection can't be used
+    # after this
+    pass
+
+
+def check_key(key):
+    if isinstance(key, str):
+        key = key.encode()
+    if not key or len(key) > 250 or any(c <= 32 or c == 127 for c in key):
+        raise ClientError('invalid key: {!r}'.format(key))
+    return key
+
+def check_value(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return value
+
+def get_request(keys):
+    return b'get %s\r\n' % b' '.join(keys)
+
+def set_request(key, value, flags=0, exptime=0):
+    return b'set %s %d %d %d\r\n%s\r\n' % (key, flags, exptime, len(value), value)
+
+def delete_request(key):
+    return b'delete %s\r\n' % key
+
+def check_error(line):
+    if line == b'ERROR\r\n':
+        raise ClientError('unknown command')
+    if line.startswith(b'CLIENT_ERROR '):
+        raise ClientError(line[13:].strip().decode(errors='replace'))
+    if line.startswith(b'SERVER_ERROR '):
+        raise ServerError(line[13:].strip().decode(errors='replace'))
+
+def parse_value(line):
+    # VALUE <key> <flags> <bytes>
+    check_error(line)
+    if not line.startswith(b'VALUE '):
+        raise ProtocolError('unexpected reply: {!r}'.format(line))
+    _, key, flags, size = line.split()[:4]
+    return key, int(flags), int(size)
+
+def parse_stored(line):
+    if line == b'STORED\r\n':
+        return True
+    if line == b'NOT_STORED\r\n':
+        return False
+    check_error(line)
+    raise ProtocolError('unexpected reply: {!r}'.format(line))
+
+def parse_deleted(line):
+    if line == b'DELETED\r\n':
+        return True
+    if line == b'NOT_FOUND\r\n':
+        return False
+    check_error(line)
+    raise ProtocolError('unexpected reply: {!r}'.format(line))
@@ -0,0 +1,190 @@
+import queue
+import socket
+import threading
+
+from client import protocol
+from client.hashring import HashRing
+
+
+POOL_SIZE = 4
+TIMEOUT = 5.0
+
+
+class Connection(object):
+    def __init__(self, host, port, timeout=TIMEOUT):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile('rb')
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        line = self.file.readline()
+        if not line.endswith(protocol.SEP):
+            raise ConnectionError('connection closed')
+        return line
+
+    def read_values(self):
+        values = {}
+        while True:
+            line = self.readline()
+            if line == b'END\r\n':
+                return values
+            key, flags, size = protocol.parse_value(line)
+            data = self.file.read(size + 2)
+            if len(data) != size + 2:
+                raise ConnectionError('connection closed')
+            values[key] = data[:-2]
+
+    def read_stored(self):
+        return protocol.parse_stored(self.readline())
+
+    def read_deleted(self):
+        return protocol.parse_deleted(self.readline())
+
+    def read_replies(self, read, count):
+        # every reply is read even if one is an error, so the connection
+        # stays in step with the server
+        replies, error = [], None
+        for _ in range(count):
+            try:
+                replies.append(read())
+            except (protocol.ClientError, protocol.ServerError) as e:
+                replies.append(None)
+                error = error or e
+        if error:
+            raise error
+        return replies
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class Pool(object):
+    # up to `size` connections to one server, each used by one thread at a
+    # time. threads wait for a connection once all of them are out
+    def __init__(self, host, port, size=POOL_SIZE, timeout=TIMEOUT):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.opened = 0
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            room = self.opened < self.size
+            if room:
+                self.opened += 1
+        if not room:
+            try:
+                return self.idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise ConnectionError('no connection to {}:{} available'.format(self.host, self.port))
+        try:
+            return Connection(self.host, self.port, self.timeout)
+        except Exception:
+            self.discard(None)
+            raise
+
+    def release(self, conn):
+        self.idle.put(conn)
+
+    def discard(self, conn):
+        if conn is not None:
+            conn.close()
+        with self.lock:
+            self.opened -= 1
+
+    def run(self, fn):
+        conn = self.acquire()
+        try:
+            result = fn(conn)
+        except (protocol.ClientError, protocol.ServerError):
+            # an error reply leaves the connection usable
+            self.release(conn)
+            raise
+        except BaseException:
+            # anything else may have left a reply half read
+            self.discard(conn)
+            raise
+        self.release(conn)
+        return result
+
+    def close(self):
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+class Client(object):
+    def __init__(self, servers, pool_size=POOL_SIZE, timeout=TIMEOUT):
+        if isinstance(servers, tuple):
+            servers = [servers]
+        servers = [tuple(server) for server in servers]
+        self.ring = HashRing(servers)
+        self.pools = {server: Pool(server[0], server[1], pool_size, timeout) for server in servers}
+
+    def get(self, key):
+        key = protocol.check_key(key)
+        def request(conn):
+            conn.send(protocol.get_request([key]))
+            return conn.read_values()
+        return self.pools[self.ring.get(key)].run(request).get(key)
+
+    def get_many(self, keys):
+        keys = [protocol.check_key(key) for key in keys]
+        values = {}
+        for server, group in self.ring.group(keys).items():
+            def request(conn):
+                conn.send(protocol.get_request(group))
+                return conn.read_values()
+            values.update(self.pools[server].run(request))
+        return values
+
+    def set(self, key, value, flags=0, exptime=0):
+        return self.set_many({key: value}, flags, exptime)[protocol.check_key(key)]
+
+    def set_many(self, items, flags=0, exptime=0):
+        # all the sets for a server go out in one write before the replies
+        # are read
+        items = {protocol.check_key(key): protocol.check_value(value) for key, value in dict(items).items()}
+        results = {}
+        for server, group in self.ring.group(items).items():
+            def request(conn):
+                conn.send(b''.join(protocol.set_request(key, items[key], flags, exptime) for key in group))
+                return conn.read_replies(conn.read_stored, len(group))
+            results.update(zip(group, self.pools[server].run(request)))
+        return results
+
+    def delete(self, key):
+        return self.delete_many([key])[protocol.check_key(key)]
+
+    def delete_many(self, keys):
+        keys = [protocol.check_key(key) for key in keys]
+        results = {}
+        for server, group in self.ring.group(keys).items():
+            def request(conn):
+                conn.send(b''.join(protocol.delete_request(key) for key in group))
+                return conn.read_replies(conn.read_deleted, len(group))
+            results.update(zip(group, self.pools[server].run(request)))
+        return results
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -11,8 +11,15 @@ logger = structlog.get_logger(__name__)
 
 
 class DumpCommand(Command):
+    def __init__(self, keys=None):
+        # only these keys, when dumping a large store a slice at a time
+        self.keys = keys
+
     def visit(self, store):
-        logger.debug(str(store.data))
+        if self.keys is None:
+            logger.debug(str(store.data))
+        else:
+            logger.debug(str({key: store.data[key] for key in self.keys if key in store.data}))
 
 class DumpCommitCommand(Command):
     def visit(self, store):
@@ -24,25 +31,40 @@ class DumpLogCommand(Command):
 
 class SetCommand(Command):
     opcode = 1
+    encoding = 0
     def __init__(self, key, flags, exptime, data):
         self.key = key
         self.flags = int(flags)
         self.exptime = int(exptime)
         self.data = data
 
+    @staticmethod
+    def create(key, flags, exptime, data, encoding=0):
+        if encoding:
+            return EncodedSetCommand(key, flags, exptime, data, encoding)
+        return SetCommand(key, flags, exptime, data)
+
     def visit(self, store):
-        logger.debug('SET %s %d %d %s', self.key, self.flags, self.exptime, self.data)
-        store[self.key] = StorageItem(self.flags, self.exptime, self.data)
+        # the size rather than the data, which may be many megabytes
+        logger.debug('SET %s %d %d (%d bytes)', self.key, self.flags, self.exptime, len(self.data))
+        store[self.key] = StorageItem(self.flags, self.exptime, self.data, self.encoding)
 
     def pack(self):
-        return struct.pack(
-            '=I%dsHII%ds' % (len(self.key), len(self.data)),
-            len(self.key),
-            self.key,
-            self.flags,
-            self.exptime,
-            len(self.data),
-            self.data)
+        return b''.join(self.pack_parts())
+
+    def pack_parts(self):
+        # the data goes in the record as is, rather than being copied into
+        # one buffer with the header
+        return (
+            struct.pack(
+                '=I%dsHII' % len(self.key),
+                len(self.key),
+                self.key,
+                self.flags,
+                self.exptime,
+                len(self.data)),
+            self.data,
+        )
 
     @classmethod
     def unpack(cls, f):
@@ -54,13 +76,32 @@ class SetCommand(Command):
     def __str__(self):
         return 'SET %s' % self.key
 
+class EncodedSetCommand(SetCommand):
+    # a set whose data is stored compressed. the encoding goes after the
+    # regular set record so opcode 1 records stay readable
+    opcode = 3
+    def __init__(self, key, flags, exptime, data, encoding):
+        super().__init__(key, flags, exptime, data)
+        self.encoding = int(encoding)
+
+    def pack_parts(self):
+        return super().pack_parts() + (struct.pack('=B', self.encoding),)
+
+    @classmethod
+    def unpack(cls, f):
+        key = unpack_vls(f)
+        flags, exptime = unpack(f, '=HI')
+        data = unpack_vls(f)
+        encoding, = unpack(f, '=B')
+        return cls(key, flags, exptime, data, encoding)
+
 class GetCommand(Command):
     def __init__(self, key):
         self.key = key
 
     def visit(self, store):
         data = store[self.key]
-        logger.debug('GET %s -> %s', self.key, data)
+        logger.debug('GET %s -> %d bytes', self.key, len(data.data))
         return data
 
     def __str__(self):
@@ -68,6 +109,7 @@ class GetCommand(Command):
 
 class DeleteCommand(Command):
     opcode = 2
+    tombstone = True
     def __init__(self, key):
         self.key = key
 
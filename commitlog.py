@@ -0,0 +1,93 @@
+import os
+import struct
+import uuid
+
+import structlog
+
+from base import Command
+from utils import unpack
+
+
+logger = structlog.get_logger(__name__)
+
+
+# every record is the commit id, the command's opcode and then the packed
+# command, which always starts with the length prefixed key
+HEADER_SIZE = 16 + struct.calcsize('=H')
+
+
+def command_classes(cls=Command):
+    for command in cls.__subclasses__():
+        yield command
+        yield from command_classes(command)
+
+def command_class(opcode):
+    for command in command_classes():
+        if opcode == command.opcode:
+            return command
+
+def read_commit(f):
+    commit_id = f.read(16)
+    if not commit_id:
+        return None
+    commit_id = uuid.UUID(bytes=commit_id)
+    op = unpack(f, '=H')[0]
+    command = command_class(op)
+    if command:
+        return commit_id, command.unpack(f)
+    return commit_id, None
+
+def read_commits(f, offset=0):
+    f.seek(offset)
+    while True:
+        start = f.tell()
+        record = read_commit(f)
+        if record is None:
+            break
+        commit_id, command = record
+        if command:
+            yield commit_id, command, start, f.tell() - start
+
+def read_commits_after(f, commit_id):
+    # the commits made after commit_id: those that follow it in the log,
+    # or if compaction has since dropped it, those with a later timestamp
+    offset = None
+    for found, _, start, size in read_commits(f):
+        if found == commit_id:
+            offset = start + size
+    if offset is not None:
+        yield from read_commits(f, offset)
+        return
+    for record in read_commits(f):
+        if record[0].time > commit_id.time:
+            yield record
+
+def read_commit_at(f, offset):
+    f.seek(offset)
+    return read_commit(f)
+
+def record_key(data):
+    size = struct.unpack_from('=I', data)[0]
+    return data[4:4 + size]
+
+def record_parts(data):
+    # a packed command, or the buffers from Command.pack_parts()
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return (data,)
+    return data
+
+def write_commit(f, commit_id, opcode, data, fsync=True):
+    data = record_parts(data)
+    f.seek(0, os.SEEK_END)
+    offset = f.tell()
+    f.write(commit_id.bytes)
+    f.write(struct.pack('=H', opcode))
+    for part in data:
+        f.write(part)
+    f.flush()
+    if fsync:
+        try:
+            os.fsync(f.fileno())
+        except IOError as e:
+            logger.exception('error syncing commit file')
+    return offset, HEADER_SIZE + sum(len(part) for part in data)
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+from prometheus_client import (
+    Counter,
+    Gauge,
+    Histogram,
+)
+import structlog
+
+
+logger = structlog.get_logger(__name__)
+
+
+NUM_COMPACTIONS = Counter('storage_num_compactions', 'number of compactions')
+COMPACTION_DURATION = Histogram('storage_compaction_seconds', 'Duration of compactions')
+COMPACTION_ERRORS = Counter('storage_compaction_errors', 'Number of errors during compaction')
+COMPACTION_ABORTS = Counter('storage_compaction_aborts', 'Number of compactions abandoned because the log changed underneath them')
+COMPACTION_PROGRESS = Gauge('storage_compaction_progress', 'Fraction of the current compaction that is done')
+COMPACTION_BYTES = Counter('storage_compaction_bytes', 'Bytes read and written by compaction')
+COMPACTION_RECLAIMED = Counter('storage_compaction_reclaimed_bytes', 'Bytes reclaimed by compaction')
+
+
+RATE = 4 * 1024 * 1024
+CHUNK = 64 * 1024
+
+
+class RateLimiter(object):
+    # token bucket over bytes of I/O. compaction calls throttle() after each
+    # chunk it reads or writes and sleeps whenever it gets ahead of the
+    # budget, which also hands the loop back to foreground requests
+    def __init__(self, rate=RATE, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst or max(rate or 0, CHUNK)
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+
+    async def throttle(self, nbytes):
+        COMPACTION_BYTES.inc(nbytes)
+        if not self.rate:
+            await asyncio.sleep(0)
+            return
+
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= nbytes
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+        else:
+            await asyncio.sleep(0)
+
+
+class Compaction(object):
+    # bookkeeping for a single run: duration, progress and reclaimed bytes
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+
+    def __enter__(self):
+        NUM_COMPACTIONS.inc()
+        COMPACTION_PROGRESS.set(0)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        COMPACTION_DURATION.observe(time.perf_counter() - self.start)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            COMPACTION_ERRORS.inc()
+        COMPACTION_PROGRESS.set(0)
+
+    def advance(self, nbytes):
+        self.done += nbytes
+        if self.total:
+            COMPACTION_PROGRESS.set(min(1.0, self.done / self.total))
+
+    def abort(self, reason):
+        logger.info('compaction abandoned: %s', reason)
+        COMPACTION_ABORTS.inc()
+
+    def reclaimed(self, before, after):
+        reclaimed = max(0, before - after)
+        COMPACTION_RECLAIMED.inc(reclaimed)
+        logger.info('compaction reclaimed %d of %d bytes', reclaimed, before)
+        return reclaimed
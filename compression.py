@@ -0,0 +1,103 @@
+import time
+import zlib
+
+from prometheus_client import (
+    Counter,
+    Histogram,
+)
+import structlog
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+logger = structlog.get_logger(__name__)
+
+
+# values for StorageItem.encoding. these are persisted in the commit log
+# and the database, so never renumber them
+NONE = 0
+ZLIB = 1
+LZ4 = 2
+
+THRESHOLD = 1024
+LEVEL = 6
+# don't bother keeping compressed values that save less than this
+MIN_RATIO = 0.9
+
+
+COMPRESSED_ITEMS = Counter('storage_compressed_items', 'Number of values stored compressed')
+COMPRESSION_IN_BYTES = Counter('storage_compression_in_bytes', 'Bytes given to the compressor')
+COMPRESSION_OUT_BYTES = Counter('storage_compression_out_bytes', 'Bytes produced by the compressor')
+COMPRESSION_RATIO = Histogram('storage_compression_ratio', 'Compressed size over original size',
+                              buckets=(.1, .2, .3, .4, .5, .6, .7, .8, .9, 1.0))
+COMPRESSION_DURATION = Histogram('storage_compression_seconds', 'CPU time spent compressing values')
+DECOMPRESSION_DURATION = Histogram('storage_decompression_seconds', 'CPU time spent decompressing values')
+
+
+def _zlib(level):
+    return (lambda data: zlib.compress(data, level)), zlib.decompress
+
+def _lz4(level):
+    return lz4.frame.compress, lz4.frame.decompress
+
+CODECS = {
+    'zlib': (ZLIB, _zlib),
+    'lz4': (LZ4, _lz4),
+}
+
+
+def available(codec):
+    return codec == 'zlib' or (codec == 'lz4' and lz4 is not None)
+
+
+class Compressor(object):
+    # compresses values at or above `threshold` bytes with `codec`. a
+    # threshold of None turns compression off, but values that were stored
+    # compressed can always be read back
+    def __init__(self, codec='zlib', threshold=None, level=LEVEL, min_ratio=MIN_RATIO):
+        if codec not in CODECS:
+            raise ValueError('unknown codec: {}'.format(codec))
+        if not available(codec):
+            logger.warn('%s is not installed, compressing with zlib', codec)
+            codec = 'zlib'
+        self.codec = codec
+        self.threshold = threshold
+        self.min_ratio = min_ratio
+        self.encoding, factory = CODECS[codec]
+        self.compressor, _ = factory(level)
+        self.decompressors = {NONE: None}
+        for name, (encoding, factory) in CODECS.items():
+            if available(name):
+                self.decompressors[encoding] = factory(level)[1]
+
+    def compress(self, data):
+        if self.threshold is None or len(data) < self.threshold:
+            return NONE, data
+
+        start = time.process_time()
+        compressed = self.compressor(data)
+        COMPRESSION_DURATION.observe(time.process_time() - start)
+
+        ratio = len(compressed) / len(data)
+        COMPRESSION_RATIO.observe(ratio)
+        if ratio > self.min_ratio:
+            return NONE, data
+
+        COMPRESSED_ITEMS.inc()
+        COMPRESSION_IN_BYTES.inc(len(data))
+        COMPRESSION_OUT_BYTES.inc(len(compressed))
+        return self.encoding, compressed
+
+    def decompress(self, item):
+        if not item.encoding:
+            return item.data
+        decompressor = self.decompressors.get(item.encoding)
+        if decompressor is None:
+            raise ValueError('no decompressor for encoding {}'.format(item.encoding))
+        start = time.process_time()
+        data = decompressor(item.data)
+        DECOMPRESSION_DURATION.observe(time.process_time() - start)
+        return data
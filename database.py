@@ -0,0 +1,108 @@
+import sqlite3
+
+import structlog
+
+
+logger = structlog.get_logger(__name__)
+
+
+JOURNAL_MODE = 'wal'
+# the commit log is truncated as soon as a flush commits, so the flush has
+# to be on disk by then. see SQLiteBackend.sync_wal for normal
+SYNCHRONOUS = 'full'
+CACHE_SIZE = -16000       # negative values are KiB, so ~16MB of page cache
+MMAP_SIZE = 0
+CACHED_STATEMENTS = 128
+BATCH_SIZE = 5000
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra')
+
+
+TABLE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    key TEXT PRIMARY KEY,
+    flags INTEGER,
+    exptime INTEGER,
+    data BLOB,
+    encoding INTEGER NOT NULL DEFAULT 0
+){};'''
+
+STATUS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS status (
+    id INTEGER PRIMARY KEY,
+    commit_id BLOB
+);'''
+
+if sqlite3.sqlite_version_info >= (3, 24, 0):
+    # update the row in place instead of the delete + insert that
+    # INSERT OR REPLACE does
+    UPSERT = '''
+INSERT INTO items (key, flags, exptime, data, encoding) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(key) DO UPDATE SET
+    flags = excluded.flags,
+    exptime = excluded.exptime,
+    data = excluded.data,
+    encoding = excluded.encoding'''
+else:
+    UPSERT = 'INSERT OR REPLACE INTO items (key, flags, exptime, data, encoding) VALUES (?, ?, ?, ?, ?)'
+
+SELECT = 'SELECT key, flags, exptime, data, encoding FROM items'
+
+SELECT_ONE = 'SELECT flags, exptime, data, encoding FROM items WHERE key = ?'
+
+SELECT_KEYS = 'SELECT key FROM items'
+
+COUNT = 'SELECT COUNT(*) FROM items'
+
+DELETE = 'DELETE FROM items WHERE key = ?'
+
+
+def _mode(value, choices, name):
+    # yaml turns a bare `off` into False, which is a mode for both
+    # settings, and a bare `on` or `yes` into True, which isn't for either
+    if value is True:
+        raise ValueError('invalid {}: true (quote the mode in the config file, '
+                         'one of {})'.format(name, ', '.join(choices)))
+    if value is False:
+        value = 'off'
+    value = str(value).lower()
+    if value not in choices:
+        raise ValueError('invalid {}: {}'.format(name, value))
+    return value
+
+def connect(path,
+            journal_mode=JOURNAL_MODE,
+            synchronous=SYNCHRONOUS,
+            cache_size=CACHE_SIZE,
+            mmap_size=MMAP_SIZE,
+            cached_statements=CACHED_STATEMENTS):
+    conn = sqlite3.connect(path, cached_statements=cached_statements)
+    journal_mode = _mode(journal_mode, JOURNAL_MODES, 'journal_mode')
+    synchronous = _mode(synchronous, SYNCHRONOUS_MODES, 'synchronous')
+
+    mode = conn.execute('PRAGMA journal_mode = %s' % journal_mode).fetchone()[0]
+    if mode != journal_mode:
+        logger.warn('journal_mode %s not supported for %s, using %s', journal_mode, path, mode)
+    conn.execute('PRAGMA synchronous = %s' % synchronous)
+    conn.execute('PRAGMA cache_size = %d' % int(cache_size))
+    conn.execute('PRAGMA mmap_size = %d' % int(mmap_size))
+    logger.info('sqlite journal_mode=%s synchronous=%s cache_size=%s mmap_size=%s',
+                mode, synchronous, cache_size, mmap_size)
+    return conn
+
+def create_schema(c, without_rowid=False):
+    c.execute(TABLE_SCHEMA.format(' WITHOUT ROWID' if without_rowid else ''))
+    c.execute(STATUS_SCHEMA)
+
+    # databases created before values could be compressed
+    columns = [row[1] for row in c.execute('PRAGMA table_info(items)')]
+    if 'encoding' not in columns:
+        logger.info('adding encoding column to items')
+        c.execute('ALTER TABLE items ADD COLUMN encoding INTEGER NOT NULL DEFAULT 0')
+
+def chunks(values, size):
+    values = list(values)
+    size = size or len(values) or 1
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
@@ -0,0 +1,89 @@
+import time
+
+from prometheus_client import Counter, Gauge
+import structlog
+
+
+logger = structlog.get_logger(__name__)
+
+
+FLUSH_TRIGGERS = Counter('storage_flush_triggers', 'Flushes started, by what started them', ['reason'])
+DIRTY_KEYS = Gauge('storage_dirty_keys', 'Keys changed since the last flush')
+DIRTY_BYTES = Gauge('storage_dirty_bytes', 'Bytes committed since the last flush')
+DIRTY_LIMIT = Gauge('storage_flush_dirty_limit', 'Changed keys that start a flush, adapted to flush throughput')
+FLUSH_THROUGHPUT = Gauge('storage_flush_keys_per_second', 'Recent flush throughput')
+
+
+# seconds between checks
+CHECK_INTERVAL = 0.5
+# upper bounds on what's left for the next flush. the dirty key limit
+# shrinks below MAX_DIRTY_KEYS when flushes are too slow to write that many
+# in TARGET_PAUSE, but never below MIN_DIRTY_KEYS
+MAX_DIRTY_KEYS = 100000
+MIN_DIRTY_KEYS = 1000
+MAX_DIRTY_BYTES = 64 * 1024 * 1024
+MAX_LOG_BYTES = 256 * 1024 * 1024
+TARGET_PAUSE = 0.05
+# weight of the latest flush in the throughput estimate
+SMOOTHING = 0.3
+
+
+class FlushPolicy(object):
+    # decides when Store.flush_loop flushes. a flush writes everything
+    # pending in one go, so the way to keep it short is to start it before
+    # too much has built up: after `interval` seconds, or as soon as the
+    # dirty keys, dirty bytes or commit log pass their limits. the dirty key
+    # limit follows measured throughput, so it's however many keys a flush
+    # can write in `target_pause`
+    def __init__(self, interval=10, max_dirty_keys=MAX_DIRTY_KEYS, min_dirty_keys=MIN_DIRTY_KEYS,
+                 max_dirty_bytes=MAX_DIRTY_BYTES, max_log_bytes=MAX_LOG_BYTES, target_pause=TARGET_PAUSE,
+                 check_interval=CHECK_INTERVAL, clock=time.monotonic):
+        self.interval = interval
+        self.max_dirty_keys = max_dirty_keys
+        self.min_dirty_keys = min(min_dirty_keys, max_dirty_keys)
+        self.max_dirty_bytes = max_dirty_bytes
+        self.max_log_bytes = max_log_bytes
+        self.target_pause = target_pause
+        self.check_interval = min(check_interval, interval)
+        self.clock = clock
+        self.last_flush = clock()
+        # keys/sec, None until the first flush
+        self.throughput = None
+        self.dirty_limit = max_dirty_keys
+        DIRTY_LIMIT.set(self.dirty_limit)
+
+    def reason(self, store):
+        # why the store should be flushed now, or None
+        if not store.dirty:
+            return None
+        dirty_keys = store.dirty_keys
+        DIRTY_KEYS.set(dirty_keys)
+        DIRTY_BYTES.set(store.dirty_bytes)
+        if dirty_keys >= self.dirty_limit:
+            return 'dirty_keys'
+        if self.max_dirty_bytes and store.dirty_bytes >= self.max_dirty_bytes:
+            return 'dirty_bytes'
+        # a log backend's data file only shrinks when it's rotated, at
+        # max_file_size, so flushing it early would just repeat
+        if (self.max_log_bytes and store.backend.flush_empties_log
+                and store.commit_log_size >= self.max_log_bytes):
+            return 'commit_log'
+        if self.clock() - self.last_flush >= self.interval:
+            return 'interval'
+        return None
+
+    def flushed(self, reason, keys, seconds):
+        FLUSH_TRIGGERS.labels(reason).inc()
+        self.last_flush = self.clock()
+        if keys and seconds > 0:
+            rate = keys / seconds
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput += SMOOTHING * (rate - self.throughput)
+            FLUSH_THROUGHPUT.set(self.throughput)
+            self.dirty_limit = int(max(self.min_dirty_keys,
+                                       min(self.max_dirty_keys, self.throughput * self.target_pause)))
+            DIRTY_LIMIT.set(self.dirty_limit)
+        logger.info('flushed {} keys in {:.3f}s ({}), next at {} keys'.format(
+            keys, seconds, reason, self.dirty_limit))
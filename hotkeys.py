@@ -0,0 +1,173 @@
+import heapq
+import time
+
+from prometheus_client.core import GaugeMetricFamily
+
+
+CAPACITY = 1000
+SAMPLE_RATE = 0.01
+EXPORT = 10
+HALF_LIFE = 300
+
+
+class SpaceSaving(object):
+    # Metwally et al's Space-Saving: at most `capacity` counters. a key
+    # that isn't tracked takes over the smallest counter and inherits its
+    # count as the error bound, so any key with more than total/capacity
+    # hits is guaranteed to be present and counts are never underestimated
+    # by more than `error`
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # (count, key) entries, some stale. an entry is current when its
+        # count matches self.counts[key]
+        self.heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, weight=1):
+        if key in self.counts:
+            self.counts[key] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = weight
+            self.errors[key] = 0
+        else:
+            count, _ = self.pop_min()
+            self.counts[key] = count + weight
+            self.errors[key] = count
+        heapq.heappush(self.heap, (self.counts[key], key))
+        if len(self.heap) > 4 * self.capacity:
+            self.rebuild()
+
+    def pop_min(self):
+        while True:
+            count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                del self.counts[key]
+                del self.errors[key]
+                return count, key
+
+    def rebuild(self):
+        self.heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def decay(self, factor=0.5):
+        for key in self.counts:
+            self.counts[key] *= factor
+            self.errors[key] *= factor
+        self.rebuild()
+
+    def top(self, n):
+        return heapq.nlargest(n, ((count, self.errors[key], key) for key, count in self.counts.items()))
+
+
+class LargestValues(object):
+    # the `capacity` biggest values by size. sizes are kept current for
+    # tracked keys, so a key that shrinks or is deleted drops out
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.sizes = {}
+        # lower bound on the smallest tracked size, so most values that
+        # can't make the list are rejected without a scan
+        self.smallest = 0
+
+    def update(self, key, size):
+        if key in self.sizes or len(self.sizes) < self.capacity:
+            self.sizes[key] = size
+            self.smallest = min(self.smallest, size)
+            return
+        if size <= self.smallest:
+            return
+        victim = min(self.sizes, key=self.sizes.get)
+        if self.sizes[victim] < size:
+            del self.sizes[victim]
+            self.sizes[key] = size
+            victim = min(self.sizes, key=self.sizes.get)
+        self.smallest = self.sizes[victim]
+
+    def remove(self, key):
+        self.sizes.pop(key, None)
+
+    def top(self, n):
+        return heapq.nlargest(n, ((size, key) for key, size in self.sizes.items()))
+
+
+class HotKeys(object):
+    # heavy hitters per command. only one in every 1/sample_rate requests
+    # is counted (with a weight of 1/sample_rate) so the cost on the request
+    # path is usually a single decrement. value sizes aren't sampled. counts halve every half_life
+    # seconds so the ranking follows the current traffic
+    def __init__(self, capacity=CAPACITY, sample_rate=SAMPLE_RATE, half_life=HALF_LIFE, clock=time.monotonic):
+        self.capacity = capacity
+        self.period = max(1, int(round(1 / sample_rate))) if sample_rate else 0
+        self.half_life = half_life
+        self.clock = clock
+        self.countdown = self.period
+        self.counters = {}
+        self.largest = LargestValues(capacity)
+        self.next_decay = clock() + half_life if half_life else None
+
+    def record(self, command, key, size=None):
+        if not self.period:
+            return
+        # big values are usually written once, so sampling would miss
+        # them. checking every one is a comparison against the smallest
+        # tracked size
+        if size is not None:
+            self.largest.update(key, size)
+        self.countdown -= 1
+        if self.countdown:
+            return
+        self.countdown = self.period
+
+        counter = self.counters.get(command)
+        if counter is None:
+            counter = self.counters[command] = SpaceSaving(self.capacity)
+        counter.add(key, self.period)
+
+        if self.next_decay is not None and self.clock() >= self.next_decay:
+            self.next_decay = self.clock() + self.half_life
+            for counter in self.counters.values():
+                counter.decay()
+
+    def removed(self, key):
+        self.largest.remove(key)
+
+    def top(self, n=EXPORT):
+        return {
+            'commands': {
+                command: [
+                    {'key': key.decode(errors='replace'), 'count': count, 'error': error}
+                    for count, error, key in counter.top(n)
+                ]
+                for command, counter in self.counters.items()
+            },
+            'largest': [
+                {'key': key.decode(errors='replace'), 'bytes': size}
+                for size, key in self.largest.top(n)
+            ],
+        }
+
+
+class HotKeysCollector(object):
+    # publishes the current top keys at scrape time, so label cardinality is
+    # bounded by `export` per command
+    def __init__(self, hotkeys, export=EXPORT):
+        self.hotkeys = hotkeys
+        self.export = export
+
+    def collect(self):
+        requests = GaugeMetricFamily(
+            'hot_key_requests', 'Estimated requests for the hottest keys', labels=['command', 'key'])
+        sizes = GaugeMetricFamily(
+            'largest_value_bytes', 'Size of the largest values', labels=['key'])
+        top = self.hotkeys.top(self.export)
+        for command, keys in top['commands'].items():
+            for entry in keys:
+                requests.add_metric([command, entry['key']], entry['count'])
+        for entry in top['largest']:
+            sizes.add_metric([entry['key']], entry['bytes'])
+        yield requests
+        yield sizes
@@ -0,0 +1,140 @@
+from collections import namedtuple
+import mmap
+import os
+import struct
+import tempfile
+import uuid
+import zlib
+
+
+MAGIC = b'KVIMG\x01'
+# the store's last commit, the last commit flushed to the database, and
+# how many items and pending inserts, updates and deletes follow
+HEADER = struct.Struct('=16s16sQQQQ')
+# key size, flags, exptime, value size, encoding. all the item headers
+# come first, in one table, then all the keys and values, so loading
+# unpacks the table in one go and only slices the rest
+ITEM = struct.Struct('=IIqIB')
+KEY = struct.Struct('=I')
+# crc32 of everything before it
+CHECKSUM = struct.Struct('=I')
+
+# items packed per write of the item table
+TABLE_BATCH = 65536
+BUFFER_SIZE = 1024 * 1024
+
+
+Image = namedtuple('Image', 'commit_id flushed_commit_id items inserts updates deletes')
+
+
+def fields(*args):
+    return args
+
+def uuid_bytes(commit_id):
+    return commit_id.bytes if commit_id else bytes(16)
+
+def bytes_uuid(data):
+    return uuid.UUID(bytes=data) if any(data) else None
+
+
+class Writer(object):
+    # buffers small writes and keeps a running checksum of everything
+    # written
+    def __init__(self, f, buffer_size=BUFFER_SIZE):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.crc = 0
+
+    def write(self, data):
+        if len(data) >= self.buffer_size:
+            self.flush()
+            self.crc = zlib.crc32(data, self.crc)
+            self.f.write(data)
+            return
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.crc = zlib.crc32(self.buffer, self.crc)
+            self.f.write(self.buffer)
+            self.buffer.clear()
+
+
+def write_image(path, commit_id, flushed_commit_id, items, inserts=(), updates=(), deletes=()):
+    # items is a sequence of (key, StorageItem). written to a temporary
+    # file that replaces path once it is complete, so path always holds
+    # a whole image
+    directory = os.path.dirname(path) or '.'
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            out = Writer(f)
+            out.write(MAGIC)
+            out.write(HEADER.pack(uuid_bytes(commit_id), uuid_bytes(flushed_commit_id),
+                                  len(items), len(inserts), len(updates), len(deletes)))
+            for i in range(0, len(items), TABLE_BATCH):
+                out.write(b''.join(
+                    ITEM.pack(len(key), item.flags, item.exptime, len(item.data), item.encoding)
+                    for key, item in items[i:i + TABLE_BATCH]))
+            for key, item in items:
+                out.write(key)
+                out.write(item.data)
+
+            pending = list(inserts) + list(updates) + list(deletes)
+            out.write(b''.join(KEY.pack(len(key)) for key in pending))
+            for key in pending:
+                out.write(key)
+            out.flush()
+            f.write(CHECKSUM.pack(out.crc))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return path
+
+def read_image(path, make_item=fields):
+    # raises ValueError for a file that isn't a whole image. the items are
+    # (key, make_item(flags, exptime, data, encoding)) pairs
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError('empty memory image')
+    with buf:
+        end = len(buf) - CHECKSUM.size
+        if end < len(MAGIC) + HEADER.size or buf[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a memory image')
+        with memoryview(buf) as view:
+            if zlib.crc32(view[:end]) != CHECKSUM.unpack_from(buf, end)[0]:
+                raise ValueError('memory image checksum mismatch')
+
+            offset = len(MAGIC)
+            commit_id, flushed_commit_id, count, inserts, updates, deletes = HEADER.unpack_from(buf, offset)
+            offset += HEADER.size
+            table = offset
+            offset += count * ITEM.size
+            items = []
+            append = items.append
+            for key_size, flags, exptime, data_size, encoding in ITEM.iter_unpack(view[table:offset]):
+                key_end = offset + key_size
+                data_end = key_end + data_size
+                append((buf[offset:key_end], make_item(flags, exptime, buf[key_end:data_end], encoding)))
+                offset = data_end
+
+            table = offset
+            offset += (inserts + updates + deletes) * KEY.size
+            keys = []
+            for key_size, in KEY.iter_unpack(view[table:offset]):
+                keys.append(buf[offset:offset + key_size])
+                offset += key_size
+            if offset != end:
+                raise ValueError('memory image has {} unexpected bytes'.format(end - offset))
+
+    return Image(
+        bytes_uuid(commit_id), bytes_uuid(flushed_commit_id), items,
+        keys[:inserts], keys[inserts:inserts + updates], keys[inserts + updates:])
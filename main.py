@@ -1,7 +1,7 @@
 import asyncio
 import logging
 import logging.config
-import sqlite3
+import resource
 import threading
 import yaml
 
@@ -9,9 +9,31 @@ import click
 import prometheus_client
 import structlog
 
+from backends import LogBackend, SQLiteBackend
+import backends.log as log_backend
+import backends.sqlite as sqlite_backend
+import bloom
+import capture
 import commands
+import compaction
+import compression
+from compression import Compressor
+import database
+import flushpolicy
+from flushpolicy import FlushPolicy
+import hotkeys
+from hotkeys import HotKeys, HotKeysCollector
+import profiler
+from profiler import SamplingProfiler
+import scheduler
+from scheduler import Scheduler
+import server as memcache_server
 from server import MemcacheServer
+import slowlog
+from slowlog import SlowLog
 from store import Store
+import valuecache
+from valuecache import ValueCache
 from web import HttpServer
 
 
@@ -90,6 +112,14 @@ def do_configure_logging(config):
         cache_logger_on_first_use=True,
     )
 
+def raise_open_files_limit(wanted):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        logger.info('raising open files limit from %d to %d', soft, wanted)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
 def click_config_file(default_config_file):
     def parse_config_callback(ctx, param, value):
         try:
@@ -124,22 +154,141 @@ def click_config_file(default_config_file):
 def main(ctx, db, bind, port):
     do_configure_logging(ctx.default_map['logging'])
 
-    logger.info('connecting to %s', db)
-    conn = sqlite3.connect(db)
+    storage = ctx.default_map['storage']
+    compaction_conf = ctx.default_map['compaction']
+    compaction_interval = compaction_conf.get('interval', 60)
+    compaction_rate = compaction_conf.get('rate', compaction.RATE)
+    if storage == 'log':
+        log_conf = ctx.default_map['log_storage']
+        logger.info('opening data files in %s', db)
+        backend = LogBackend(
+            db,
+            max_file_size=log_conf.get('max_file_size', log_backend.MAX_FILE_SIZE),
+            merge_files=log_conf.get('merge_files', log_backend.MERGE_FILES),
+            compaction_rate=compaction_rate)
+    elif storage == 'sqlite':
+        sqlite_conf = ctx.default_map['sqlite']
+        logger.info('connecting to %s', db)
+        conn = database.connect(
+            db,
+            journal_mode=sqlite_conf.get('journal_mode', database.JOURNAL_MODE),
+            synchronous=sqlite_conf.get('synchronous', database.SYNCHRONOUS),
+            cache_size=sqlite_conf.get('cache_size', database.CACHE_SIZE),
+            mmap_size=sqlite_conf.get('mmap_size', database.MMAP_SIZE))
+        commit_log = open(ctx.default_map['commit_log'], 'a+b')
+        backend = SQLiteBackend(
+            conn,
+            commit_log,
+            batch_size=sqlite_conf.get('batch_size', database.BATCH_SIZE),
+            without_rowid=sqlite_conf.get('without_rowid', False),
+            compaction_rate=compaction_rate,
+            compaction_min_size=compaction_conf.get('min_size', sqlite_backend.COMPACTION_MIN_SIZE),
+            lazy=sqlite_conf.get('lazy', False),
+            bloom_error_rate=sqlite_conf.get('bloom_error_rate', bloom.ERROR_RATE))
+    else:
+        raise click.BadParameter('unknown storage: {}'.format(storage))
+
+    compression_conf = ctx.default_map['compression']
+    compressor = Compressor(
+        codec=compression_conf.get('codec', 'zlib'),
+        threshold=compression_conf.get('threshold', None),
+        level=compression_conf.get('level', compression.LEVEL))
+
+    get_cache_conf = ctx.default_map['get_cache']
+    max_items = get_cache_conf.get('max_items', valuecache.MAX_ITEMS)
+    value_cache = ValueCache(
+        max_items=max_items,
+        max_bytes=get_cache_conf.get('max_bytes', valuecache.MAX_BYTES),
+        max_item_size=get_cache_conf.get('max_item_size', valuecache.MAX_ITEM_SIZE)) if max_items else None
 
     logger.info('initializing store')
-    commit_log = open(ctx.default_map['commit_log'], 'a+b')
-    store = Store(conn, commit_log)
-    store.load_db()
-    store.sync_commit_log()
+    store = Store(
+        backend,
+        snapshot_dir=ctx.default_map['snapshot_dir'],
+        compressor=compressor,
+        value_cache=value_cache)
+    image_conf = ctx.default_map['image']
+    image_path = image_conf.get('path')
+    store.load(image_path)
 
     loop = asyncio.get_event_loop()
 
-    server = MemcacheServer(store)
-    web = HttpServer(store)
+    profiler_conf = ctx.default_map['profiler']
+    sampler = SamplingProfiler(
+        interval=profiler_conf.get('interval', profiler.INTERVAL),
+        max_seconds=profiler_conf.get('max_seconds', profiler.MAX_SECONDS))
+    hotkeys_conf = ctx.default_map['hotkeys']
+    tracker = HotKeys(
+        capacity=hotkeys_conf.get('capacity', hotkeys.CAPACITY),
+        sample_rate=hotkeys_conf.get('sample_rate', hotkeys.SAMPLE_RATE),
+        half_life=hotkeys_conf.get('half_life', hotkeys.HALF_LIFE))
+    prometheus_client.REGISTRY.register(
+        HotKeysCollector(tracker, export=hotkeys_conf.get('export', hotkeys.EXPORT)))
+    slowlog_conf = ctx.default_map['slowlog']
+    slow_log = SlowLog(
+        threshold=slowlog_conf.get('threshold', slowlog.THRESHOLD),
+        sample_rate=slowlog_conf.get('sample_rate', slowlog.SAMPLE_RATE),
+        size=slowlog_conf.get('size', slowlog.SIZE))
+    sched_conf = ctx.default_map['scheduler']
+    sched = Scheduler(
+        batch=sched_conf.get('batch', scheduler.BATCH),
+        slice_size=sched_conf.get('slice', scheduler.SLICE),
+        rate=sched_conf.get('client_rate', scheduler.RATE),
+        burst=sched_conf.get('client_burst', scheduler.BURST),
+        quiet=sched_conf.get('quiet', scheduler.QUIET),
+        max_defer=sched_conf.get('max_defer', scheduler.MAX_DEFER))
+    conn_conf = ctx.default_map['connections']
+    capture_conf = ctx.default_map['capture']
+    server = MemcacheServer(
+        store,
+        profiler=sampler,
+        hotkeys=tracker,
+        slow_log=slow_log,
+        scheduler=sched,
+        max_connections=conn_conf.get('max_connections', memcache_server.MAX_CONNECTIONS),
+        write_buffer=conn_conf.get('write_buffer', memcache_server.WRITE_BUFFER),
+        drain_timeout=conn_conf.get('drain_timeout', memcache_server.DRAIN_TIMEOUT),
+        idle_timeout=conn_conf.get('idle_timeout', memcache_server.IDLE_TIMEOUT),
+        max_item_size=conn_conf.get('max_item_size', memcache_server.MAX_ITEM_SIZE),
+        capture_dir=capture_conf.get('dir', memcache_server.CAPTURE_DIR),
+        capture_max_value=capture_conf.get('max_value', capture.MAX_VALUE))
+    # leave room for data files, the database and the web/metrics servers
+    raise_open_files_limit(server.max_connections + 256)
+    web = HttpServer(store, profiler=sampler, hotkeys=tracker, slow_log=slow_log)
+    lag_task = loop.create_task(
+        profiler.monitor_loop_lag(
+            interval=profiler_conf.get('lag_interval', profiler.LAG_INTERVAL),
+            callback=slow_log.record_loop_lag)
+    )
+    flush_conf = ctx.default_map['flush']
+    policy = FlushPolicy(
+        interval=ctx.default_map['flush_timeout'],
+        max_dirty_keys=flush_conf.get('max_dirty_keys', flushpolicy.MAX_DIRTY_KEYS),
+        min_dirty_keys=flush_conf.get('min_dirty_keys', flushpolicy.MIN_DIRTY_KEYS),
+        max_dirty_bytes=flush_conf.get('max_dirty_bytes', flushpolicy.MAX_DIRTY_BYTES),
+        max_log_bytes=flush_conf.get('max_log_bytes', flushpolicy.MAX_LOG_BYTES),
+        target_pause=flush_conf.get('target_pause', flushpolicy.TARGET_PAUSE),
+        check_interval=flush_conf.get('check_interval', flushpolicy.CHECK_INTERVAL))
     flush_task = loop.create_task(
-        store.flush_loop(timeout=ctx.default_map['flush_timeout'])
+        store.flush_loop(scheduler=sched, policy=policy)
     )
+    if server.idle_timeout:
+        idle_task = loop.create_task(server.idle_loop())
+    else:
+        idle_task = None
+    if compaction_interval:
+        compact_task = loop.create_task(
+            backend.compact_loop(store, timeout=compaction_interval, scheduler=sched)
+        )
+    else:
+        compact_task = None
+    image_interval = image_conf.get('interval', 0)
+    if image_path and image_interval:
+        image_task = loop.create_task(
+            store.image_loop(image_path, interval=image_interval, scheduler=sched)
+        )
+    else:
+        image_task = None
 
     metrics_conf = ctx.default_map['metrics']
     prometheus_client.start_http_server(
@@ -158,9 +307,11 @@ def main(ctx, db, bind, port):
         server.handler,
         bind,
         port,
+        limit=conn_conf.get('read_limit', memcache_server.READ_LIMIT),
+        backlog=conn_conf.get('backlog', 1024),
         loop=loop)
-    server = loop.run_until_complete(coro)
-    logger.info('serving memcached server on {0[0]}:{0[1]}'.format(server.sockets[0].getsockname()))
+    listener = loop.run_until_complete(coro)
+    logger.info('serving memcached server on {0[0]}:{0[1]}'.format(listener.sockets[0].getsockname()))
 
     try:
         loop.run_forever()
@@ -168,10 +319,32 @@ def main(ctx, db, bind, port):
         pass
     finally:
         logger.info('stopping server')
-        server.close()
-        loop.run_until_complete(server.wait_closed())
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        if server.capture is not None:
+            server.stop_capture()
         flush_task.cancel()
         loop.run_until_complete(flush_task)
+        lag_task.cancel()
+        loop.run_until_complete(lag_task)
+        if idle_task:
+            idle_task.cancel()
+            loop.run_until_complete(idle_task)
+        if compact_task:
+            compact_task.cancel()
+            loop.run_until_complete(compact_task)
+        if image_task:
+            image_task.cancel()
+            loop.run_until_complete(image_task)
+        if store.snapshotting:
+            loop.run_until_complete(store.snapshot_task)
+        if store.imaging:
+            loop.run_until_complete(store.image_future)
+        if image_path:
+            try:
+                store.write_image(image_path)
+            except Exception as e:
+                logger.exception('error writing memory image: {}'.format(e))
         loop.close()
 
 
@@ -181,7 +354,87 @@ if __name__ == '__main__':
             'bind': '0.0.0.0',
             'port': 11211,
             'flush_timeout': 5,
+            'flush': {
+                'check_interval': 0.5,
+                'max_dirty_keys': 100000,
+                'min_dirty_keys': 1000,
+                'max_dirty_bytes': 64 * 1024 * 1024,
+                'max_log_bytes': 256 * 1024 * 1024,
+                'target_pause': 0.05,
+            },
+            'storage': 'sqlite',
             'commit_log': 'commit.log',
+            'snapshot_dir': 'snapshots',
+            'image': {
+                'path': 'kv.image',
+                'interval': 300,
+            },
+            'sqlite': {
+                'journal_mode': 'wal',
+                'synchronous': 'full',
+                'cache_size': -16000,
+                'mmap_size': 0,
+                'batch_size': 5000,
+                'without_rowid': False,
+                'lazy': False,
+                'bloom_error_rate': 0.01,
+            },
+            'log_storage': {
+                'max_file_size': 64 * 1024 * 1024,
+                'merge_files': 2,
+            },
+            'compression': {
+                'codec': 'zlib',
+                'threshold': 1024,
+                'level': 6,
+            },
+            'get_cache': {
+                'max_items': 10000,
+                'max_bytes': 64 * 1024 * 1024,
+                'max_item_size': 64 * 1024,
+            },
+            'profiler': {
+                'interval': 0.005,
+                'max_seconds': 60,
+                'lag_interval': 0.5,
+            },
+            'connections': {
+                'max_connections': 10000,
+                'backlog': 1024,
+                'read_limit': 64 * 1024,
+                'write_buffer': 64 * 1024,
+                'drain_timeout': 10,
+                'idle_timeout': 0,
+                'max_item_size': 64 * 1024 * 1024,
+            },
+            'hotkeys': {
+                'capacity': 1000,
+                'sample_rate': 0.01,
+                'half_life': 300,
+                'export': 10,
+            },
+            'scheduler': {
+                'batch': 16,
+                'slice': 100,
+                'client_rate': 0,
+                'client_burst': 100,
+                'quiet': 0.005,
+                'max_defer': 1.0,
+            },
+            'capture': {
+                'dir': 'captures',
+                'max_value': 64,
+            },
+            'slowlog': {
+                'threshold': 0.01,
+                'sample_rate': 0.001,
+                'size': 128,
+            },
+            'compaction': {
+                'interval': 60,
+                'rate': 4 * 1024 * 1024,
+                'min_size': 1024 * 1024,
+            },
             'web': {
                 'bind': '0.0.0.0',
                 'port': 8080,
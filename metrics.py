@@ -0,0 +1,162 @@
+import bisect
+from contextlib import ContextDecorator
+import time
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import (
+    CounterMetricFamily,
+    GaugeMetricFamily,
+    HistogramMetricFamily,
+)
+from prometheus_client.utils import INF, floatToGoString
+
+
+# drop-in replacements for the prometheus_client metric classes, for
+# metrics updated on every request or every key. prometheus_client takes a
+# lock (and, for histograms, scans the buckets) on every update; these keep
+# plain numbers that are only turned into samples when the registry is
+# scraped. updates are not thread safe, so only use them from the event loop
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0, INF)
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, observe):
+        self.observe = observe
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.observe(time.perf_counter() - self.start)
+
+
+class _ExceptionCounter(ContextDecorator):
+    def __init__(self, inc):
+        self.inc = inc
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.inc()
+
+
+class CounterValue(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def count_exceptions(self):
+        return _ExceptionCounter(self.inc)
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class HistogramValue(object):
+    __slots__ = ('upper_bounds', 'counts', 'sum')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * len(upper_bounds)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # buckets are inclusive upper bounds, and the last one is +Inf
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return _Timer(self.observe)
+
+    def buckets(self):
+        cumulative = 0
+        for bound, count in zip(self.upper_bounds, self.counts):
+            cumulative += count
+            yield floatToGoString(bound), cumulative
+
+
+class _Metric(object):
+    family = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            # unlabelled metrics are used directly, like prometheus_client's.
+            # bind the child's methods so an update is a single call
+            self.child = self.children[()] = self.new_child()
+            for method in ('inc', 'dec', 'set', 'observe', 'time', 'count_exceptions'):
+                if hasattr(self.child, method):
+                    setattr(self, method, getattr(self.child, method))
+        if registry:
+            registry.register(self)
+
+    def labels(self, *values):
+        try:
+            return self.children[values]
+        except KeyError:
+            child = self.children[values] = self.new_child()
+            return child
+
+    def describe(self):
+        return [self.family(self.name, self.documentation, labels=self.labelnames)]
+
+    def collect(self):
+        family = self.family(self.name, self.documentation, labels=self.labelnames)
+        for values, child in list(self.children.items()):
+            self.add_sample(family, list(values), child)
+        return [family]
+
+
+class Counter(_Metric):
+    family = CounterMetricFamily
+
+    def new_child(self):
+        return CounterValue()
+
+    def add_sample(self, family, values, child):
+        family.add_metric(values, child.value)
+
+
+class Gauge(_Metric):
+    family = GaugeMetricFamily
+
+    def new_child(self):
+        return GaugeValue()
+
+    def add_sample(self, family, values, child):
+        family.add_metric(values, child.value)
+
+
+class Histogram(_Metric):
+    family = HistogramMetricFamily
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        buckets = tuple(float(bound) for bound in buckets)
+        if buckets[-1] != INF:
+            buckets += (INF,)
+        self.upper_bounds = buckets
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_child(self):
+        return HistogramValue(self.upper_bounds)
+
+    def add_sample(self, family, values, child):
+        family.add_metric(values, list(child.buckets()), child.sum)
@@ -0,0 +1,92 @@
+import asyncio
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+from prometheus_client import Histogram
+import structlog
+
+
+logger = structlog.get_logger(__name__)
+
+
+LOOP_LAG = Histogram('event_loop_lag_seconds', 'How late the event loop runs a callback scheduled to run now',
+                     buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0))
+
+INTERVAL = 0.005
+MAX_SECONDS = 60
+LAG_INTERVAL = 0.5
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+def collapse(frame):
+    stack = []
+    while frame is not None:
+        stack.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class SamplingProfiler(object):
+    # samples the stack of one thread (the event loop's) from a background
+    # thread every `interval` seconds. nothing is installed in the profiled
+    # thread, so the overhead is one stack walk per sample
+    def __init__(self, interval=INTERVAL, max_seconds=MAX_SECONDS):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.running = False
+
+    def sample(self, thread_id, seconds, interval, stop):
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not stop.is_set():
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stacks[collapse(frame)] += 1
+            del frame
+            stop.wait(interval)
+        return stacks
+
+    async def profile(self, seconds, interval=None, loop=None):
+        if self.running:
+            raise RuntimeError('profile already in progress')
+        loop = loop or asyncio.get_event_loop()
+        seconds = min(float(seconds), self.max_seconds)
+        interval = interval or self.interval
+        stop = threading.Event()
+
+        self.running = True
+        logger.info('profiling for %.1fs every %.4fs', seconds, interval)
+        try:
+            return await loop.run_in_executor(
+                None, self.sample, threading.get_ident(), seconds, interval, stop)
+        finally:
+            stop.set()
+            self.running = False
+
+    @staticmethod
+    def format(stacks):
+        # brendan gregg's collapsed stack format, which flamegraph.pl and
+        # speedscope read directly
+        return ''.join('%s %d\n' % (stack, count) for stack, count in stacks.most_common())
+
+
+async def monitor_loop_lag(interval=LAG_INTERVAL, loop=None, callback=None):
+    loop = loop or asyncio.get_event_loop()
+    try:
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - expected)
+            LOOP_LAG.observe(lag)
+            if callback:
+                callback(lag)
+
+    except asyncio.CancelledError as e:
+        logger.info('--cleanup--')
@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+from prometheus_client import Histogram
+import structlog
+
+import metrics
+
+
+logger = structlog.get_logger(__name__)
+
+
+YIELDS = metrics.Counter('scheduler_yields', 'Times a connection or long command handed the loop to others')
+THROTTLED = metrics.Counter('scheduler_throttled_requests', 'Requests delayed by their connection\'s rate limit')
+THROTTLE_SECONDS = metrics.Counter('scheduler_throttle_seconds', 'Time requests were delayed by their connection\'s rate limit')
+MAINTENANCE_DELAY = Histogram('scheduler_maintenance_delay_seconds', 'Time background work waited for a lull in requests',
+                              buckets=(.001, .005, .01, .05, .1, .25, .5, 1.0, 2.5, 5.0))
+
+
+# requests served from one connection before the others get a turn. a
+# client that pipelines requests would otherwise be served for as long as
+# its requests are already buffered, without the loop ever switching away
+BATCH = 16
+# keys of a multi-get (or items of a dump) handled between turns
+SLICE = 100
+# requests/sec per connection, 0 for unlimited
+RATE = 0
+BURST = 100
+# background work waits for this many seconds without a request...
+QUIET = 0.005
+# ...but no longer than this
+MAX_DEFER = 1.0
+
+
+class TokenBucket(object):
+    # like compaction.RateLimiter, but over requests, and it leaves the
+    # waiting to the caller
+    __slots__ = ('rate', 'burst', 'clock', 'tokens', 'last')
+
+    def __init__(self, rate, burst=BURST, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+
+    def take(self, n=1):
+        # seconds until the tokens taken would have been there
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= n
+        if self.tokens < 0:
+            return -self.tokens / self.rate
+        return 0
+
+
+class Scheduler(object):
+    # everything runs on one loop, so fairness comes from the work itself
+    # giving the loop up: connections after every `batch` requests, long
+    # commands every `slice` keys, and background work (flushes and
+    # compaction) waits for a gap between requests before it starts
+    def __init__(self, batch=BATCH, slice_size=SLICE, rate=RATE, burst=BURST,
+                 quiet=QUIET, max_defer=MAX_DEFER, clock=time.monotonic):
+        self.batch = batch
+        self.slice_size = slice_size
+        self.rate = rate
+        self.burst = burst
+        self.quiet = quiet
+        self.max_defer = max_defer
+        self.clock = clock
+        # monotonic time the last request was read, kept by the server
+        self.last_request = 0.0
+
+    def bucket(self):
+        # a connection's rate limit, or None when unlimited
+        if self.rate:
+            return TokenBucket(self.rate, self.burst, self.clock)
+        return None
+
+    async def pause(self):
+        YIELDS.inc()
+        await asyncio.sleep(0)
+
+    async def throttle(self, bucket):
+        delay = bucket.take()
+        if delay:
+            THROTTLED.inc()
+            THROTTLE_SECONDS.inc(delay)
+            await asyncio.sleep(delay)
+
+    def slices(self, items):
+        for i in range(0, len(items), self.slice_size):
+            yield items[i:i + self.slice_size]
+
+    async def maintenance(self):
+        # wait until no request has come in for `quiet` seconds, or for
+        # `max_defer` if requests never let up
+        start = now = self.clock()
+        while now - start < self.max_defer:
+            last = self.last_request
+            idle = now - last
+            if idle >= self.quiet:
+                break
+            await asyncio.sleep(min(self.quiet - idle, self.max_defer - (now - start)))
+            now = self.clock()
+            if self.last_request == last:
+                # nothing came in while we waited
+                break
+        MAINTENANCE_DELAY.observe(now - start)
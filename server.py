@@ -1,12 +1,15 @@
 import asyncio
+import contextvars
+import itertools
+import json
+import os
+import struct
+import time
 
-from prometheus_client import (
-    Counter,
-    Gauge,
-    Histogram,
-)
 import structlog
 
+import capture
+from capture import Capture
 from commands import (
     DeleteCommand,
     DumpCommand,
@@ -15,59 +18,256 @@ from commands import (
     SetCommand,
     GetCommand,
 )
+from hotkeys import HotKeys
+import metrics
+from profiler import SamplingProfiler
+from scheduler import Scheduler
+import slowlog
+from slowlog import SlowLog, Trace, TRACE
+from valuecache import END
 
 
 logger = structlog.get_logger(__name__)
 
 
-REQUEST_DURATION = Histogram('request_duration_seconds', 'Request duration in seconds', ['command'])
-REQUEST_ERRORS = Counter('request_errors', 'Exceptions thrown in request handlers', ['command'])
-BYTES_IN = Counter('bytes_in', 'Network bytes in')
-BYTES_OUT = Counter('bytes_out', 'Network bytes out')
+REQUEST_DURATION = metrics.Histogram('request_duration_seconds', 'Request duration in seconds', ['command'])
+REQUEST_ERRORS = metrics.Counter('request_errors', 'Exceptions thrown in request handlers', ['command'])
+BYTES_IN = metrics.Counter('bytes_in', 'Network bytes in')
+BYTES_OUT = metrics.Counter('bytes_out', 'Network bytes out')
+NUM_CONNECTIONS = metrics.Gauge('server_connections', 'Open client connections')
+CONNECTIONS = metrics.Counter('server_accepted_connections', 'Client connections accepted')
+REJECTED_CONNECTIONS = metrics.Counter('server_rejected_connections', 'Client connections refused over max_connections')
+IDLE_DISCONNECTS = metrics.Counter('server_idle_disconnects', 'Client connections closed for being idle')
+SLOW_DISCONNECTS = metrics.Counter('server_slow_client_disconnects', 'Client connections dropped for not reading replies')
+GET_KEYS = metrics.Counter('server_get_keys', 'Keys looked up by get, by whether they were found', ['result'])
+DELETE_KEYS = metrics.Counter('server_delete_keys', 'Keys deleted, by whether they were found', ['result'])
+GET_HITS = GET_KEYS.labels('hit')
+GET_MISSES = GET_KEYS.labels('miss')
+DELETE_HITS = DELETE_KEYS.labels('hit')
+DELETE_MISSES = DELETE_KEYS.labels('miss')
+
+
+MAX_CONNECTIONS = 10000
+# the StreamReader limit: longest command line, and how much a client can
+# send ahead before reading from it is paused
+READ_LIMIT = 64 * 1024
+# replies buffered for a client before the connection stops reading its
+# requests until they're sent
+WRITE_BUFFER = 64 * 1024
+# seconds a client may sit over WRITE_BUFFER before it's dropped
+DRAIN_TIMEOUT = 10
+# seconds without a request before a connection is closed, 0 for never
+IDLE_TIMEOUT = 0
+# largest value a set may store, 0 for no limit
+MAX_ITEM_SIZE = 64 * 1024 * 1024
+# values bigger than this are read from and written to the socket a chunk
+# at a time, rather than through a buffer holding the whole request or reply
+STREAM_SIZE = 256 * 1024
+STREAM_CHUNK = 64 * 1024
+# where `capture start` writes
+CAPTURE_DIR = 'captures'
+
+
+# the Client of the connection a handler task is serving
+CLIENT = contextvars.ContextVar('client', default=None)
+
+
+class Client(object):
+    # a connection's entry in MemcacheServer.connections, and what
+    # `stats conns` reports about it
+    __slots__ = ('id', 'addr', 'opened', 'last', 'requests', 'bytes_out', 'capture')
+
+    def __init__(self, id, addr):
+        self.id = id
+        self.addr = addr
+        self.opened = self.last = time.monotonic()
+        self.requests = 0
+        self.bytes_out = 0
+        # the capture running when the current request started, so one
+        # started part way through a set doesn't get its value alone
+        self.capture = None
+
+
+def request_count(command):
+    # read without labels(), which would add an empty series for a
+    # command that hasn't been seen yet
+    child = REQUEST_DURATION.children.get((command,))
+    return sum(child.counts) if child is not None else 0
+
+def format_stat(value):
+    if isinstance(value, float):
+        return b'%.6f' % value
+    if isinstance(value, int):
+        return b'%d' % value
+    return str(value).encode()
+
+
+class Reply(list):
+    # a reply carrying large values, as buffers that are written one slice
+    # at a time rather than joined into one
+    pass
+
+
+def end_values(values):
+    if isinstance(values, Reply):
+        values.append(END)
+        return values
+    return values + END
 
 
 class MemcacheServer(object):
     sep = b'\r\n'
     seplen = len(sep)
 
-    def __init__(self, store):
+    def __init__(self, store, profiler=None, hotkeys=None, slow_log=None, scheduler=None,
+                 max_connections=MAX_CONNECTIONS, write_buffer=WRITE_BUFFER, drain_timeout=DRAIN_TIMEOUT,
+                 idle_timeout=IDLE_TIMEOUT, max_item_size=MAX_ITEM_SIZE, stream_size=STREAM_SIZE,
+                 capture_dir=CAPTURE_DIR, capture_max_value=capture.MAX_VALUE):
         self.store = store
+        self.profiler = profiler or SamplingProfiler()
+        self.hotkeys = hotkeys or HotKeys()
+        self.slow_log = slow_log or SlowLog()
+        self.scheduler = scheduler or Scheduler()
+        self.max_connections = max_connections
+        self.write_buffer = write_buffer
+        self.drain_timeout = drain_timeout
+        self.idle_timeout = idle_timeout
+        self.max_item_size = max_item_size
+        self.stream_size = stream_size
+        self.capture_dir = capture_dir
+        self.capture_max_value = capture_max_value
+        # the running traffic capture, if any
+        self.capture = None
+        # writer -> Client
+        self.connections = {}
+        self.client_ids = itertools.count(1)
+        self.started = time.time()
 
     async def cmd_set(self, reader, key, flags, exptime, datalen, noreply=None):
         datalen = int(datalen)
-        data = await reader.readexactly(datalen + 2)
-        BYTES_IN.inc(len(data))
-        data = data.rstrip(self.sep)
-        self.store.apply(SetCommand(key, flags, exptime, data))
+        start = time.perf_counter()
+        if self.max_item_size and datalen > self.max_item_size:
+            await self.skip_value(reader, datalen)
+            self.capture_value(datalen)
+            return b'SERVER_ERROR object too large for cache'
+        if datalen > self.stream_size:
+            data = await self.read_value(reader, datalen)
+        else:
+            data = (await reader.readexactly(datalen + self.seplen))[:-self.seplen]
+        self.capture_value(datalen, data)
+        slowlog.add_read_time(time.perf_counter() - start)
+        BYTES_IN.inc(datalen + self.seplen)
+        self.hotkeys.record('set', key, datalen)
+        encoding, data = self.store.compressor.compress(data)
+        self.store.apply(SetCommand.create(key, flags, exptime, data, encoding))
         if noreply is None:
             return b'STORED'
 
+    def capture_value(self, datalen, data=b''):
+        client = CLIENT.get()
+        if client is not None and client.capture is not None:
+            client.capture.value(client.id, datalen, data)
+
+    async def read_value(self, reader, datalen):
+        # straight into a buffer of the value's size, so neither the
+        # reader's buffer nor a slice of it ever holds the whole value. the
+        # bytearray is stored as is and never changed after this
+        value = bytearray(datalen)
+        with memoryview(value) as view:
+            pos = 0
+            while pos < datalen:
+                chunk = await reader.read(min(STREAM_CHUNK, datalen - pos))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', datalen)
+                view[pos:pos + len(chunk)] = chunk
+                pos += len(chunk)
+        await reader.readexactly(self.seplen)
+        return value
+
+    async def skip_value(self, reader, datalen):
+        remaining = datalen + self.seplen
+        while remaining:
+            chunk = await reader.read(min(STREAM_CHUNK, remaining))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', datalen)
+            remaining -= len(chunk)
+
     async def cmd_get(self, reader, *keys):
+        cache = self.store.value_cache
+        if cache is not None and len(keys) == 1:
+            self.hotkeys.record('get', keys[0])
+            wire = cache.get(keys[0])
+            if wire is not None:
+                GET_HITS.inc()
+            else:
+                wire = end_values(self.get_values(keys))
+                if not isinstance(wire, Reply) and len(wire) > len(END):
+                    cache.put(keys[0], wire)
+            return wire
+        for key in keys:
+            self.hotkeys.record('get', key)
+        if len(keys) <= self.scheduler.slice_size:
+            return end_values(self.get_values(keys))
+        # a long multi-get gives other connections a turn between slices
+        resp = []
+        stream = False
+        for i, chunk in enumerate(self.scheduler.slices(keys)):
+            if i:
+                await self.scheduler.pause()
+            values = self.get_values(chunk)
+            if isinstance(values, Reply):
+                stream = True
+                resp.extend(values)
+            else:
+                resp.append(values)
+        resp.append(END)
+        return Reply(resp) if stream else b''.join(resp)
+
+    def get_values(self, keys):
         resp = []
+        stream = False
         for key in keys:
             try:
                 item = self.store.apply(GetCommand(key))
             except KeyError:
-                pass
+                GET_MISSES.inc()
             else:
-                resp.append(b'VALUE %s %d %d' % (key, item.flags, len(item.data)))
-                resp.append(item.data)
-        resp.append(b'END')
+                GET_HITS.inc()
+                data = self.store.compressor.decompress(item)
+                resp.append(b'VALUE %s %d %d' % (key, item.flags, len(data)))
+                resp.append(data)
+                if len(data) > self.stream_size:
+                    stream = True
+        if stream:
+            reply = Reply()
+            for part in resp:
+                reply.append(part)
+                reply.append(self.sep)
+            return reply
+        resp.append(b'')
         return b'\r\n'.join(resp)
 
     async def cmd_delete(self, reader, key, noreply=None):
+        self.hotkeys.record('delete', key)
+        self.hotkeys.removed(key)
         try:
             self.store.apply(DeleteCommand(key))
         except KeyError:
+            DELETE_MISSES.inc()
             resp = b'NOT_FOUND'
         else:
+            DELETE_HITS.inc()
             resp = b'DELETED'
         finally:
             if noreply is None:
                 return resp
 
     async def cmd_dump(self, reader):
-        self.store.apply(DumpCommand())
+        keys = list(self.store.data)
+        for i, chunk in enumerate(self.scheduler.slices(keys)):
+            if i:
+                await self.scheduler.pause()
+            self.store.apply(DumpCommand(chunk))
 
     async def cmd_dumplog(self, reader):
         self.store.apply(DumpLogCommand())
@@ -75,7 +275,166 @@ class MemcacheServer(object):
     async def cmd_dumpcommit(self, reader):
         self.store.apply(DumpCommitCommand())
 
+    async def cmd_profile(self, reader, seconds=b'5'):
+        try:
+            stacks = await self.profiler.profile(float(seconds))
+        except RuntimeError as e:
+            return b'SERVER_ERROR %s' % str(e).encode()
+        data = SamplingProfiler.format(stacks).encode()
+        return b'VALUE profile 0 %d\r\n%s\r\nEND' % (len(data), data)
+
+    async def cmd_slowlog(self, reader, subcommand=b'get', n=None):
+        subcommand = subcommand.lower()
+        if subcommand == b'get':
+            data = json.dumps(self.slow_log.get(int(n) if n else None)).encode()
+            return b'VALUE slowlog 0 %d\r\n%s\r\nEND' % (len(data), data)
+        if subcommand == b'len':
+            return b'%d' % len(self.slow_log)
+        if subcommand == b'reset':
+            self.slow_log.reset()
+            return b'OK'
+        return b'CLIENT_ERROR unknown slowlog subcommand'
+
+    async def cmd_stats(self, reader, group=b''):
+        stats = getattr(self, 'stats_%s' % group.decode().lower(), None) if group else self.stats_general
+        if stats is None:
+            return b'CLIENT_ERROR unknown stats group'
+        lines = [b'STAT %s %s' % (name.encode(), format_stat(value)) for name, value in stats()]
+        lines.append(END)
+        return b'\r\n'.join(lines)
+
+    def stats_general(self):
+        # the memcached names where there is an equivalent
+        store = self.store
+        user, system = os.times()[:2]
+        return [
+            ('pid', os.getpid()),
+            ('uptime', int(time.time() - self.started)),
+            ('time', int(time.time())),
+            ('pointer_size', struct.calcsize('P') * 8),
+            ('rusage_user', user),
+            ('rusage_system', system),
+            ('max_connections', self.max_connections),
+            ('curr_connections', len(self.connections)),
+            ('total_connections', CONNECTIONS.child.value),
+            ('rejected_connections', REJECTED_CONNECTIONS.child.value),
+            ('cmd_get', GET_HITS.value + GET_MISSES.value),
+            ('cmd_set', request_count('set')),
+            ('get_hits', GET_HITS.value),
+            ('get_misses', GET_MISSES.value),
+            ('delete_hits', DELETE_HITS.value),
+            ('delete_misses', DELETE_MISSES.value),
+            ('bytes_read', BYTES_IN.child.value),
+            ('bytes_written', BYTES_OUT.child.value),
+            # items in memory. in lazy mode that leaves out the ones that
+            # haven't been read yet
+            ('curr_items', len(store.data)),
+            ('bytes', store.num_bytes),
+            # nothing is evicted or expires
+            ('evictions', 0),
+            ('expired_unfetched', 0),
+            ('dirty_items', store.dirty_keys),
+            ('dirty_bytes', store.dirty_bytes),
+            ('commit_log_bytes', store.commit_log_size),
+            ('flushes', store.flushes),
+            ('flush_seconds', store.flush_seconds),
+            ('last_flush_seconds', store.last_flush_seconds),
+        ]
+
+    def stats_items(self):
+        # there are no slab classes, so every item is in class 1
+        return [
+            ('items:1:number', len(self.store.data)),
+            ('items:1:evicted', 0),
+            ('items:1:outofmemory', 0),
+        ]
+
+    def stats_sizes(self):
+        return [(str(size), count) for size, count in sorted(self.store.sizes.items()) if count]
+
+    def stats_conns(self):
+        now = time.monotonic()
+        stats = []
+        for client in sorted(self.connections.values(), key=lambda client: client.id):
+            prefix = '%d:' % client.id
+            stats.extend((
+                (prefix + 'addr', client.addr),
+                (prefix + 'secs_since_last_cmd', int(now - client.last)),
+                (prefix + 'connected_secs', int(now - client.opened)),
+                (prefix + 'requests', client.requests),
+                (prefix + 'bytes_written', client.bytes_out),
+            ))
+        return stats
+
+    async def cmd_capture(self, reader, subcommand=b'start', name=None):
+        subcommand = subcommand.lower()
+        if subcommand == b'start':
+            if self.capture is not None:
+                return b'SERVER_ERROR capture already running'
+            path = self.start_capture(name.decode() if name else None)
+            return b'OK %s' % path.encode()
+        if subcommand == b'stop':
+            if self.capture is None:
+                return b'SERVER_ERROR no capture running'
+            info = self.stop_capture()
+            return b'OK %s %d' % (info['path'].encode(), info['records'])
+        return b'CLIENT_ERROR unknown capture subcommand'
+
+    def start_capture(self, name=None):
+        name = os.path.basename(name or time.strftime('%Y%m%dT%H%M%S'))
+        os.makedirs(self.capture_dir, exist_ok=True)
+        path = os.path.join(self.capture_dir, name)
+        self.capture = Capture(path, self.capture_max_value)
+        logger.info('capturing traffic to %s', path)
+        return path
+
+    def stop_capture(self):
+        running, self.capture = self.capture, None
+        running.close()
+        info = running.info()
+        logger.info('captured {records} records in {seconds:.1f}s to {path}'.format(**info))
+        return info
+
+    async def cmd_snapshot(self, reader, name=None):
+        try:
+            path = self.store.start_snapshot(name.decode() if name else None)
+        except RuntimeError as e:
+            return b'SERVER_ERROR %s' % str(e).encode()
+        return b'OK %s' % path.encode()
+
     async def handler(self, reader, writer):
+        if len(self.connections) >= self.max_connections:
+            REJECTED_CONNECTIONS.inc()
+            logger.warn('too many connections, refusing {}'.format(writer.get_extra_info('peername')))
+            writer.write(b'SERVER_ERROR too many open connections' + self.sep)
+            writer.close()
+            return
+
+        writer.transport.set_write_buffer_limits(high=self.write_buffer)
+        peername = writer.get_extra_info('peername')
+        addr = ':'.join(map(str, peername[:2])) if isinstance(peername, tuple) else str(peername)
+        client = self.connections[writer] = Client(next(self.client_ids), addr)
+        CONNECTIONS.inc()
+        NUM_CONNECTIONS.inc()
+        TRACE.set(Trace(addr))
+        CLIENT.set(client)
+        if self.capture is not None:
+            self.capture.opened(client.id)
+        try:
+            await self.serve(reader, writer, client)
+        except ConnectionError as e:
+            logger.debug('connection lost: {}'.format(e))
+        finally:
+            if self.capture is not None:
+                self.capture.closed(client.id)
+            del self.connections[writer]
+            NUM_CONNECTIONS.dec()
+            writer.close()
+
+    async def serve(self, reader, writer, client):
+        scheduler = self.scheduler
+        bucket = scheduler.bucket()
+        served = 0
         while True:
             if reader.at_eof():
                 break
@@ -93,14 +452,79 @@ class MemcacheServer(object):
                     reader._buffer.clear()
                 reader._maybe_resume_transport()
             else:
+                client.last = scheduler.last_request = time.monotonic()
+                client.capture = self.capture
+                if client.capture is not None:
+                    client.capture.line(client.id, buf)
                 buf = buf.rstrip(self.sep)
                 if buf:
+                    if bucket is not None:
+                        await scheduler.throttle(bucket)
+                    client.requests += 1
                     resp = await self.dispatch(reader, buf)
-                    if resp:
-                        writer.write(resp + self.sep)
-                        BYTES_OUT.inc(len(resp + self.sep))
-                        await writer.drain()
-        writer.close()
+                    if isinstance(resp, Reply):
+                        if not await self.send(writer, client, resp):
+                            break
+                    elif resp:
+                        writer.writelines((resp, self.sep))
+                        BYTES_OUT.inc(len(resp) + self.seplen)
+                        client.bytes_out += len(resp) + self.seplen
+                        if writer.transport.get_write_buffer_size() > self.write_buffer:
+                            if not await self.drain(writer):
+                                break
+                    served += 1
+                    if served >= scheduler.batch:
+                        served = 0
+                        await scheduler.pause()
+
+    async def send(self, writer, client, reply):
+        # a slice at a time, waiting for the client to take them whenever
+        # too much is buffered, so the transport never holds a whole copy
+        # of a large value either
+        reply.append(self.sep)
+        for part in reply:
+            with memoryview(part) as view:
+                for i in range(0, len(view), STREAM_CHUNK):
+                    writer.write(view[i:i + STREAM_CHUNK])
+                    if writer.transport.get_write_buffer_size() > self.write_buffer:
+                        if not await self.drain(writer):
+                            return False
+            BYTES_OUT.inc(len(part))
+            client.bytes_out += len(part)
+        return True
+
+    async def drain(self, writer):
+        # a client that doesn't read its replies. no more requests are read
+        # from it while we wait, and it's dropped if it doesn't catch up
+        try:
+            await asyncio.wait_for(writer.drain(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            SLOW_DISCONNECTS.inc()
+            logger.warn('dropping slow client {}: {} bytes unsent'.format(
+                writer.get_extra_info('peername'), writer.transport.get_write_buffer_size()))
+            writer.transport.abort()
+            return False
+        return True
+
+    def close_idle(self, now=None):
+        now = now or time.monotonic()
+        for writer, client in list(self.connections.items()):
+            if now - client.last >= self.idle_timeout:
+                IDLE_DISCONNECTS.inc()
+                logger.info('closing idle connection {}'.format(writer.get_extra_info('peername')))
+                writer.close()
+
+    async def idle_loop(self, interval=None):
+        # one sweep for every connection rather than a timer per connection,
+        # so idle clients cost nothing but their buffers
+        interval = interval or max(1, self.idle_timeout / 10)
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                self.close_idle()
+
+        except asyncio.CancelledError as e:
+            logger.info('--cleanup--')
 
     async def dispatch(self, reader, buf):
         argv = buf.split(b' ')
@@ -108,12 +532,19 @@ class MemcacheServer(object):
         cmd = cmd.decode().lower()
         cmd_handler = getattr(self, 'cmd_%s' % cmd, None)
         if cmd_handler:
-            with REQUEST_DURATION.labels(cmd).time():
-                with REQUEST_ERRORS.labels(cmd).count_exceptions():
-                    try:
-                        return await cmd_handler(reader, *argv)
-                    except Exception as e:
-                        logger.exception('error processing command {}: {}'.format(cmd, e))
+            trace = TRACE.get()
+            if trace is not None:
+                trace.reset()
+            start = time.perf_counter()
+            try:
+                return await cmd_handler(reader, *argv)
+            except Exception as e:
+                REQUEST_ERRORS.labels(cmd).inc()
+                logger.exception('error processing command {}: {}'.format(cmd, e))
+            finally:
+                elapsed = time.perf_counter() - start
+                REQUEST_DURATION.labels(cmd).observe(elapsed)
+                self.slow_log.observe(cmd, argv, elapsed, trace)
         else:
             logger.warn('received unknown command: %s', cmd)
             return b'ERROR'
@@ -0,0 +1,111 @@
+from collections import deque
+import contextvars
+import itertools
+import time
+
+
+THRESHOLD = 0.01
+SAMPLE_RATE = 0.001
+SIZE = 128
+MAX_KEYS = 8
+MAX_KEY_LENGTH = 64
+
+
+class Trace(object):
+    # where the time of the current request on a connection went. one per
+    # connection, reset for every request, and reached through TRACE by code
+    # that doesn't otherwise know which connection it's serving
+    __slots__ = ('client', 'read', 'commit')
+
+    def __init__(self, client=None):
+        self.client = client
+        self.reset()
+
+    def reset(self):
+        self.read = 0.0
+        self.commit = 0.0
+
+
+# each connection's handler runs in its own task, and so its own context
+TRACE = contextvars.ContextVar('trace', default=None)
+
+
+def add_commit_time(seconds):
+    trace = TRACE.get()
+    if trace is not None:
+        trace.commit += seconds
+
+def add_read_time(seconds):
+    trace = TRACE.get()
+    if trace is not None:
+        trace.read += seconds
+
+
+def describe_keys(keys):
+    described = [key[:MAX_KEY_LENGTH].decode(errors='replace') for key in keys[:MAX_KEYS]]
+    if len(keys) > MAX_KEYS:
+        described.append('... (%d more)' % (len(keys) - MAX_KEYS))
+    return described
+
+
+class SlowLog(object):
+    # like redis' SLOWLOG: the last `size` commands that took at least
+    # `threshold` seconds, plus one in every 1/sample_rate commands however
+    # fast, so there's always a baseline to compare against. a command that
+    # is neither costs a comparison and a decrement
+    def __init__(self, threshold=THRESHOLD, sample_rate=SAMPLE_RATE, size=SIZE):
+        self.threshold = threshold
+        self.period = max(1, int(round(1 / sample_rate))) if sample_rate else 0
+        self.countdown = self.period
+        self.entries = deque(maxlen=size)
+        self.ids = itertools.count()
+        # most recent event loop lag, as measured by profiler.monitor_loop_lag
+        self.loop_lag = 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def observe(self, command, argv, seconds, trace=None):
+        slow = seconds >= self.threshold
+        if not slow:
+            if not self.period:
+                return
+            self.countdown -= 1
+            if self.countdown:
+                return
+            self.countdown = self.period
+
+        read = trace.read if trace else 0.0
+        commit = trace.commit if trace else 0.0
+        if command == 'set':
+            keys = argv[:1]
+            value_bytes = int(argv[3]) if len(argv) > 3 and argv[3].isdigit() else None
+        else:
+            keys, value_bytes = argv, None
+        self.entries.appendleft({
+            'id': next(self.ids),
+            'time': time.time(),
+            'command': command,
+            'keys': describe_keys(keys),
+            'value_bytes': value_bytes,
+            'client': trace.client if trace else None,
+            'sampled': not slow,
+            'duration': seconds,
+            # waiting for the client to send the rest of the request
+            'read': read,
+            # writing (and fsyncing) the commit log
+            'commit': commit,
+            'execute': max(0.0, seconds - read - commit),
+            # how late the event loop was running callbacks, a measure of
+            # how long requests wait before they are picked up at all
+            'loop_lag': self.loop_lag,
+        })
+
+    def record_loop_lag(self, seconds):
+        self.loop_lag = seconds
+
+    def get(self, n=None):
+        return list(itertools.islice(self.entries, n))
+
+    def reset(self):
+        self.entries.clear()
@@ -1,181 +1,356 @@
 import asyncio
 from collections import defaultdict, namedtuple
-from collections.abc import MutableMapping
+from collections.abc import KeysView, MutableMapping
+import gc
+import itertools
 import os
-import struct
+import time
 import uuid
 
 from prometheus_client import (
     Counter,
-    Gauge,
     Histogram,
 )
 import structlog
 
-from base import Command
-from utils import unpack
+from backends import Backend, SQLiteBackend
+import commitlog
+import compression
+import database
+from flushpolicy import FlushPolicy
+import image
+import metrics
+import slowlog
 
 
 logger = structlog.get_logger(__name__)
 
 
-StorageItem = namedtuple('StorageItem', 'flags exptime data')
+StorageItem = namedtuple('StorageItem', 'flags exptime data encoding')
+StorageItem.__new__.__defaults__ = (compression.NONE,)
 
 
-TABLE_SCHEMA = '''
-CREATE TABLE IF NOT EXISTS items (
-    key TEXT PRIMARY KEY,
-    flags INTEGER,
-    exptime INTEGER,
-    data BLOB
-);'''
-
-STATUS_SCHEMA = '''
-CREATE TABLE IF NOT EXISTS status (
-    id INTEGER PRIMARY KEY,
-    commit_id BLOB
-);'''
-
-
-NUM_KEYS = Gauge('storage_num_keys', 'number of keys')
-NUM_BYTES = Gauge('storage_data_bytes', 'size of data')
-NUM_COMMITS = Counter('storage_num_commits', 'number of commits')
-COMMIT_DURATION = Histogram('storage_commit_seconds', 'Duration of commits')
-COMMIT_ERRORS = Counter('storage_commit_errors', 'Number of errors during commit')
-NUM_DB_UPSERTS = Counter('storage_db_upserts', 'number of db upserts')
-NUM_DB_DELETES = Counter('storage_db_deletes', 'number of db deletes')
+# updated for every key or every write, so these use the lock-free metrics
+NUM_KEYS = metrics.Gauge('storage_num_keys', 'number of keys')
+NUM_BYTES = metrics.Gauge('storage_data_bytes', 'size of data')
+NUM_COMMITS = metrics.Counter('storage_num_commits', 'number of commits')
+COMMIT_DURATION = metrics.Histogram('storage_commit_seconds', 'Duration of commits')
+COMMIT_ERRORS = metrics.Counter('storage_commit_errors', 'Number of errors during commit')
 NUM_DB_FLUSH = Counter('storage_db_num_flush', 'number of db flushes')
 FLUSH_DURATION = Histogram('storage_flush_seconds', 'Duration of flush')
 FLUSH_ERRORS = Counter('storage_flush_errors', 'Number of errors during flush')
+NUM_SNAPSHOTS = Counter('storage_num_snapshots', 'number of snapshots')
+SNAPSHOT_DURATION = Histogram('storage_snapshot_seconds', 'Duration of snapshots')
+SNAPSHOT_ERRORS = Counter('storage_snapshot_errors', 'Number of errors during snapshot')
+IMAGE_DURATION = Histogram('storage_image_seconds', 'Duration of memory image writes')
+IMAGE_ERRORS = Counter('storage_image_errors', 'Number of errors writing memory images')
+
+
+SNAPSHOT_PAGES = 64
+# item sizes are counted in buckets this wide for `stats sizes`, as
+# memcached does
+SIZE_BUCKET = 32
 
 
 class Store(MutableMapping):
-    def __init__(self, conn, commit_log):
+    def __init__(self, conn, commit_log=None, snapshot_dir='snapshots',
+                 batch_size=database.BATCH_SIZE, without_rowid=False, compressor=None, value_cache=None):
+        if isinstance(conn, Backend):
+            self.backend = conn
+        else:
+            self.backend = SQLiteBackend(conn, commit_log, batch_size, without_rowid)
         self.data = {}
         self.commit_id = None
-        self.conn = conn
-        self.commit_log = commit_log
+        self.compressor = compressor or compression.Compressor()
+        # serialized get replies, kept in step with the items here
+        self.value_cache = value_cache
         self.pending_insert = set()
         self.pending_delete = set()
         self.pending_update = set()
+        # running totals for `stats`, kept up to date as items change so
+        # reading them doesn't walk the store
+        self.num_bytes = 0
+        self.sizes = defaultdict(int)
+        # bytes committed since the last flush
+        self.dirty_bytes = 0
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        # bumped by every commit. versions are only meaningful within one
+        # process, so anything derived from them also carries the epoch
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.started = self.modified = time.time()
+        # key -> (version, time) of its last commit
+        self.versions = {}
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_task = None
+        self.snapshot_running = False
+        self.last_snapshot = None
+        self.last_snapshot_error = None
+        # a memory image being written in an executor thread
+        self.image_future = None
 
     @property
     def dirty(self):
         return self.pending_insert or self.pending_update or self.pending_delete
 
+    @property
+    def dirty_keys(self):
+        return len(self.pending_insert) + len(self.pending_update) + len(self.pending_delete)
+
     @property
     def pending_upsert(self):
         return self.pending_insert.union(self.pending_update)
 
+    @property
+    def lazy(self):
+        return self.backend.lazy
+
+    @property
+    def conn(self):
+        return self.backend.conn
+
+    @property
+    def commit_log_size(self):
+        return self.backend.commit_log_size()
+
+    @property
+    def commit_log(self):
+        return self.backend.commit_log
+
+    def load_item(self, key, flags, exptime, data, encoding=compression.NONE):
+        NUM_KEYS.inc()
+        NUM_BYTES.inc(len(data))
+        self.data[key] = StorageItem(flags, exptime, data, encoding)
+        self.count_item(data)
+
+    def load_items(self, items):
+        # load_item for a list of (key, StorageItem) pairs
+        self.data.update(items)
+        sizes = [len(item.data) for _, item in items]
+        for size in sizes:
+            self.sizes[-(-size // SIZE_BUCKET) * SIZE_BUCKET] += 1
+        total = sum(sizes)
+        NUM_KEYS.inc(len(items))
+        NUM_BYTES.inc(total)
+        self.num_bytes += total
+
+    def count_item(self, data, sign=1):
+        size = len(data)
+        self.num_bytes += sign * size
+        self.sizes[-(-size // SIZE_BUCKET) * SIZE_BUCKET] += sign
+
+    def load(self, image_path=None):
+        # from the memory image while it's current, otherwise from the
+        # database, and then whatever was committed since. nothing loaded
+        # is garbage, so the collector is paused rather than left to scan
+        # the growing store over and over
+        gc.disable()
+        try:
+            if image_path and self.load_image(image_path):
+                self.backend.replay(self, after=self.commit_id)
+            else:
+                self.load_db()
+                self.sync_commit_log()
+        finally:
+            gc.enable()
+
     def load_db(self, conn=None):
-        conn = conn or self.conn
-        with conn:
-            c = conn.cursor()
-            c.execute('BEGIN')
-
-            c.execute(TABLE_SCHEMA)
-            c.execute(STATUS_SCHEMA)
-
-            c.execute('SELECT * FROM items')
-            rows = c.fetchall()
-            for row in rows:
-                NUM_KEYS.inc()
-                key, item = row[0], StorageItem(*row[1:])
-                self.data[key] = item
-                NUM_BYTES.inc(len(item.data))
-            logger.info('loaded {} rows from db'.format(len(rows)))
-
-            c.execute('SELECT commit_id FROM status WHERE id = 1')
-            row = c.fetchone()
-            if row:
-                commit_id = uuid.UUID(bytes=row[0])
-                self.commit_id = commit_id
-            logger.info('commit_id: {}'.format(self.commit_id))
-            c.execute('COMMIT')
+        self.commit_id = self.backend.load(self, conn)
+
+    @property
+    def images(self):
+        # a lazy store doesn't have every item to write out
+        return self.backend.images and not self.lazy
+
+    @property
+    def imaging(self):
+        return self.image_future is not None and not self.image_future.done()
+
+    def load_image(self, path):
+        # True if the store was loaded from the memory image at path. an
+        # image written before the last flush is older than the database,
+        # and the commits in between are gone from the commit log
+        if not self.images:
+            return False
+        start = time.perf_counter()
+        try:
+            img = image.read_image(path, StorageItem)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning('ignoring memory image {}: {}'.format(path, e))
+            return False
+        if img.flushed_commit_id != self.backend.flushed_commit_id():
+            logger.info('memory image {} is older than the database'.format(path))
+            return False
+
+        self.load_items(img.items)
+        self.pending_insert.update(img.inserts)
+        self.pending_update.update(img.updates)
+        self.pending_delete.update(img.deletes)
+        self.commit_id = img.commit_id
+        logger.info('loaded {} items from memory image {} in {:.3f}s, commit_id: {}'.format(
+            len(img.items), path, time.perf_counter() - start, self.commit_id))
+        return True
+
+    def image_state(self):
+        # everything write_image needs, copied so the store can change
+        # while the image is written
+        return (self.commit_id, self.backend.flushed_commit_id(), list(self.data.items()),
+                list(self.pending_insert), list(self.pending_update), list(self.pending_delete))
+
+    def write_image(self, path, state=None):
+        if not self.images:
+            return None
+        state = state or self.image_state()
+        start = time.perf_counter()
+        with IMAGE_ERRORS.count_exceptions():
+            image.write_image(path, *state)
+        elapsed = time.perf_counter() - start
+        IMAGE_DURATION.observe(elapsed)
+        logger.info('wrote {} items to memory image {} in {:.3f}s'.format(len(state[2]), path, elapsed))
+        return path
+
+    async def save_image(self, path, loop=None):
+        # write_image without blocking the loop. the future is shielded so
+        # shutdown can wait for it (see imaging) rather than leave a write
+        # running
+        if not self.images or self.imaging:
+            return None
+        loop = loop or asyncio.get_event_loop()
+        self.image_future = loop.run_in_executor(None, self.write_image, path, self.image_state())
+        return await asyncio.shield(self.image_future)
+
+    async def image_loop(self, path, interval=300, scheduler=None):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if scheduler is not None:
+                    await scheduler.maintenance()
+                try:
+                    await self.save_image(path)
+                except Exception as e:
+                    logger.exception('error writing memory image: {}'.format(e))
+
+        except asyncio.CancelledError as e:
+            logger.info('--cleanup--')
 
     def sync_commit_log(self, commit_log=None):
-        commit_log = commit_log or self.commit_log
-        # replay the commits from the log
-        for commit_id, command in self.load_commits(commit_log):
-            logger.info('replaying commit %s - %s', commit_id, command)
-            command.visit(self)
-            self.commit_id = commit_id
+        self.backend.replay(self, commit_log)
 
     def load_commits(self, commit_log=None):
         commit_log = commit_log or self.commit_log
-        commit_log.seek(0)
-        while True:
-            commit_id = commit_log.read(16)
-            if not commit_id:
-                break
-            commit_id = uuid.UUID(bytes=commit_id)
-            op = unpack(commit_log, '=H')[0]
-            for command in Command.__subclasses__():
-                if op == command.opcode:
-                    yield commit_id, command.unpack(commit_log)
+        for commit_id, command, _, _ in commitlog.read_commits(commit_log):
+            yield commit_id, command
 
     def dump_commit_log(self):
         logger.debug('commits log: %s', ['%s - %s' % (commit_id, command) for commit_id, command in self.load_commits()])
 
-    async def flush_loop(self, conn=None, timeout=10):
+    async def flush_loop(self, conn=None, timeout=10, scheduler=None, policy=None):
+        policy = policy or FlushPolicy(interval=timeout)
         try:
             while True:
-                await asyncio.sleep(timeout)
-                self.flush(conn)
+                await asyncio.sleep(policy.check_interval)
+                reason = policy.reason(self)
+                if reason is None:
+                    continue
+                if scheduler is not None:
+                    # let requests in flight finish first
+                    await scheduler.maintenance()
+                keys = self.dirty_keys
+                if self.flush(conn):
+                    policy.flushed(reason, keys, self.last_flush_seconds)
 
         except asyncio.CancelledError as e:
             logger.info('--cleanup--')
 
     def flush(self, conn=None, commit_log=None):
-        conn = conn or self.conn
-        commit_log = commit_log or self.commit_log
-
+        # True if anything was flushed
         if not self.dirty:
-            return
+            return False
+
+        if self.snapshotting:
+            # the snapshot relies on the commit log not being truncated
+            # underneath it; pending writes stay in the log until the
+            # next flush
+            logger.info('snapshot in progress, deferring flush')
+            return False
 
         NUM_DB_FLUSH.inc()
-        with FLUSH_DURATION.time():
+        start = time.perf_counter()
+        try:
             with FLUSH_ERRORS.count_exceptions():
-                self.save_db(conn)
+                self.backend.flush(self, conn, commit_log)
+                self.clear_pending()
+        finally:
+            elapsed = time.perf_counter() - start
+            FLUSH_DURATION.observe(elapsed)
+            self.flushes += 1
+            self.flush_seconds += elapsed
+            self.last_flush_seconds = elapsed
+        return True
 
-                # truncate commit log
-                commit_log.seek(0)
-                commit_log.truncate()
+    @property
+    def snapshotting(self):
+        if self.snapshot_running:
+            return True
+        return self.snapshot_task is not None and not self.snapshot_task.done()
+
+    def start_snapshot(self, name=None, loop=None):
+        if self.snapshotting:
+            raise RuntimeError('snapshot already in progress')
+        loop = loop or asyncio.get_event_loop()
+        name = os.path.basename(name or time.strftime('%Y%m%dT%H%M%S'))
+        path = os.path.join(self.snapshot_dir, name)
+        self.snapshot_task = loop.create_task(
+            self.snapshot(path, point=self.backend.snapshot_point(self), loop=loop))
+        self.snapshot_task.add_done_callback(self.snapshot_done)
+        return path
+
+    def snapshot_done(self, task):
+        # nothing awaits a started snapshot, so its failure is logged here
+        if not task.cancelled() and task.exception() is not None:
+            e = task.exception()
+            logger.error('snapshot failed: {}'.format(e), exc_info=(type(e), e, e.__traceback__))
+
+    async def snapshot(self, path, point=None, pages=SNAPSHOT_PAGES, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        point = point or self.backend.snapshot_point(self)
+        commit_id = point[0]
+        NUM_SNAPSHOTS.inc()
+        self.snapshot_running = True
+        try:
+            with SNAPSHOT_DURATION.time(), SNAPSHOT_ERRORS.count_exceptions():
+                os.makedirs(path)
+                logger.info('snapshot %s at commit %s', path, commit_id)
+
+                await self.backend.snapshot(self, path, point, pages, loop)
+        except Exception as e:
+            self.last_snapshot_error = {
+                'path': path,
+                'error': str(e),
+                'time': time.time(),
+            }
+            raise
+        finally:
+            self.snapshot_running = False
+
+        self.last_snapshot = {
+            'path': path,
+            'commit_id': str(commit_id) if commit_id else None,
+            'time': time.time(),
+        }
+        logger.info('snapshot %s complete', path)
+        return path
 
     def save_db(self, conn=None):
-        conn = conn or self.conn
-        with conn:
-            c = conn.cursor()
-            c.execute('BEGIN')
-
-            if self.pending_upsert:
-                values = []
-                for key in self.pending_upsert:
-                    NUM_DB_UPSERTS.inc()
-                    item = self.data[key]
-                    values.append((key, item.flags, item.exptime, item.data))
-                logger.debug('values to update: %s', values)
-                c.executemany('INSERT OR REPLACE INTO items (key, flags, exptime, data) VALUES (?, ?, ?, ?)', values)
-            else:
-                logger.debug('no values to update')
-
-
-            if self.pending_delete:
-                values = []
-                for key in self.pending_delete:
-                    NUM_DB_DELETES.inc()
-                    logger.debug(key.decode())
-                    values.append((key,))
-                logger.debug('keys to delete: %s', values)
-                c.executemany('DELETE FROM items WHERE key = ?', values)
-            else:
-                logger.debug('no keys to delete')
-
-            logger.debug('saving commit %s', self.commit_id)
-            c.execute('INSERT OR REPLACE INTO status (id, commit_id) VALUES (1, ?)', (self.commit_id.bytes,))
-
-            c.execute('COMMIT')
+        self.backend.save(self, conn)
+        self.clear_pending()
 
+    def clear_pending(self):
+        self.dirty_bytes = 0
         self.pending_insert.clear()
         self.pending_update.clear()
         self.pending_delete.clear()
@@ -184,28 +359,44 @@ class Store(MutableMapping):
         ret = command.visit(self)
         if command.opcode:
             NUM_COMMITS.inc()
-            self.commit(command.opcode, command.pack())
+            try:
+                self.commit(command.opcode, command.pack_parts())
+            finally:
+                # the item has changed in memory even if the commit failed
+                if command.tombstone:
+                    self.versions.pop(command.key, None)
+                else:
+                    self.versions[command.key] = (self.version, self.modified)
         return ret
 
-    @COMMIT_DURATION.time()
+    def key_version(self, key):
+        # keys untouched since startup are all at version 0
+        return self.versions.get(key, (0, self.started))
+
     @COMMIT_ERRORS.count_exceptions()
     def commit(self, opcode, data):
+        start = time.perf_counter()
         self.commit_id = uuid.uuid1()
+        self.version += 1
+        self.modified = time.time()
         logger.info('commiting {}'.format(self.commit_id))
-        self.commit_log.write(self.commit_id.bytes)
-        self.commit_log.write(struct.pack('=H', opcode))
-        self.commit_log.write(data)
-        self.commit_log.flush()
+        self.dirty_bytes += sum(len(part) for part in commitlog.record_parts(data))
         try:
-            os.fsync(self.commit_log.fileno())
-        except IOError as e:
-            logger.exception('error syncing commit file')
+            self.backend.append(self.commit_id, opcode, data)
+        finally:
+            elapsed = time.perf_counter() - start
+            COMMIT_DURATION.observe(elapsed)
+            slowlog.add_commit_time(elapsed)
 
     def __setitem__(self, key, value):
         assert isinstance(value, StorageItem)
         if key not in self.data:
             NUM_KEYS.inc()
-            if key not in self.pending_delete:
+            if self.lazy and key not in self.pending_delete and self.backend.may_contain(key):
+                # the key may be in the database without having been read
+                # yet. an upsert is right either way, and saves the read
+                self.pending_update.add(key)
+            elif key not in self.pending_delete:
                 # this means that the key did not exist in the
                 # database, so we want to put it in pending insert
                 self.pending_insert.add(key)
@@ -223,18 +414,33 @@ class Store(MutableMapping):
                 # need to mark the key as pending update
                 self.pending_update.add(key)
             NUM_BYTES.dec(len(self.data[key].data))
+            self.count_item(self.data[key].data, -1)
         NUM_BYTES.inc(len(value.data))
+        self.count_item(value.data)
         self.data[key] = value
+        if self.value_cache is not None:
+            self.value_cache.discard(key)
 
     def __getitem__(self, key):
+        try:
+            return self.data[key]
+        except KeyError:
+            if not self.lazy or key in self.pending_delete:
+                raise
+        # read through, and keep the item for next time
+        row = self.backend.fetch(key)
+        if row is None:
+            raise KeyError(key)
+        self.load_item(key, *row)
         return self.data[key]
 
     def __delitem__(self, key):
-        value = self.data[key]
+        value = self[key]
         if key not in self.pending_insert:
             # this key was from the database, so much
             # delete it from the db
             self.pending_delete.add(key)
+            self.pending_update.discard(key)
         else:
             # this key was not in the database and was
             # pending insert, so we simply remove it from
@@ -242,13 +448,25 @@ class Store(MutableMapping):
             self.pending_insert.remove(key)
         NUM_KEYS.dec()
         NUM_BYTES.dec(len(value.data))
+        self.count_item(value.data, -1)
         del self.data[key]
+        if self.value_cache is not None:
+            self.value_cache.discard(key)
 
     def __iter__(self):
-        return iter(self.data)
+        if not self.lazy:
+            return iter(self.data)
+        return itertools.chain(self.data, (
+            key for key in self.backend.keys()
+            if key not in self.data and key not in self.pending_delete))
 
     def __len__(self):
-        return len(self.data)
+        if not self.lazy:
+            return len(self.data)
+        # scans the database
+        return sum(1 for _ in self)
 
     def keys(self):
-        return self.data.keys()
+        if not self.lazy:
+            return self.data.keys()
+        return KeysView(self)
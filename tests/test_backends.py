@@ -0,0 +1,145 @@
+import pytest
+
+from backends import LogBackend
+from backends.log import DATA_EXT, HINT_EXT
+import commands
+import store
+
+import os
+
+
+def make_store(path, **kwargs):
+    s = store.Store(LogBackend(str(path), **kwargs))
+    s.load_db()
+    s.sync_commit_log()
+    return s
+
+def files(path, ext):
+    return sorted(name for name in os.listdir(str(path)) if name.endswith(ext))
+
+def assert_store_equal(s1, s2):
+    assert len(s2) == len(s1)
+    for key in s1:
+        assert s2[key] == s1[key]
+
+def fill(s, num_keys, version):
+    for i in range(num_keys):
+        s.apply(commands.SetCommand(b'key_%d' % i, i, 0, b'value_%d_%d' % (i, version)))
+
+def test_log_backend_reload(tmp_path):
+    s1 = make_store(tmp_path)
+    fill(s1, 10, 1)
+    fill(s1, 5, 2)
+    s1.apply(commands.DeleteCommand(b'key_9'))
+    s1.flush()
+    assert not s1.dirty
+    s1.backend.close()
+
+    s2 = make_store(tmp_path)
+    assert s2.commit_id == s1.commit_id
+    assert s2[b'key_0'].data == b'value_0_2'
+    assert s2[b'key_7'].data == b'value_7_1'
+    assert b'key_9' not in s2
+    assert_store_equal(s1, s2)
+
+def test_log_backend_rotate_hint(tmp_path):
+    s1 = make_store(tmp_path, max_file_size=1)
+    fill(s1, 10, 1)
+    s1.flush()
+    fill(s1, 5, 2)
+    s1.apply(commands.DeleteCommand(b'key_9'))
+    s1.flush()
+    s1.apply(commands.DeleteCommand(b'key_8'))
+    assert files(tmp_path, DATA_EXT) == ['00000001.data', '00000002.data', '00000003.data']
+    assert files(tmp_path, HINT_EXT) == ['00000001.hint', '00000002.hint']
+    s1.backend.close()
+
+    s2 = make_store(tmp_path)
+    assert s2.commit_id == s1.commit_id
+    assert_store_equal(s1, s2)
+    assert s2.backend.keydir == s1.backend.keydir
+
+@pytest.mark.asyncio
+async def test_log_backend_merge(tmp_path):
+    s1 = make_store(tmp_path, max_file_size=1)
+    for version in range(3):
+        fill(s1, 10, version)
+        s1.apply(commands.DeleteCommand(b'key_%d' % version))
+        s1.flush()
+    s1.apply(commands.SetCommand(b'key_0', 0, 0, b'active'))
+    sizes = sum(os.path.getsize(str(tmp_path / name)) for name in files(tmp_path, DATA_EXT))
+
+    await s1.backend.compact(s1)
+    assert files(tmp_path, DATA_EXT) == ['00000003.data', '00000004.data']
+    assert files(tmp_path, HINT_EXT) == ['00000003.hint']
+    assert sum(os.path.getsize(str(tmp_path / name)) for name in files(tmp_path, DATA_EXT)) < sizes
+    assert_store_equal(s1, make_store(tmp_path))
+
+    # keys updated after the merge still point at the active file
+    assert s1.backend.keydir[b'key_0'].file_id == 4
+    s1.backend.close()
+
+    s2 = make_store(tmp_path)
+    assert s2.commit_id == s1.commit_id
+    assert_store_equal(s1, s2)
+
+class Crash(Exception):
+    pass
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('crash_at', ['00000002.hint', '00000001.data', 'merge.manifest'])
+async def test_log_backend_merge_crash(tmp_path, monkeypatch, crash_at):
+    s1 = make_store(tmp_path, max_file_size=1)
+    s1.apply(commands.SetCommand(b'deleted', 0, 0, b'value'))
+    fill(s1, 3, 1)
+    s1.flush()
+    s1.apply(commands.DeleteCommand(b'deleted'))
+    fill(s1, 3, 2)
+    s1.flush()
+    s1.apply(commands.SetCommand(b'key_0', 0, 0, b'active'))
+
+    remove = os.remove
+    def crashing_remove(path):
+        if os.path.basename(path) == crash_at:
+            raise Crash(path)
+        remove(path)
+    monkeypatch.setattr(os, 'remove', crashing_remove)
+    with pytest.raises(Crash):
+        await s1.backend.compact(s1)
+    monkeypatch.setattr(os, 'remove', remove)
+    s1.backend.close()
+
+    # the next start finishes the swap rather than loading the older
+    # files alongside the merged one, which has no tombstones
+    s2 = make_store(tmp_path)
+    assert b'deleted' not in s2
+    assert s2[b'key_0'].data == b'active'
+    assert s2[b'key_2'].data == b'value_2_2'
+    assert files(tmp_path, DATA_EXT) == ['00000002.data', '00000003.data']
+    assert files(tmp_path, HINT_EXT) == ['00000002.hint']
+    assert not files(tmp_path, '.manifest')
+
+def test_log_backend_incomplete_merge(tmp_path):
+    s1 = make_store(tmp_path, max_file_size=1)
+    fill(s1, 3, 1)
+    s1.flush()
+    # merge output from before a crash, with no manifest to say it was done
+    (tmp_path / '00000001.merge').write_bytes(b'partial')
+    s1.backend.close()
+
+    s2 = make_store(tmp_path)
+    assert_store_equal(s1, s2)
+    assert not files(tmp_path, '.merge')
+
+@pytest.mark.asyncio
+async def test_log_backend_snapshot(tmp_path):
+    os.mkdir(str(tmp_path / 'data'))
+    s1 = make_store(tmp_path / 'data', max_file_size=1)
+    fill(s1, 10, 1)
+    s1.flush()
+    fill(s1, 5, 2)
+
+    path = await s1.snapshot(str(tmp_path / 'snap'))
+    s2 = make_store(path)
+    assert s2.commit_id == s1.commit_id
+    assert_store_equal(s1, s2)
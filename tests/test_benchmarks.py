@@ -0,0 +1,63 @@
+import os
+
+from click.testing import CliRunner
+
+from benchmarks import harness, suite
+
+
+def result(ops_per_sec, p99):
+    return {'ops_per_sec': ops_per_sec, 'latency_us': {'p99': p99}}
+
+def test_percentile():
+    samples = list(range(1, 101))
+    assert harness.percentile(samples, 50) == 50
+    assert harness.percentile(samples, 99) == 99
+    assert harness.percentile(samples, 99.9) == 100
+    assert harness.percentile([7], 50) == 7
+    assert harness.percentile([], 50) == 0.0
+
+def test_summarize():
+    summary = harness.summarize([0.5, 0.25, 0.25], items=10)
+    assert summary['ops'] == 30
+    assert summary['ops_per_sec'] == 30
+    assert summary['latency_us']['p50'] == 0.25e6
+    assert summary['latency_us']['max'] == 0.5e6
+
+def test_compare():
+    baseline = {
+        'fast': result(1000, 100),
+        'slow': result(1000, 100),
+        'laggy': result(1000, 100),
+        'jitter': result(1000, 0.2),
+    }
+    results = {
+        'fast': result(1200, 90),
+        'slow': result(700, 100),
+        'laggy': result(1000, 200),
+        'jitter': result(1000, 0.4),
+        'new': result(1, 1),
+    }
+    regressions = harness.compare(results, baseline, 0.25)
+    assert len(regressions) == 2
+    assert regressions[0].startswith('laggy: p99')
+    assert regressions[1].startswith('slow: 700 ops/s')
+
+def test_missing_baseline(tmpdir, monkeypatch):
+    monkeypatch.setattr(suite, 'run', lambda names, quick: {'fast': result(1000, 100)})
+    monkeypatch.setattr(suite, 'do_configure_logging', lambda config: None)
+    baseline = str(tmpdir.join('baseline.json'))
+    output = str(tmpdir.join('out.json'))
+
+    outcome = CliRunner().invoke(suite.main, ['-o', output, '--baseline', baseline])
+    assert outcome.exit_code == 0
+    assert 'WARNING: no baseline' in outcome.output
+
+    outcome = CliRunner().invoke(suite.main, ['-o', output, '--baseline', baseline, '--require-baseline'])
+    assert outcome.exit_code == 1
+    assert 'WARNING: no baseline' in outcome.output
+
+    CliRunner().invoke(suite.main, ['--baseline', baseline, '--save-baseline'])
+    assert os.path.exists(baseline)
+    outcome = CliRunner().invoke(suite.main, ['-o', output, '--baseline', baseline, '--require-baseline'])
+    assert outcome.exit_code == 0
+    assert 'no regressions' in outcome.output
@@ -0,0 +1,31 @@
+import pytest
+
+import bloom
+
+
+def test_no_false_negatives():
+    f = bloom.BloomFilter(1000)
+    keys = [b'key_%d' % i for i in range(1000)]
+    for key in keys:
+        f.add(key)
+    assert all(key in f for key in keys)
+
+def test_false_positive_rate():
+    f = bloom.BloomFilter(10000, error_rate=0.01)
+    for i in range(10000):
+        f.add(b'key_%d' % i)
+    false_positives = sum(b'other_%d' % i in f for i in range(10000))
+    assert false_positives < 200
+
+def test_empty():
+    f = bloom.BloomFilter(0)
+    assert b'key' not in f
+
+def test_update_matches_add():
+    keys = [b'key_%d' % i for i in range(100)]
+    f1 = bloom.BloomFilter(100)
+    f2 = bloom.BloomFilter(100)
+    for key in keys:
+        f1.add(key)
+    f2.update(keys)
+    assert f1.bits == f2.bits
@@ -0,0 +1,125 @@
+import pytest
+
+import capture
+
+import asyncio
+import os
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'capture')
+    clock = FakeClock()
+    cap = capture.Capture(path, max_value=4, clock=clock)
+    cap.opened(1)
+    clock.now = 0.5
+    cap.line(1, b'set foo 0 0 10\r\n')
+    cap.value(1, 10, b'0123456789')
+    clock.now = 1.5
+    cap.closed(1)
+    cap.close()
+    assert cap.info()['records'] == 4
+
+    with open(path, 'rb') as f:
+        assert list(capture.read_records(f)) == [
+            (capture.OPEN, 0.0, 1, 0, b''),
+            (capture.LINE, 0.5, 1, 16, b'set foo 0 0 10\r\n'),
+            # truncated, but the size is kept
+            (capture.VALUE, 0.5, 1, 10, b'0123'),
+            (capture.CLOSE, 1.5, 1, 0, b''),
+        ]
+
+def test_truncated_file(tmp_path):
+    path = str(tmp_path / 'capture')
+    cap = capture.Capture(path)
+    cap.line(1, b'get foo\r\n')
+    cap.line(1, b'get bar\r\n')
+    cap.close()
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+    with open(path, 'rb') as f:
+        assert [data for _, _, _, _, data in capture.read_records(f)] == [b'get foo\r\n']
+
+def test_not_a_capture(tmp_path):
+    path = tmp_path / 'capture'
+    path.write_bytes(b'nonsense')
+    with open(str(path), 'rb') as f:
+        with pytest.raises(ValueError):
+            list(capture.read_records(f))
+
+@pytest.mark.asyncio
+async def test_server_capture(server, tmp_path):
+    server.capture_dir = str(tmp_path)
+    listener = await asyncio.start_server(server.handler, '127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    writer.write(b'capture start test\r\n')
+    assert await reader.readline() == b'OK %s\r\n' % os.path.join(str(tmp_path), 'test').encode()
+    writer.write(b'capture start test\r\n')
+    assert await reader.readline() == b'SERVER_ERROR capture already running\r\n'
+    other_reader, other_writer = await asyncio.open_connection('127.0.0.1', port)
+    other_writer.write(b'set foo 0 0 3\r\nbar\r\n')
+    assert await other_reader.readline() == b'STORED\r\n'
+    other_writer.close()
+    await asyncio.sleep(0.05)
+    writer.write(b'capture stop\r\n')
+    assert (await reader.readline()).startswith(b'OK ')
+    writer.close()
+    listener.close()
+    await listener.wait_closed()
+
+    with open(str(tmp_path / 'test'), 'rb') as f:
+        records = [(kind, data) for kind, _, _, _, data in capture.read_records(f)]
+    # not the capture commands themselves
+    assert records == [
+        (capture.OPEN, b''),
+        (capture.LINE, b'set foo 0 0 3\r\n'),
+        (capture.VALUE, b'bar'),
+        (capture.CLOSE, b''),
+    ]
+
+def test_admin_commands_skipped(tmp_path):
+    path = str(tmp_path / 'capture')
+    cap = capture.Capture(path)
+    for line in (b'stats\r\n', b'SNAPSHOT name\r\n', b'slowlog get 10\r\n', b'get foo\r\n', b'\r\n'):
+        cap.line(1, line)
+    cap.close()
+    with open(path, 'rb') as f:
+        assert [data for _, _, _, _, data in capture.read_records(f)] == [b'get foo\r\n', b'\r\n']
+
+@pytest.mark.asyncio
+async def test_capture_starts_between_requests(server, tmp_path):
+    server.capture_dir = str(tmp_path)
+    server.stream_size = 4
+    listener = await asyncio.start_server(server.handler, '127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    admin_reader, admin_writer = await asyncio.open_connection('127.0.0.1', port)
+
+    # the set's line is read before the capture starts, its value after
+    writer.write(b'set foo 0 0 10\r\n01234')
+    await asyncio.sleep(0.05)
+    admin_writer.write(b'capture start test\r\n')
+    await admin_reader.readline()
+    writer.write(b'56789\r\nget foo\r\n')
+    assert await reader.readline() == b'STORED\r\n'
+    await reader.readline()
+    admin_writer.write(b'capture stop\r\n')
+    await admin_reader.readline()
+    for w in (writer, admin_writer):
+        w.close()
+    listener.close()
+    await listener.wait_closed()
+
+    with open(str(tmp_path / 'test'), 'rb') as f:
+        records = [(kind, data) for kind, _, _, _, data in capture.read_records(f)]
+    # nothing of the set, which started first
+    assert records == [(capture.LINE, b'get foo\r\n')]
@@ -0,0 +1,119 @@
+import pytest
+
+import client
+from client.hashring import HashRing
+from server import MemcacheServer
+from store import Store
+
+import asyncio
+import io
+import sqlite3
+import threading
+
+
+def make_server():
+    s = Store(sqlite3.connect(':memory:', check_same_thread=False), io.BytesIO())
+    s.backend.fsync = False
+    s.load_db()
+    return MemcacheServer(s)
+
+async def start(num_servers):
+    servers, listeners, addresses = [], [], []
+    for _ in range(num_servers):
+        server = make_server()
+        listener = await asyncio.start_server(server.handler, '127.0.0.1', 0)
+        servers.append(server)
+        listeners.append(listener)
+        addresses.append(listener.sockets[0].getsockname()[:2])
+    return servers, listeners, addresses
+
+async def stop(listeners):
+    for listener in listeners:
+        listener.close()
+        await listener.wait_closed()
+    await asyncio.sleep(0.05)
+
+def test_hash_ring_distribution():
+    servers = [('10.0.0.%d' % i, 11211) for i in range(4)]
+    ring = HashRing(servers)
+    keys = [b'key_%d' % i for i in range(10000)]
+    counts = {server: len(group) for server, group in ring.group(keys).items()}
+    assert len(counts) == 4
+    assert min(counts.values()) > 1500
+
+def test_hash_ring_stability():
+    servers = [('10.0.0.%d' % i, 11211) for i in range(4)]
+    keys = [b'key_%d' % i for i in range(10000)]
+    before = HashRing(servers)
+    after = HashRing(servers + [('10.0.0.4', 11211)])
+    moved = [key for key in keys if before.get(key) != after.get(key)]
+    # only keys taken by the new server move
+    assert all(after.get(key) == ('10.0.0.4', 11211) for key in moved)
+    assert len(moved) < 10000 * 0.3
+
+@pytest.mark.asyncio
+async def test_async_client():
+    servers, listeners, addresses = await start(2)
+    async with client.AsyncClient(addresses) as c:
+        assert await c.set('foo', 'bar')
+        assert await c.get('foo') == b'bar'
+        assert await c.get('missing') is None
+        assert await c.delete('foo')
+        assert not await c.delete('foo')
+
+        items = {b'key_%d' % i: b'value_%d' % i for i in range(100)}
+        assert all((await c.set_many(items)).values())
+        assert await c.get_many(list(items) + [b'missing']) == items
+        # keys are spread over both servers
+        assert all(len(server.store) > 10 for server in servers)
+        assert sorted(await c.delete_many([b'key_0', b'missing'])) == [b'key_0', b'missing']
+
+        with pytest.raises(client.ClientError):
+            await c.get(b'bad key')
+    await stop(listeners)
+
+@pytest.mark.asyncio
+async def test_async_client_pipelining():
+    servers, listeners, addresses = await start(1)
+    async with client.AsyncClient(addresses, pool_size=2) as c:
+        values = await asyncio.gather(*(c.set(b'key_%d' % i, b'%d' % i) for i in range(200)))
+        assert all(values)
+        values = await asyncio.gather(*(c.get(b'key_%d' % i) for i in range(200)))
+        assert values == [b'%d' % i for i in range(200)]
+        # concurrent requests share the pool's connections
+        assert len(servers[0].connections) == 2
+    await stop(listeners)
+
+@pytest.mark.asyncio
+async def test_async_client_reconnects():
+    servers, listeners, addresses = await start(1)
+    async with client.AsyncClient(addresses, pool_size=1) as c:
+        await c.set(b'key', b'value')
+        for writer in list(servers[0].connections):
+            writer.close()
+        await asyncio.sleep(0.05)
+        assert await c.get(b'key') == b'value'
+    await stop(listeners)
+
+def test_sync_client():
+    loop = asyncio.new_event_loop()
+    servers, listeners, addresses = loop.run_until_complete(start(2))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        with client.Client(addresses) as c:
+            assert c.set('foo', 'bar')
+            assert c.get('foo') == b'bar'
+            assert c.get('missing') is None
+            assert c.delete('foo')
+            assert not c.delete('foo')
+
+            items = {b'key_%d' % i: b'value_%d' % i for i in range(100)}
+            assert all(c.set_many(items).values())
+            assert c.get_many(list(items) + [b'missing']) == items
+            assert all(len(server.store) > 10 for server in servers)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(stop(listeners))
+        loop.close()
@@ -18,6 +18,19 @@ def test_pack_unpack():
     c = commands.DeleteCommand.unpack(f)
     assert delete_cmd.key == c.key
 
+def test_pack_parts():
+    value = bytearray(b'some_value')
+    set_cmd = commands.EncodedSetCommand(b'some_key', 1, 2, value, 1)
+    parts = set_cmd.pack_parts()
+    # the data isn't copied into the record
+    assert parts[1] is value
+    assert b''.join(parts) == set_cmd.pack()
+    c = commands.EncodedSetCommand.unpack(io.BytesIO(set_cmd.pack()))
+    assert (c.key, c.data, c.encoding) == (b'some_key', b'some_value', 1)
+
+    delete_cmd = commands.DeleteCommand(b'some_key')
+    assert delete_cmd.pack_parts() == (delete_cmd.pack(),)
+
 def test_set_cmd():
     key = b'some_key'
     value = b'some_value'
@@ -0,0 +1,132 @@
+import pytest
+
+import commands
+import compaction
+import store
+
+import asyncio
+import os
+import sqlite3
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def sleeps(monkeypatch):
+    sleeps = []
+    real_sleep = asyncio.sleep
+    async def sleep(delay):
+        sleeps.append(delay)
+        await real_sleep(0)
+    monkeypatch.setattr(compaction.asyncio, 'sleep', sleep)
+    return sleeps
+
+@pytest.fixture()
+def file_store(tmp_path):
+    conn = sqlite3.connect(':memory:')
+    commit_log = open(str(tmp_path / 'commit.log'), 'a+b')
+    s = store.Store(conn, commit_log)
+    s.backend.compaction_min_size = 0
+    s.load_db()
+    return s
+
+def reload(s):
+    s2 = store.Store(s.conn, s.commit_log)
+    s2.load_db()
+    s2.sync_commit_log()
+    return s2
+
+def log_size(s):
+    return os.path.getsize(s.commit_log.name)
+
+@pytest.mark.asyncio
+async def test_rate_limiter(sleeps):
+    clock = FakeClock()
+    limiter = compaction.RateLimiter(1000, burst=1000, clock=clock)
+
+    await limiter.throttle(500)
+    await limiter.throttle(500)
+    assert sleeps == [0, 0]
+
+    # out of tokens, so wait for the overdraft to refill
+    await limiter.throttle(500)
+    assert sleeps[-1] == pytest.approx(0.5)
+
+    clock.now += 2
+    await limiter.throttle(500)
+    assert sleeps[-1] == 0
+
+@pytest.mark.asyncio
+async def test_rate_limiter_unlimited(sleeps):
+    limiter = compaction.RateLimiter(0)
+    await limiter.throttle(10 ** 9)
+    assert sleeps == [0]
+
+@pytest.mark.asyncio
+async def test_compact_commit_log(file_store):
+    s1 = file_store
+    s1.apply(commands.SetCommand(b'saved', 0, 0, b'value'))
+    s1.apply(commands.SetCommand(b'removed', 0, 0, b'value'))
+    s1.flush()
+
+    for i in range(100):
+        s1.apply(commands.SetCommand(b'hot', 0, 0, b'value_%d' % i))
+    s1.apply(commands.SetCommand(b'transient', 0, 0, b'value'))
+    s1.apply(commands.DeleteCommand(b'transient'))
+    s1.apply(commands.DeleteCommand(b'removed'))
+    before = log_size(s1)
+
+    await s1.backend.compact(s1)
+    assert log_size(s1) < before / 10
+
+    commits = list(s1.load_commits())
+    assert len(commits) == 2
+    assert commits[-1][0] == s1.commit_id
+
+    s2 = reload(s1)
+    assert sorted(s2.keys()) == sorted(s1.keys()) == [b'hot', b'saved']
+    assert s2[b'hot'].data == b'value_99'
+
+    # the store keeps appending to the new file
+    s1.apply(commands.SetCommand(b'after', 0, 0, b'value'))
+    assert reload(s1)[b'after'].data == b'value'
+
+@pytest.mark.asyncio
+async def test_compact_keeps_tail(file_store, monkeypatch):
+    s1 = file_store
+    for i in range(100):
+        s1.apply(commands.SetCommand(b'key', 0, 0, b'value_%d' % i))
+
+    # commits that land while compaction is yielding to the loop
+    async def throttle(nbytes):
+        s1.apply(commands.SetCommand(b'during', 0, 0, b'value'))
+    monkeypatch.setattr(s1.backend.limiter, 'throttle', throttle)
+    monkeypatch.setattr('backends.sqlite.CHUNK', 1)
+
+    await s1.backend.compact(s1)
+    s2 = reload(s1)
+    assert s2[b'key'].data == b'value_99'
+    assert s2[b'during'].data == b'value'
+    assert s2.commit_id == s1.commit_id
+
+@pytest.mark.asyncio
+async def test_compact_aborts_after_flush(file_store, monkeypatch):
+    s1 = file_store
+    for i in range(100):
+        s1.apply(commands.SetCommand(b'key', 0, 0, b'value_%d' % i))
+
+    async def throttle(nbytes):
+        s1.flush()
+        s1.apply(commands.SetCommand(b'after_flush', 0, 0, b'value'))
+    monkeypatch.setattr(s1.backend.limiter, 'throttle', throttle)
+    monkeypatch.setattr('backends.sqlite.CHUNK', 1)
+
+    await s1.backend.compact(s1)
+    assert [command.key for _, command in s1.load_commits()] == [b'after_flush']
+    assert not os.path.exists(s1.commit_log.name + '.compact')
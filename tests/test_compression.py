@@ -0,0 +1,101 @@
+import pytest
+
+from backends import LogBackend
+import commands
+import compression
+import store
+
+import io
+import sqlite3
+
+
+VALUE = b'{"some": "json", "that": "compresses"}' * 100
+
+
+@pytest.fixture()
+def compressor():
+    return compression.Compressor(threshold=100)
+
+def test_compress_threshold(compressor):
+    encoding, data = compressor.compress(b'small')
+    assert encoding == compression.NONE
+    assert data == b'small'
+
+    encoding, data = compressor.compress(VALUE)
+    assert encoding == compression.ZLIB
+    assert len(data) < len(VALUE)
+    assert compressor.decompress(store.StorageItem(0, 0, data, encoding)) == VALUE
+
+def test_compress_incompressible(compressor):
+    value = bytes(range(256))
+    encoding, data = compressor.compress(value)
+    assert encoding == compression.NONE
+    assert data == value
+
+def test_compress_disabled():
+    encoding, data = compression.Compressor().compress(VALUE)
+    assert encoding == compression.NONE
+    assert data == VALUE
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        compression.Compressor('brotli')
+
+def test_missing_codec(monkeypatch):
+    monkeypatch.setattr(compression, 'lz4', None)
+    assert compression.Compressor('lz4').codec == 'zlib'
+
+def test_encoded_set_pack_unpack(compressor):
+    encoding, data = compressor.compress(VALUE)
+    cmd = commands.SetCommand.create(b'key', 1, 2, data, encoding)
+    assert type(cmd) == commands.EncodedSetCommand
+
+    s = store.Store(sqlite3.connect(':memory:'), io.BytesIO())
+    s.commit(cmd.opcode, cmd.pack())
+    (_, c), = s.load_commits()
+    assert type(c) == commands.EncodedSetCommand
+    assert (c.key, c.flags, c.exptime, c.data, c.encoding) == (b'key', 1, 2, data, encoding)
+
+def assert_roundtrip(s1, s2, compressor):
+    assert s2[b'big'].encoding == compression.ZLIB
+    assert s2[b'big'].data == s1[b'big'].data
+    assert compressor.decompress(s2[b'big']) == VALUE
+    assert s2[b'small'].encoding == compression.NONE
+
+def test_store_compressed_items(s1, conn, commit_log, compressor):
+    for key, value in ((b'big', VALUE), (b'small', b'value')):
+        encoding, data = compressor.compress(value)
+        s1.apply(commands.SetCommand.create(key, 0, 0, data, encoding))
+
+    # replayed from the commit log
+    s2 = store.Store(conn, commit_log)
+    s2.load_db()
+    s2.sync_commit_log()
+    assert_roundtrip(s1, s2, compressor)
+
+    # loaded from the database
+    s1.flush()
+    s3 = store.Store(conn, commit_log)
+    s3.load_db()
+    assert_roundtrip(s1, s3, compressor)
+
+def test_log_backend_compressed_items(tmp_path, compressor):
+    s1 = store.Store(LogBackend(str(tmp_path)))
+    s1.load_db()
+    for key, value in ((b'big', VALUE), (b'small', b'value')):
+        encoding, data = compressor.compress(value)
+        s1.apply(commands.SetCommand.create(key, 0, 0, data, encoding))
+    s1.backend.close()
+
+    s2 = store.Store(LogBackend(str(tmp_path)))
+    s2.load_db()
+    assert_roundtrip(s1, s2, compressor)
+
+def test_schema_migration(conn, commit_log):
+    conn.execute('CREATE TABLE items (key TEXT PRIMARY KEY, flags INTEGER, exptime INTEGER, data BLOB)')
+    conn.execute('INSERT INTO items VALUES (?, 1, 2, ?)', (b'old', b'value'))
+    conn.commit()
+
+    s = store.Store(conn, commit_log)
+    s.load_db()
+    assert s[b'old'] == store.StorageItem(1, 2, b'value', compression.NONE)
@@ -0,0 +1,93 @@
+import pytest
+
+import commands
+import database
+import store
+
+import sqlite3
+
+
+def test_connect_pragmas(tmp_path):
+    conn = database.connect(str(tmp_path / 'db.sqlite'), synchronous=False, mmap_size=1024 * 1024)
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert conn.execute('PRAGMA synchronous').fetchone()[0] == 0
+    assert conn.execute('PRAGMA cache_size').fetchone()[0] == database.CACHE_SIZE
+
+def test_connect_invalid_mode(tmp_path):
+    with pytest.raises(ValueError):
+        database.connect(str(tmp_path / 'db.sqlite'), synchronous='sometimes')
+
+def test_connect_bare_on(tmp_path):
+    with pytest.raises(ValueError) as e:
+        database.connect(str(tmp_path / 'db.sqlite'), synchronous=True)
+    assert 'quote' in str(e.value)
+
+def test_chunks():
+    assert list(database.chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(database.chunks(range(5), None)) == [[0, 1, 2, 3, 4]]
+    assert list(database.chunks([], 2)) == []
+
+@pytest.mark.parametrize('without_rowid', [False, True])
+def test_save_db_batches(tmp_path, commit_log, without_rowid):
+    conn = database.connect(str(tmp_path / 'db.sqlite'))
+    s1 = store.Store(conn, commit_log, batch_size=3, without_rowid=without_rowid)
+    s1.load_db()
+
+    for i in range(10):
+        s1.apply(commands.SetCommand(b'key_%d' % i, i, 0, b'value_%d' % i))
+    s1.flush()
+    for i in range(5):
+        s1.apply(commands.SetCommand(b'key_%d' % i, i, 0, b'updated_%d' % i))
+    for i in range(5, 8):
+        s1.apply(commands.DeleteCommand(b'key_%d' % i))
+    s1.flush()
+
+    s2 = store.Store(conn, commit_log)
+    s2.load_db()
+    assert s2.commit_id == s1.commit_id
+    assert sorted(s2.keys()) == sorted(s1.keys())
+    for key in s1:
+        assert s2[key] == s1[key]
+
+def test_replay_after_partial_flush(s1, conn, commit_log):
+    s1.apply(commands.SetCommand(b'key', 0, 0, b'value'))
+    s1.flush()
+    s1.apply(commands.DeleteCommand(b'key'))
+
+    # the delete made it to the database but the log was never truncated
+    conn.execute(database.DELETE, (b'key',))
+    conn.commit()
+
+    s2 = store.Store(conn, commit_log)
+    s2.load_db()
+    s2.sync_commit_log()
+    assert b'key' not in s2
+    assert s2.commit_id == s1.commit_id
+
+def test_connect_default_synchronous(tmp_path):
+    conn = database.connect(str(tmp_path / 'db.sqlite'))
+    # full
+    assert conn.execute('PRAGMA synchronous').fetchone()[0] == 2
+
+def test_flush_checkpoints_wal(tmp_path, commit_log):
+    path = str(tmp_path / 'db.sqlite')
+    conn = database.connect(path, synchronous='normal')
+    s1 = store.Store(conn, commit_log)
+    s1.load_db()
+    s1.apply(commands.SetCommand(b'key', 0, 0, b'value'))
+
+    # a reader holding an older snapshot keeps the checkpoint from
+    # finishing, so the commit log has to stay
+    reader = sqlite3.connect(path)
+    reader.execute('BEGIN')
+    reader.execute(database.COUNT).fetchone()
+    s1.flush()
+    assert [command.key for _, command in s1.load_commits()] == [b'key']
+
+    reader.rollback()
+    s1.apply(commands.SetCommand(b'other', 0, 0, b'value'))
+    s1.flush()
+    assert list(s1.load_commits()) == []
+    # everything made it from the wal into the database file
+    _, frames, checkpointed = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    assert frames == checkpointed
@@ -0,0 +1,100 @@
+import pytest
+
+from backends import LogBackend
+import commands
+import flushpolicy
+import store
+
+import asyncio
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def set_keys(s, n, size=10, prefix=b'key'):
+    for i in range(n):
+        s.apply(commands.SetCommand(b'%s_%d' % (prefix, i), 0, 0, b'x' * size))
+
+def test_nothing_to_flush(s1):
+    clock = FakeClock()
+    policy = flushpolicy.FlushPolicy(interval=10, clock=clock)
+    clock.now += 100
+    assert policy.reason(s1) is None
+
+def test_interval(s1):
+    clock = FakeClock()
+    policy = flushpolicy.FlushPolicy(interval=10, clock=clock)
+    set_keys(s1, 1)
+    assert policy.reason(s1) is None
+    clock.now += 10
+    assert policy.reason(s1) == 'interval'
+
+def test_dirty_keys(s1):
+    policy = flushpolicy.FlushPolicy(max_dirty_keys=5, min_dirty_keys=1, clock=FakeClock())
+    set_keys(s1, 4)
+    assert policy.reason(s1) is None
+    set_keys(s1, 1, prefix=b'other')
+    assert policy.reason(s1) == 'dirty_keys'
+
+def test_dirty_bytes(s1):
+    policy = flushpolicy.FlushPolicy(max_dirty_bytes=1000, clock=FakeClock())
+    set_keys(s1, 1, size=100)
+    assert policy.reason(s1) is None
+    # rewriting the same key still adds to the commit log
+    for _ in range(10):
+        set_keys(s1, 1, size=100)
+    assert policy.reason(s1) == 'dirty_bytes'
+    s1.flush()
+    assert s1.dirty_bytes == 0
+
+def test_commit_log_size(s1):
+    policy = flushpolicy.FlushPolicy(max_dirty_bytes=0, max_log_bytes=500, clock=FakeClock())
+    set_keys(s1, 1, size=100)
+    assert policy.reason(s1) is None
+    set_keys(s1, 5, size=100)
+    assert policy.reason(s1) == 'commit_log'
+
+def test_commit_log_size_log_backend(tmp_path):
+    s = store.Store(LogBackend(str(tmp_path)))
+    s.load_db()
+    policy = flushpolicy.FlushPolicy(max_dirty_bytes=0, max_log_bytes=500, clock=FakeClock())
+    set_keys(s, 6, size=100)
+    # flushing leaves the data file as it is until it reaches max_file_size
+    assert policy.reason(s) is None
+    s.flush()
+    assert policy.reason(s) is None
+
+def test_dirty_limit_follows_throughput():
+    policy = flushpolicy.FlushPolicy(max_dirty_keys=100000, min_dirty_keys=100, target_pause=0.1,
+                                     clock=FakeClock())
+    assert policy.dirty_limit == 100000
+    # 10000 keys/sec, so a 0.1s flush is 1000 keys
+    policy.flushed('interval', 1000, 0.1)
+    assert policy.dirty_limit == 1000
+    # faster flushes raise the limit, smoothed
+    policy.flushed('dirty_keys', 1000, 0.01)
+    assert policy.throughput == pytest.approx(10000 + 0.3 * 90000)
+    assert policy.dirty_limit == 3700
+    # never below the minimum
+    for _ in range(20):
+        policy.flushed('dirty_keys', 1, 10)
+    assert policy.dirty_limit == 100
+
+@pytest.mark.asyncio
+async def test_flush_loop(s1):
+    policy = flushpolicy.FlushPolicy(interval=60, max_dirty_keys=10, min_dirty_keys=1, check_interval=0.01)
+    task = asyncio.ensure_future(s1.flush_loop(policy=policy))
+    set_keys(s1, 5)
+    await asyncio.sleep(0.05)
+    assert s1.dirty_keys == 5
+    set_keys(s1, 5, prefix=b'other')
+    await asyncio.sleep(0.05)
+    assert s1.dirty_keys == 0
+    assert s1.flushes == 1
+    task.cancel()
+    await task
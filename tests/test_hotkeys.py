@@ -0,0 +1,88 @@
+import pytest
+
+import hotkeys
+
+import random
+
+
+def test_space_saving_exact_under_capacity():
+    counter = hotkeys.SpaceSaving(capacity=10)
+    for key, n in ((b'a', 5), (b'b', 3), (b'c', 1)):
+        for _ in range(n):
+            counter.add(key)
+    assert counter.top(2) == [(5, 0, b'a'), (3, 0, b'b')]
+
+def test_space_saving_finds_heavy_hitters():
+    rng = random.Random(0)
+    counter = hotkeys.SpaceSaving(capacity=20)
+    for i in range(20000):
+        if i % 4 == 0:
+            counter.add(b'hot')
+        elif i % 10 == 1:
+            counter.add(b'warm')
+        else:
+            counter.add(b'cold_%d' % rng.randrange(10000))
+    assert len(counter) == 20
+    top = counter.top(2)
+    assert [key for count, error, key in top] == [b'hot', b'warm']
+    # counts overestimate by at most the error bound
+    count, error, key = top[0]
+    assert count - error <= 5000 <= count
+    assert len(counter.heap) <= 4 * counter.capacity
+
+def test_space_saving_decay():
+    counter = hotkeys.SpaceSaving(capacity=2)
+    counter.add(b'a', 10)
+    counter.decay()
+    counter.add(b'b', 4)
+    counter.add(b'c', 1)
+    # a (5) survives, b (4) is the smallest and is replaced by c
+    assert [key for count, error, key in counter.top(2)] == [b'c', b'a']
+
+def test_largest_values():
+    largest = hotkeys.LargestValues(capacity=2)
+    largest.update(b'a', 100)
+    largest.update(b'b', 10)
+    largest.update(b'c', 5)
+    assert largest.top(3) == [(100, b'a'), (10, b'b')]
+    largest.update(b'c', 50)
+    assert largest.top(3) == [(100, b'a'), (50, b'c')]
+    largest.update(b'a', 1)
+    largest.remove(b'c')
+    assert largest.top(3) == [(1, b'a')]
+
+def test_hotkeys_sampling():
+    tracker = hotkeys.HotKeys(capacity=10, sample_rate=0.1, half_life=0)
+    for _ in range(1000):
+        tracker.record('get', b'k')
+    tracker.record('set', b'k', 1234)
+    top = tracker.top()
+    # 1 in 10 counted, each with a weight of 10
+    assert top['commands']['get'] == [{'key': 'k', 'count': 1000, 'error': 0}]
+    assert 'set' not in top['commands']
+    # sizes are tracked for every set, sampled or not
+    assert top['largest'] == [{'key': 'k', 'bytes': 1234}]
+
+def test_hotkeys_disabled():
+    tracker = hotkeys.HotKeys(sample_rate=0)
+    tracker.record('get', b'k')
+    assert tracker.top() == {'commands': {}, 'largest': []}
+
+def test_hotkeys_half_life():
+    now = [0.0]
+    tracker = hotkeys.HotKeys(sample_rate=1, half_life=10, clock=lambda: now[0])
+    for _ in range(8):
+        tracker.record('get', b'k')
+    now[0] = 10
+    tracker.record('get', b'k')
+    assert tracker.top()['commands']['get'][0]['count'] == 4.5
+
+def test_hotkeys_collector():
+    tracker = hotkeys.HotKeys(sample_rate=1)
+    tracker.record('get', b'a')
+    tracker.record('get', b'a')
+    tracker.record('set', b'b', 42)
+    requests, sizes = hotkeys.HotKeysCollector(tracker, export=1).collect()
+    assert sorted((s.labels['command'], s.labels['key'], s.value) for s in requests.samples) == [
+        ('get', 'a', 2), ('set', 'b', 1)]
+    assert [(s.labels['key'], s.value) for s in sizes.samples] == [('b', 42)]
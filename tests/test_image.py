@@ -0,0 +1,46 @@
+import pytest
+
+import image
+from store import StorageItem
+
+import uuid
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'kv.image')
+    commit_id = uuid.uuid1()
+    items = [
+        (b'foo', StorageItem(1, 2, b'bar')),
+        (b'empty', StorageItem(0, 0, b'')),
+        (b'large', StorageItem(3, -1, b'x' * (image.BUFFER_SIZE + 1), 1)),
+    ]
+    image.write_image(path, commit_id, None, items, [b'foo'], [b'large'], [b'gone'])
+    assert image.read_image(path, StorageItem).items == items
+
+    img = image.read_image(path)
+    assert img.commit_id == commit_id
+    assert img.flushed_commit_id is None
+    assert img.items == [(key, tuple(item)) for key, item in items]
+    assert img.inserts == [b'foo']
+    assert img.updates == [b'large']
+    assert img.deletes == [b'gone']
+    # only the image is left behind
+    assert [p.name for p in tmp_path.iterdir()] == ['kv.image']
+
+def test_empty(tmp_path):
+    path = str(tmp_path / 'kv.image')
+    image.write_image(path, None, None, [])
+    assert image.read_image(path) == image.Image(None, None, [], [], [], [])
+
+@pytest.mark.parametrize('corrupt', [
+    lambda data: data[:-1],
+    lambda data: data[:20] + bytes([data[20] ^ 1]) + data[21:],
+    lambda data: b'',
+    lambda data: b'nonsense',
+])
+def test_corrupt(tmp_path, corrupt):
+    path = tmp_path / 'kv.image'
+    image.write_image(str(path), uuid.uuid1(), None, [(b'foo', StorageItem(1, 2, b'bar'))])
+    path.write_bytes(corrupt(path.read_bytes()))
+    with pytest.raises(ValueError):
+        image.read_image(str(path))
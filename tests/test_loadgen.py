@@ -0,0 +1,95 @@
+import pytest
+
+from benchmarks import loadgen
+
+import asyncio
+import random
+
+
+async def run(server, *args):
+    listener = await asyncio.start_server(server.handler, '127.0.0.1', 0)
+    try:
+        port = listener.sockets[0].getsockname()[1]
+        stats, elapsed = await loadgen.run('127.0.0.1', port, *args)
+    finally:
+        listener.close()
+        await listener.wait_closed()
+    return loadgen.report(stats, elapsed, {})
+
+def workload(**kwargs):
+    options = dict(mix={'get': 1, 'mget': 1, 'set': 1, 'delete': 1}, keys=50, zipf=1.0,
+                   value_size='uniform:1:200', mget_size=3, seed=1)
+    options.update(kwargs)
+    return loadgen.Workload(**options)
+
+def test_histogram_percentiles():
+    histogram = loadgen.Histogram()
+    values = [random.uniform(1, 100000) for _ in range(10000)]
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    for p in (50, 90, 99, 99.9):
+        exact = values[int(p / 100.0 * len(values)) - 1]
+        assert histogram.percentile(p) == pytest.approx(exact, rel=0.05)
+    assert histogram.percentile(100) == values[-1]
+    assert histogram.summary()['count'] == 10000
+
+def test_zipf_skew():
+    zipf = loadgen.Zipf(1000, 1.0, random.Random(1))
+    draws = [zipf() for _ in range(10000)]
+    assert all(0 <= draw < 1000 for draw in draws)
+    assert draws.count(0) > draws.count(10) > draws.count(500)
+
+def test_value_size():
+    rng = random.Random(1)
+    assert loadgen.ValueSize('fixed:10', rng)() == 10
+    assert all(5 <= loadgen.ValueSize('uniform:5:7', rng)() <= 7 for _ in range(100))
+    assert all(100 <= loadgen.ValueSize('pareto:100:1.5', rng)() for _ in range(100))
+
+@pytest.mark.asyncio
+async def test_closed_loop(server, s1):
+    result = await run(server, 4, 0.2, 0, workload(), True)
+    assert result['requests'] > 0
+    assert result['errors'] == 0
+    assert result['hit_ratio'] > 0
+    assert set(result['latency_us']) == {'all', 'get', 'mget', 'set', 'delete'}
+
+@pytest.mark.asyncio
+async def test_open_loop(server, s1):
+    result = await run(server, 2, 0.2, 200, workload(mix={'set': 1}), False)
+    assert result['requests'] == pytest.approx(40, abs=2)
+    assert result['errors'] == 0
+    assert len(s1) > 0
+
+@pytest.mark.asyncio
+async def test_reconnect_after_error():
+    # the first connection answers its first request with an error and
+    # leaves a stray reply behind it, so reading on would be out of step
+    connections = []
+    async def handler(reader, writer):
+        connections.append(writer)
+        first = len(connections) == 1
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if first:
+                writer.write(b'SERVER_ERROR busy\r\nEND\r\nEND\r\n')
+                first = False
+            else:
+                writer.write(b'NOT_FOUND\r\n')
+        writer.close()
+
+    listener = await asyncio.start_server(handler, '127.0.0.1', 0)
+    try:
+        conn = await loadgen.Connection.open('127.0.0.1', listener.sockets[0].getsockname()[1])
+        stats = loadgen.Stats()
+        for _ in range(5):
+            assert await loadgen.execute(conn, stats, 'delete', (b'key',), 0)
+        conn.close()
+    finally:
+        listener.close()
+        await listener.wait_closed()
+    assert stats.errors == 1
+    assert stats.latency['delete'].count == 4
+    assert len(connections) == 2
@@ -0,0 +1,56 @@
+import pytest
+
+import metrics
+
+from prometheus_client import CollectorRegistry, generate_latest
+import prometheus_client
+
+
+def exposition(module):
+    registry = CollectorRegistry()
+    counter = module.Counter('requests', 'Requests', ['command'], registry=registry)
+    gauge = module.Gauge('keys', 'Keys', registry=registry)
+    histogram = module.Histogram('latency_seconds', 'Latency', ['command'], registry=registry,
+                                 buckets=(.01, .1, 1.0))
+    counter.labels('get').inc()
+    counter.labels('get').inc(2)
+    counter.labels('set').inc()
+    gauge.inc(5)
+    gauge.dec(2)
+    for value in (.005, .01, .5, 3):
+        histogram.labels('get').observe(value)
+    lines = generate_latest(registry).decode().splitlines()
+    # prometheus_client also exports creation times
+    return [line for line in lines if '_created' not in line]
+
+def test_matches_prometheus_client():
+    assert exposition(metrics) == exposition(prometheus_client)
+
+def test_unlabelled():
+    counter = metrics.Counter('c', 'C', registry=None)
+    counter.inc()
+    counter.inc(2)
+    assert counter.child.value == 3
+
+    histogram = metrics.Histogram('h', 'H', registry=None, buckets=(1, 2))
+    histogram.observe(1)
+    histogram.observe(1.5)
+    histogram.observe(10)
+    assert list(histogram.child.buckets()) == [('1.0', 1), ('2.0', 2), ('+Inf', 3)]
+    assert histogram.child.sum == 12.5
+
+def test_time_and_count_exceptions():
+    histogram = metrics.Histogram('h', 'H', registry=None)
+    errors = metrics.Counter('e', 'E', registry=None)
+
+    @histogram.time()
+    @errors.count_exceptions()
+    def fail():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        fail()
+    with errors.count_exceptions():
+        pass
+    assert errors.child.value == 1
+    assert sum(histogram.child.counts) == 1
@@ -0,0 +1,73 @@
+import pytest
+
+import profiler
+
+import asyncio
+import time
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+async def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        busy_wait(0.01)
+        await asyncio.sleep(0)
+
+def lag_sum():
+    return profiler.LOOP_LAG._sum.get()
+
+@pytest.mark.asyncio
+async def test_profile_samples_loop():
+    sampler = profiler.SamplingProfiler(interval=0.001)
+    task = asyncio.ensure_future(busy(0.3))
+    stacks = await sampler.profile(0.2)
+    await task
+
+    assert sum(stacks.values()) > 10
+    busy_samples = sum(count for stack, count in stacks.items() if 'busy_wait' in stack)
+    assert busy_samples > 0
+    assert 'test_profiler.py:busy:' in next(stack for stack in stacks if 'busy_wait' in stack)
+
+    output = profiler.SamplingProfiler.format(stacks)
+    stack, count = output.splitlines()[0].rsplit(' ', 1)
+    assert stacks[stack] == int(count)
+
+@pytest.mark.asyncio
+async def test_profile_one_at_a_time():
+    sampler = profiler.SamplingProfiler(interval=0.001)
+    task = asyncio.ensure_future(sampler.profile(0.1))
+    await asyncio.sleep(0)
+    with pytest.raises(RuntimeError):
+        await sampler.profile(0.1)
+    await task
+    assert not sampler.running
+
+@pytest.mark.asyncio
+async def test_profile_max_seconds():
+    sampler = profiler.SamplingProfiler(interval=0.001, max_seconds=0.05)
+    start = time.perf_counter()
+    await sampler.profile(60)
+    assert time.perf_counter() - start < 1
+
+@pytest.mark.asyncio
+async def test_monitor_loop_lag():
+    before = lag_sum()
+    task = asyncio.ensure_future(profiler.monitor_loop_lag(interval=0.01))
+    await asyncio.sleep(0.02)
+    busy_wait(0.1)
+    await asyncio.sleep(0.02)
+    task.cancel()
+    await task
+    assert lag_sum() - before >= 0.05
+
+@pytest.mark.asyncio
+async def test_dispatch_profile(server):
+    server.profiler.interval = 0.001
+    resp = await server.dispatch(None, b'profile 0.05')
+    header, data, end = resp.split(b'\r\n')
+    assert header == b'VALUE profile 0 %d' % len(data)
+    assert end == b'END'
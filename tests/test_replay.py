@@ -0,0 +1,96 @@
+import pytest
+
+from benchmarks import replay
+import capture
+from server import MemcacheServer
+import store
+
+import asyncio
+import io
+import sqlite3
+
+
+async def run(server, records, speed):
+    listener = await asyncio.start_server(server.handler, '127.0.0.1', 0)
+    try:
+        port = listener.sockets[0].getsockname()[1]
+        stats, elapsed = await replay.replay('127.0.0.1', port, records, speed)
+    finally:
+        listener.close()
+        await listener.wait_closed()
+    return replay.report(stats, elapsed, {}), elapsed
+
+def records():
+    return [
+        (capture.OPEN, 0.0, 1, 0, b''),
+        (capture.LINE, 0.0, 1, 14, b'set foo 0 0 100\r\n'),
+        (capture.VALUE, 0.0, 1, 100, b'abc'),
+        (capture.LINE, 0.0, 2, 13, b'get foo bar\r\n'),
+        (capture.LINE, 0.1, 1, 7, b'stats\r\n'),
+        (capture.LINE, 0.1, 2, 17, b'set x 0 0 1 noreply\r\n'),
+        (capture.VALUE, 0.1, 2, 1, b'x'),
+        (capture.LINE, 0.2, 2, 14, b'delete missing\r\n'),
+        (capture.LINE, 0.2, 2, 7, b'bogus\r\n'),
+        (capture.CLOSE, 0.2, 1, 0, b''),
+    ]
+
+@pytest.mark.asyncio
+async def test_replay(server, s1):
+    result, elapsed = await run(server, records(), 1.0)
+    assert elapsed >= 0.2
+    assert result['requests'] == 5
+    # the unknown command
+    assert result['errors'] == 1
+    assert set(result['latency_us']) == {'all', 'set', 'get', 'stats', 'delete', 'bogus'}
+    # padded out to the captured size
+    assert s1[b'foo'].data == b'abc' + b'x' * 97
+    assert s1[b'x'].data == b'x'
+
+@pytest.mark.asyncio
+async def test_replay_accelerated(server, s1):
+    result, elapsed = await run(server, records(), 0)
+    assert elapsed < 0.2
+    assert result['requests'] == 5
+
+@pytest.mark.asyncio
+async def test_replay_close_doesnt_block(server, s1, monkeypatch):
+    monkeypatch.setattr(replay, 'CLOSE_TIMEOUT', 0.5)
+    # connection 1 closes with a reply still outstanding, connection 2's
+    # request is due right after
+    records = [
+        (capture.LINE, 0.0, 1, 9, b'get foo\r\n'),
+        (capture.LINE, 0.0, 1, 15, b'set bar 0 0 3\r\n'),
+        (capture.CLOSE, 0.0, 1, 0, b''),
+        (capture.LINE, 0.01, 2, 9, b'get foo\r\n'),
+    ]
+    result, elapsed = await run(server, records, 1.0)
+    # the value never came, so connection 1 waited out CLOSE_TIMEOUT
+    assert result['errors'] == 1
+    assert result['latency_us']['get']['count'] == 2
+    assert result['latency_us']['get']['max'] < 0.25 * 1e6
+
+@pytest.mark.asyncio
+async def test_replay_server_capture(server, tmp_path):
+    server.capture_dir = str(tmp_path)
+    listener = await asyncio.start_server(server.handler, '127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'capture start test\r\n')
+    await reader.readline()
+    for request in (b'set foo 0 0 3\r\nbar\r\n', b'get foo\r\n', b'stats\r\n',
+                    b'slowlog get\r\n', b'delete foo\r\n'):
+        writer.write(request)
+        while (await reader.readline()) not in (b'STORED\r\n', b'END\r\n', b'DELETED\r\n'):
+            pass
+    writer.write(b'capture stop\r\n')
+    await reader.readline()
+    writer.close()
+    listener.close()
+    await listener.wait_closed()
+
+    target = store.Store(sqlite3.connect(':memory:'), io.BytesIO())
+    target.load_db()
+    with open(str(tmp_path / 'test'), 'rb') as f:
+        result, _ = await run(MemcacheServer(target), capture.read_records(f), 0)
+    assert result['errors'] == 0
+    assert set(result['latency_us']) == {'all', 'set', 'get', 'delete'}
@@ -0,0 +1,100 @@
+import pytest
+
+import scheduler
+
+import asyncio
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def sleeps(monkeypatch):
+    sleeps = []
+    real_sleep = asyncio.sleep
+    async def sleep(delay):
+        sleeps.append(delay)
+        await real_sleep(0)
+    monkeypatch.setattr(scheduler.asyncio, 'sleep', sleep)
+    return sleeps
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = scheduler.TokenBucket(10, burst=2, clock=clock)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    # out of tokens, so wait for the overdraft to refill
+    assert bucket.take() == pytest.approx(0.1)
+    assert bucket.take() == pytest.approx(0.2)
+    clock.now += 10
+    assert bucket.take() == 0
+
+def test_unlimited_has_no_bucket():
+    assert scheduler.Scheduler(rate=0).bucket() is None
+    assert scheduler.Scheduler(rate=5).bucket().rate == 5
+
+def test_slices():
+    sched = scheduler.Scheduler(slice_size=2)
+    assert list(sched.slices([1, 2, 3, 4, 5])) == [[1, 2], [3, 4], [5]]
+
+@pytest.mark.asyncio
+async def test_throttle(sleeps):
+    clock = FakeClock()
+    sched = scheduler.Scheduler(rate=10, burst=1, clock=clock)
+    bucket = sched.bucket()
+    await sched.throttle(bucket)
+    assert sleeps == []
+    await sched.throttle(bucket)
+    assert sleeps == [pytest.approx(0.1)]
+
+@pytest.fixture()
+def clock():
+    return FakeClock()
+
+@pytest.fixture()
+def clock_sleeps(monkeypatch, clock):
+    # sleeping moves the fake clock along
+    sleeps = []
+    real_sleep = asyncio.sleep
+    async def sleep(delay):
+        sleeps.append(delay)
+        clock.now += delay
+        await real_sleep(0)
+    monkeypatch.setattr(scheduler.asyncio, 'sleep', sleep)
+    return sleeps
+
+@pytest.mark.asyncio
+async def test_maintenance_waits_for_quiet(clock, clock_sleeps):
+    sched = scheduler.Scheduler(quiet=0.01, max_defer=1, clock=clock)
+    # no requests at all
+    clock.now = 5
+    await sched.maintenance()
+    assert clock_sleeps == []
+
+    # a request just came in
+    sched.last_request = clock.now - 0.004
+    await sched.maintenance()
+    assert clock_sleeps == [pytest.approx(0.006)]
+
+@pytest.mark.asyncio
+async def test_maintenance_deferred_at_most_max_defer(monkeypatch, clock):
+    sched = scheduler.Scheduler(quiet=0.01, max_defer=0.05, clock=clock)
+    sleeps = []
+    real_sleep = asyncio.sleep
+    async def sleep(delay):
+        # requests keep arriving while we wait
+        sleeps.append(delay)
+        clock.now += delay
+        sched.last_request = clock.now
+        await real_sleep(0)
+    monkeypatch.setattr(scheduler.asyncio, 'sleep', sleep)
+
+    sched.last_request = clock.now
+    await sched.maintenance()
+    assert clock.now == pytest.approx(0.05)
+    assert sum(sleeps) == pytest.approx(0.05)
@@ -1,8 +1,15 @@
 import pytest
 
-import server
+import compression
+import hotkeys
+import scheduler
+import server as server_module
+import slowlog
+import store
+import valuecache
 
 import asyncio
+import json
 
 import asynctest
 
@@ -31,3 +38,337 @@ async def test_dispatch_cmds(server, s1):
 
     resp = await server.dispatch(reader, b'BADCMD')
     assert resp == b'ERROR'
+
+@pytest.mark.asyncio
+async def test_dispatch_compressed(server, s1):
+    s1.compressor = compression.Compressor(threshold=10)
+    value = b'bar' * 100
+    reader = asynctest.mock.Mock(asyncio.StreamReader)
+    reader.readexactly.return_value = value + b'\r\n'
+
+    resp = await server.dispatch(reader, b'SET foo 1 2 %d' % len(value))
+    assert resp == b'STORED'
+    assert s1[b'foo'].encoding == compression.ZLIB
+    assert len(s1[b'foo'].data) < len(value)
+
+    resp = await server.dispatch(reader, b'GET foo')
+    assert resp == b'VALUE foo 1 %d\r\n%s\r\nEND' % (len(value), value)
+
+@pytest.mark.asyncio
+async def test_dispatch_hotkeys(server, s1):
+    server.hotkeys = hotkeys.HotKeys(sample_rate=1)
+    reader = asynctest.mock.Mock(asyncio.StreamReader)
+    reader.readexactly.return_value = b'bar\r\n'
+
+    await server.dispatch(reader, b'SET foo 1 2 3')
+    await server.dispatch(reader, b'GET foo bar')
+    await server.dispatch(reader, b'GET foo')
+
+    top = server.hotkeys.top()
+    assert top['commands']['get'][0] == {'key': 'foo', 'count': 2, 'error': 0}
+    assert top['largest'] == [{'key': 'foo', 'bytes': 3}]
+
+    await server.dispatch(reader, b'DELETE foo')
+    assert server.hotkeys.top()['largest'] == []
+
+@pytest.mark.asyncio
+async def test_dispatch_slowlog(server, s1):
+    server.slow_log = slowlog.SlowLog(threshold=0, sample_rate=0)
+    reader = asynctest.mock.Mock(asyncio.StreamReader)
+    reader.readexactly.return_value = b'bar\r\n'
+
+    await server.dispatch(reader, b'SET foo 1 2 3')
+    await server.dispatch(reader, b'GET foo')
+    assert await server.dispatch(reader, b'SLOWLOG LEN') == b'2'
+
+    resp = await server.dispatch(reader, b'SLOWLOG GET 2')
+    header, data, end = resp.split(b'\r\n')
+    assert header == b'VALUE slowlog 0 %d' % len(data)
+    entries = json.loads(data)
+    assert [(entry['command'], entry['keys']) for entry in entries] == [('slowlog', ['LEN']), ('get', ['foo'])]
+
+    assert await server.dispatch(reader, b'SLOWLOG RESET') == b'OK'
+    # the reset itself is the only entry left
+    assert await server.dispatch(reader, b'SLOWLOG LEN') == b'1'
+
+@pytest.mark.asyncio
+async def test_dispatch_sliced_multiget(server, s1):
+    server.scheduler = scheduler.Scheduler(slice_size=2)
+    for i in range(5):
+        s1[b'key_%d' % i] = store.StorageItem(0, 0, b'%d' % i)
+    reader = asynctest.mock.Mock(asyncio.StreamReader)
+
+    yields = scheduler.YIELDS.child.value
+    resp = await server.dispatch(reader, b'GET key_0 key_1 missing key_2 key_3 key_4')
+    assert resp == b''.join(b'VALUE key_%d 0 1\r\n%d\r\n' % (i, i) for i in range(5)) + b'END'
+    assert scheduler.YIELDS.child.value - yields == 2
+
+    resp = await server.dispatch(reader, b'GET missing other')
+    assert resp == b'END'
+
+@pytest.mark.asyncio
+async def test_pipelined_connection_yields(server):
+    server.scheduler = scheduler.Scheduler(batch=4)
+    listener, port = await listen(server)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    yields = scheduler.YIELDS.child.value
+    writer.write(b'get foo\r\n' * 10)
+    for _ in range(10):
+        assert await reader.readline() == b'END\r\n'
+    assert scheduler.YIELDS.child.value - yields == 2
+
+    writer.close()
+    await stop(listener)
+
+@pytest.mark.asyncio
+async def test_client_rate_limit(server):
+    server.scheduler = scheduler.Scheduler(rate=50, burst=1)
+    listener, port = await listen(server)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    throttled = scheduler.THROTTLED.child.value
+    start = asyncio.get_event_loop().time()
+    writer.write(b'get foo\r\n' * 4)
+    for _ in range(4):
+        assert await reader.readline() == b'END\r\n'
+    # the first is free, the rest come 20ms apart
+    assert asyncio.get_event_loop().time() - start >= 0.05
+    assert scheduler.THROTTLED.child.value - throttled == 3
+
+    writer.close()
+    await stop(listener)
+
+@pytest.mark.asyncio
+async def test_dispatch_value_ending_in_newline(server, s1):
+    reader = asynctest.mock.Mock(asyncio.StreamReader)
+    reader.readexactly.return_value = b'a\r\n\r\n'
+    await server.dispatch(reader, b'SET foo 0 0 3')
+    assert s1[b'foo'].data == b'a\r\n'
+
+@pytest.mark.asyncio
+async def test_large_values_streamed(server, s1):
+    server.stream_size = 1000
+    listener, port = await listen(server)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    value = bytes(range(256)) * 1000
+    writer.write(b'set big 0 0 %d\r\n%s\r\nset small 0 0 1\r\nx\r\n' % (len(value), value))
+    assert await reader.readline() == b'STORED\r\n'
+    assert await reader.readline() == b'STORED\r\n'
+    # read into a buffer of its own rather than sliced out of the reader's
+    assert type(s1[b'big'].data) is bytearray
+    assert s1[b'big'].data == value
+
+    writer.write(b'get small big\r\n')
+    assert await reader.readline() == b'VALUE small 0 1\r\n'
+    assert await reader.readline() == b'x\r\n'
+    assert await reader.readline() == b'VALUE big 0 %d\r\n' % len(value)
+    assert await reader.readexactly(len(value) + 2) == value + b'\r\n'
+    assert await reader.readline() == b'END\r\n'
+
+    writer.close()
+    await stop(listener)
+
+@pytest.mark.asyncio
+async def test_max_item_size(server, s1):
+    server.max_item_size = 1000
+    server.stream_size = 100
+    listener, port = await listen(server)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    writer.write(b'set big 0 0 1001\r\n%s\r\n' % (b'x' * 1001))
+    assert await reader.readline() == b'SERVER_ERROR object too large for cache\r\n'
+    # the value was read and dropped, so the connection carries on
+    writer.write(b'set ok 0 0 1000\r\n%s\r\nget big\r\n' % (b'x' * 1000))
+    assert await reader.readline() == b'STORED\r\n'
+    assert await reader.readline() == b'END\r\n'
+    assert b'big' not in s1
+
+    writer.close()
+    await stop(listener)
+
+def parse_stats(resp):
+    lines = resp.split(b'\r\n')
+    assert lines.pop() == b'END'
+    stats = {}
+    for line in lines:
+        stat, name, value = line.decode().split(' ')
+        assert stat == 'STAT'
+        stats[name] = value
+    return stats
+
+@pytest.mark.asyncio
+async def test_stats_leaves_metrics_alone(server, monkeypatch):
+    monkeypatch.setattr(server_module.REQUEST_DURATION, 'children', {})
+    reader = asynctest.mock.Mock(asyncio.StreamReader)
+    stats = parse_stats(await server.dispatch(reader, b'stats'))
+    assert stats['cmd_set'] == '0'
+    # only the stats command itself was timed
+    assert list(server_module.REQUEST_DURATION.children) == [('stats',)]
+
+@pytest.mark.asyncio
+async def test_dispatch_stats(server, s1):
+    reader = asynctest.mock.Mock(asyncio.StreamReader)
+    reader.readexactly.return_value = b'bar\r\n'
+    before = parse_stats(await server.dispatch(reader, b'stats'))
+
+    await server.dispatch(reader, b'set foo 0 0 3')
+    await server.dispatch(reader, b'get foo bar')
+    await server.dispatch(reader, b'delete bar')
+    stats = parse_stats(await server.dispatch(reader, b'stats'))
+    for name, delta in (('cmd_get', 2), ('cmd_set', 1), ('get_hits', 1), ('get_misses', 1),
+                        ('delete_hits', 0), ('delete_misses', 1)):
+        assert int(stats[name]) - int(before[name]) == delta
+    assert stats['curr_items'] == '1'
+    assert stats['bytes'] == '3'
+    assert stats['dirty_items'] == '1'
+    assert int(stats['commit_log_bytes']) > 0
+    assert stats['flushes'] == '0'
+
+    s1.flush()
+    stats = parse_stats(await server.dispatch(reader, b'stats'))
+    assert stats['flushes'] == '1'
+    assert stats['dirty_items'] == '0'
+    assert stats['commit_log_bytes'] == '0'
+
+    assert parse_stats(await server.dispatch(reader, b'stats items'))['items:1:number'] == '1'
+    reader.readexactly.return_value = b'x' * 40 + b'\r\n'
+    await server.dispatch(reader, b'set big 0 0 40')
+    assert parse_stats(await server.dispatch(reader, b'stats sizes')) == {'32': '1', '64': '1'}
+    await server.dispatch(reader, b'delete foo')
+    assert parse_stats(await server.dispatch(reader, b'stats sizes')) == {'64': '1'}
+
+    assert await server.dispatch(reader, b'stats nonsense') == b'CLIENT_ERROR unknown stats group'
+
+@pytest.mark.asyncio
+async def test_stats_conns(server):
+    listener, port = await listen(server)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'get foo\r\nstats conns\r\n')
+    assert await reader.readline() == b'END\r\n'
+    lines = []
+    while not lines or lines[-1] != b'END':
+        lines.append((await reader.readline()).rstrip())
+    stats = parse_stats(b'\r\n'.join(lines))
+    (client,) = server.connections.values()
+    prefix = '%d:' % client.id
+    assert stats[prefix + 'addr'] == '127.0.0.1:%d' % writer.get_extra_info('sockname')[1]
+    assert stats[prefix + 'requests'] == '2'
+    assert stats[prefix + 'bytes_written'] == '5'
+
+    writer.close()
+    await stop(listener)
+
+async def listen(server):
+    listener = await asyncio.start_server(server.handler, '127.0.0.1', 0)
+    return listener, listener.sockets[0].getsockname()[1]
+
+async def stop(listener):
+    listener.close()
+    await listener.wait_closed()
+    # let the handlers see the connections close
+    await asyncio.sleep(0.05)
+
+@pytest.mark.asyncio
+async def test_max_connections(server):
+    server.max_connections = 1
+    listener, port = await listen(server)
+    reader1, writer1 = await asyncio.open_connection('127.0.0.1', port)
+    writer1.write(b'get foo\r\n')
+    assert await reader1.readline() == b'END\r\n'
+
+    rejected = server_module.REJECTED_CONNECTIONS.child.value
+    reader2, writer2 = await asyncio.open_connection('127.0.0.1', port)
+    assert await reader2.readline() == b'SERVER_ERROR too many open connections\r\n'
+    assert await reader2.read() == b''
+    assert server_module.REJECTED_CONNECTIONS.child.value == rejected + 1
+    assert len(server.connections) == 1
+
+    writer1.close()
+    writer2.close()
+    await stop(listener)
+    assert not server.connections
+
+@pytest.mark.asyncio
+async def test_idle_timeout(server):
+    server.idle_timeout = 10
+    listener, port = await listen(server)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'get foo\r\n')
+    assert await reader.readline() == b'END\r\n'
+
+    (client,) = server.connections.values()
+    server.close_idle(client.last + 5)
+    assert len(server.connections) == 1
+    server.close_idle(client.last + 10)
+    assert await reader.read() == b''
+
+    writer.close()
+    await stop(listener)
+    assert not server.connections
+
+@pytest.mark.asyncio
+async def test_slowlog_trace(server, s1):
+    server.slow_log = slowlog.SlowLog(threshold=0, sample_rate=0)
+    listener, port = await listen(server)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'set foo 0 0 3\r\n')
+    await writer.drain()
+    await asyncio.sleep(0.05)
+    writer.write(b'bar\r\n')
+    assert await reader.readline() == b'STORED\r\n'
+
+    (entry,) = server.slow_log.get()
+    assert entry['client'] == '127.0.0.1:%d' % writer.get_extra_info('sockname')[1]
+    assert entry['value_bytes'] == 3
+    # waiting for the value counts as reading, not executing
+    assert entry['read'] >= 0.04
+    assert entry['execute'] < entry['read']
+
+    writer.close()
+    await stop(listener)
+
+@pytest.mark.asyncio
+async def test_slow_client(server, s1):
+    server.write_buffer = 1024
+    server.drain_timeout = 0.1
+    s1[b'big'] = store.StorageItem(0, 0, b'x' * 256 * 1024)
+    listener, port = await listen(server)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    dropped = server_module.SLOW_DISCONNECTS.child.value
+    # never read the replies. once the socket buffers fill up the server
+    # stops reading requests and then drops the connection
+    writer.write(b'get big\r\n' * 200)
+    for _ in range(50):
+        if not server.connections:
+            break
+        await asyncio.sleep(0.05)
+    assert not server.connections
+    assert server_module.SLOW_DISCONNECTS.child.value == dropped + 1
+
+    writer.close()
+    await stop(listener)
+
+@pytest.mark.asyncio
+async def test_dispatch_value_cache(server, s1):
+    s1.value_cache = valuecache.ValueCache()
+    reader = asynctest.mock.Mock(asyncio.StreamReader)
+    reader.readexactly.return_value = b'bar\r\n'
+    await server.dispatch(reader, b'SET foo 1 2 3')
+
+    for _ in range(3):
+        resp = await server.dispatch(reader, b'GET foo')
+        assert resp == b'VALUE foo 1 3\r\nbar\r\nEND'
+    assert s1.value_cache.get(b'foo') == resp
+
+    reader.readexactly.return_value = b'bazz\r\n'
+    await server.dispatch(reader, b'SET foo 1 2 4')
+    assert s1.value_cache.get(b'foo') is None
+    assert await server.dispatch(reader, b'GET foo') == b'VALUE foo 1 4\r\nbazz\r\nEND'
+    assert await server.dispatch(reader, b'GET foo') == b'VALUE foo 1 4\r\nbazz\r\nEND'
+
+    await server.dispatch(reader, b'DELETE foo')
+    assert await server.dispatch(reader, b'GET foo') == b'END'
+    assert len(s1.value_cache) == 0
@@ -0,0 +1,67 @@
+import pytest
+
+import slowlog
+
+
+def test_slow_commands_logged():
+    log = slowlog.SlowLog(threshold=0.01, sample_rate=0)
+    log.observe('get', [b'fast'], 0.001)
+    log.observe('get', [b'slow'], 0.02)
+    assert len(log) == 1
+    entry = log.get()[0]
+    assert entry['command'] == 'get'
+    assert entry['keys'] == ['slow']
+    assert entry['duration'] == 0.02
+    assert not entry['sampled']
+
+def test_sampled_commands_logged():
+    log = slowlog.SlowLog(threshold=1, sample_rate=0.1)
+    for i in range(100):
+        log.observe('get', [b'%d' % i], 0.001)
+    assert len(log) == 10
+    assert all(entry['sampled'] for entry in log.get())
+
+def test_bounded_newest_first():
+    log = slowlog.SlowLog(threshold=0, size=3)
+    for i in range(5):
+        log.observe('delete', [b'%d' % i], 0.1)
+    assert [entry['keys'] for entry in log.get()] == [['4'], ['3'], ['2']]
+    assert [entry['id'] for entry in log.get(2)] == [4, 3]
+    log.reset()
+    assert log.get() == []
+
+def test_set_value_size():
+    log = slowlog.SlowLog(threshold=0)
+    log.observe('set', [b'foo', b'0', b'0', b'1024'], 0.1)
+    log.observe('set', [b'foo', b'0', b'0', b'bad'], 0.1)
+    assert [entry['value_bytes'] for entry in log.get()] == [None, 1024]
+    assert log.get()[0]['keys'] == ['foo']
+
+def test_keys_truncated():
+    keys = [b'k' * 100] * (slowlog.MAX_KEYS + 2)
+    described = slowlog.describe_keys(keys)
+    assert len(described) == slowlog.MAX_KEYS + 1
+    assert len(described[0]) == slowlog.MAX_KEY_LENGTH
+    assert described[-1] == '... (2 more)'
+
+def test_trace_breakdown():
+    log = slowlog.SlowLog(threshold=0)
+    trace = slowlog.Trace('127.0.0.1:1234')
+    token = slowlog.TRACE.set(trace)
+    try:
+        slowlog.add_read_time(0.2)
+        slowlog.add_commit_time(0.3)
+    finally:
+        slowlog.TRACE.reset(token)
+    # no trace set, so nothing is recorded
+    slowlog.add_commit_time(1)
+    log.record_loop_lag(0.05)
+    log.observe('set', [b'foo', b'0', b'0', b'3'], 1.0, trace)
+    entry = log.get()[0]
+    assert entry['client'] == '127.0.0.1:1234'
+    assert entry['read'] == 0.2
+    assert entry['commit'] == 0.3
+    assert entry['execute'] == pytest.approx(0.5)
+    assert entry['loop_lag'] == 0.05
+    trace.reset()
+    assert trace.read == trace.commit == 0.0
@@ -1,8 +1,14 @@
 import pytest
 
+from backends.sqlite import SNAPSHOT_DB, SNAPSHOT_LOG, SQLiteBackend
 import commands
+import commitlog
 import store
 
+import os
+import sqlite3
+import uuid
+
 def assert_commit_log(s, num_keys, key, value):
     for i, (commit_id, command) in enumerate(s.load_commits()):
         assert type(command) == commands.SetCommand
@@ -250,3 +256,207 @@ def test_store_db_delete_flush_set(s1):
 
     # assert it is now pending insert
     assert_pending(s1, key, INSERT)
+
+def restore_snapshot(path):
+    conn = sqlite3.connect(os.path.join(path, SNAPSHOT_DB))
+    commit_log = open(os.path.join(path, SNAPSHOT_LOG), 'a+b')
+    s = store.Store(conn, commit_log)
+    s.load_db()
+    s.sync_commit_log()
+    return s
+
+@pytest.mark.asyncio
+async def test_store_snapshot(s1, tmp_path):
+    key1 = b'some_saved_key_%d'
+    value1 = b'some_saved_value_%d'
+    key2 = b'some_replay_key_%d'
+    value2 = b'some_replay_value_%d'
+    num_keys = 10
+
+    for i in range(0, num_keys + 1):
+        s1.apply(commands.SetCommand(key1 % i, i, i*i, value1 % i))
+    s1.flush()
+    for i in range(0, num_keys + 1):
+        s1.apply(commands.SetCommand(key2 % i, i, i*i, value2 % i))
+    s1.apply(commands.DeleteCommand(key1 % 0))
+
+    path = await s1.snapshot(str(tmp_path / 'snap'))
+    assert s1.last_snapshot['commit_id'] == str(s1.commit_id)
+
+    s2 = restore_snapshot(path)
+    assert s2.commit_id == s1.commit_id
+    assert_store_equal(s1, s2)
+
+@pytest.mark.asyncio
+async def test_store_snapshot_file_db(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'db.sqlite'))
+    commit_log = open(str(tmp_path / 'commit.log'), 'a+b')
+    s1 = store.Store(conn, commit_log, snapshot_dir=str(tmp_path / 'snapshots'))
+    s1.load_db()
+
+    s1.apply(commands.SetCommand(b'saved', 1, 2, b'value'))
+    s1.flush()
+    s1.apply(commands.SetCommand(b'replayed', 1, 2, b'value'))
+
+    path = s1.start_snapshot('snap')
+    assert s1.snapshotting
+    with pytest.raises(RuntimeError):
+        s1.start_snapshot('other')
+
+    # writes during the snapshot land after its commit log tail and
+    # flushes are deferred until it is done
+    s1.apply(commands.SetCommand(b'late', 1, 2, b'value'))
+    s1.flush()
+    assert s1.dirty
+
+    await s1.snapshot_task
+    assert not s1.snapshotting
+
+    s2 = restore_snapshot(path)
+    assert set(s2.keys()) == {b'saved', b'replayed'}
+
+def lazy_store(conn, commit_log):
+    s = store.Store(SQLiteBackend(conn, commit_log, lazy=True))
+    s.load_db()
+    s.sync_commit_log()
+    return s
+
+def test_lazy_read_through(s1, conn, commit_log):
+    for i in range(10):
+        s1[b'key_%d' % i] = store.StorageItem(i, 0, b'value_%d' % i)
+    s1.commit_id = uuid.uuid1()
+    s1.flush()
+
+    s2 = lazy_store(conn, commit_log)
+    assert not s2.data
+    assert s2[b'key_3'].data == b'value_3'
+    assert list(s2.data) == [b'key_3']
+    assert b'key_4' in s2
+    assert b'nope' not in s2
+    assert sorted(s2.keys()) == sorted(s1.keys())
+    assert len(s2) == 10
+    assert not s2.dirty
+
+def test_lazy_writes(s1, conn, commit_log):
+    for i in range(3):
+        s1[b'key_%d' % i] = store.StorageItem(0, 0, b'old')
+    s1.commit_id = uuid.uuid1()
+    s1.flush()
+
+    s2 = lazy_store(conn, commit_log)
+    # an unread key that is in the db is upserted, a new one inserted
+    s2.apply(commands.SetCommand(b'key_0', 0, 0, b'new'))
+    assert_pending(s2, b'key_0', UPDATE)
+    s2.apply(commands.SetCommand(b'fresh', 0, 0, b'new'))
+    # unless the bloom filter gives a false positive for it
+    assert_pending(s2, b'fresh', UPDATE if s2.backend.may_contain(b'fresh') else INSERT)
+    # deletes read the item first so a missing key is still a miss
+    s2.apply(commands.DeleteCommand(b'key_1'))
+    assert_pending(s2, b'key_1', DELETE)
+    with pytest.raises(KeyError):
+        s2.apply(commands.DeleteCommand(b'missing'))
+    with pytest.raises(KeyError):
+        s2[b'key_1']
+    # updated then deleted before a flush
+    s2.apply(commands.DeleteCommand(b'key_0'))
+    assert_pending(s2, b'key_0', DELETE)
+    s2.flush()
+
+    s3 = lazy_store(conn, commit_log)
+    assert sorted(s3) == [b'fresh', b'key_2']
+    assert s3[b'fresh'].data == b'new'
+
+def test_lazy_replays_commit_log(s1, conn, commit_log):
+    s1[b'key'] = store.StorageItem(0, 0, b'old')
+    s1.commit_id = uuid.uuid1()
+    s1.flush()
+    s1.apply(commands.SetCommand(b'key', 0, 0, b'new'))
+    s1.apply(commands.SetCommand(b'other', 0, 0, b'value'))
+
+    s2 = lazy_store(conn, commit_log)
+    assert s2[b'key'].data == b'new'
+    assert s2[b'other'].data == b'value'
+    assert s2.pending_upsert == {b'key', b'other'}
+
+def image_store(path, conn, commit_log):
+    s = store.Store(conn, commit_log)
+    s.load(str(path))
+    return s
+
+def test_store_image(s1, conn, commit_log, tmp_path):
+    path = tmp_path / 'kv.image'
+    s1.apply(commands.SetCommand(b'flushed', 1, 2, b'value'))
+    s1.apply(commands.SetCommand(b'deleted', 1, 2, b'value'))
+    s1.flush()
+    s1.apply(commands.SetCommand(b'pending', 1, 2, b'value'))
+    s1.apply(commands.SetCommand(b'flushed', 3, 4, b'updated'))
+    s1.apply(commands.DeleteCommand(b'deleted'))
+    s1.write_image(str(path))
+    # only this is replayed
+    s1.apply(commands.SetCommand(b'tail', 1, 2, b'value'))
+
+    s2 = image_store(path, conn, commit_log)
+    assert s2.commit_id == s1.commit_id
+    assert_store_equal(s1, s2)
+    assert s2.num_bytes == s1.num_bytes
+    assert_pending(s2, b'pending', INSERT)
+    assert_pending(s2, b'tail', INSERT)
+    assert_pending(s2, b'flushed', UPDATE)
+    assert_pending(s2, b'deleted', DELETE)
+
+    # and the pending changes still make it to the database
+    s2.flush()
+    s3 = image_store(tmp_path / 'missing', conn, commit_log)
+    assert_store_equal(s1, s3)
+
+def test_store_image_after_flush(s1, conn, commit_log, tmp_path):
+    path = tmp_path / 'kv.image'
+    s1.apply(commands.SetCommand(b'imaged', 1, 2, b'value'))
+    s1.write_image(str(path))
+    s1.apply(commands.SetCommand(b'flushed', 1, 2, b'value'))
+    s1.flush()
+
+    # the image is older than the database, which is loaded instead
+    s2 = image_store(path, conn, commit_log)
+    assert set(s2.keys()) == {b'imaged', b'flushed'}
+    assert not s2.dirty
+
+def test_store_image_compacted_log(s1, conn, commit_log, tmp_path):
+    path = tmp_path / 'kv.image'
+    s1.apply(commands.SetCommand(b'key', 1, 2, b'first'))
+    s1.write_image(str(path))
+    s1.apply(commands.SetCommand(b'key', 1, 2, b'second'))
+    s1.apply(commands.SetCommand(b'other', 1, 2, b'value'))
+    # as if compaction dropped the commit the image was written at
+    commits = [record for record in commitlog.read_commits(commit_log)][1:]
+    commit_log.seek(0)
+    data = commit_log.read()
+    commit_log.seek(0)
+    commit_log.truncate()
+    commit_log.write(data[commits[0][2]:])
+
+    s2 = image_store(path, conn, commit_log)
+    assert s2[b'key'].data == b'second'
+    assert s2[b'other'].data == b'value'
+
+def test_store_image_corrupt(s1, conn, commit_log, tmp_path):
+    path = tmp_path / 'kv.image'
+    s1.apply(commands.SetCommand(b'key', 1, 2, b'value'))
+    path.write_bytes(b'nonsense')
+    s2 = image_store(path, conn, commit_log)
+    assert s2[b'key'].data == b'value'
+
+@pytest.mark.asyncio
+async def test_store_save_image(s1, conn, commit_log, tmp_path):
+    path = tmp_path / 'kv.image'
+    s1.apply(commands.SetCommand(b'key', 1, 2, b'value'))
+    assert await s1.save_image(str(path)) == str(path)
+    assert not s1.imaging
+
+    s2 = store.Store(conn, commit_log)
+    assert s2.load_image(str(path))
+    assert s2[b'key'].data == b'value'
+
+def test_lazy_store_image(conn, commit_log, tmp_path):
+    s = lazy_store(conn, commit_log)
+    assert s.write_image(str(tmp_path / 'kv.image')) is None
@@ -0,0 +1,35 @@
+import pytest
+
+import valuecache
+
+
+def test_admitted_on_second_miss():
+    cache = valuecache.ValueCache()
+    assert cache.get(b'key') is None
+    cache.put(b'key', b'wire')
+    assert cache.get(b'key') is None
+    cache.put(b'key', b'wire')
+    assert cache.get(b'key') == b'wire'
+    assert cache.nbytes == 4
+
+    cache.discard(b'key')
+    assert cache.get(b'key') is None
+    assert cache.nbytes == 0
+
+def fill(cache, key, wire):
+    cache.put(key, wire)
+    cache.put(key, wire)
+
+def test_bounded():
+    cache = valuecache.ValueCache(max_items=2, max_bytes=10, max_item_size=6)
+    fill(cache, b'a', b'aaaa')
+    fill(cache, b'b', b'bbbb')
+    cache.get(b'a')
+    fill(cache, b'c', b'cccc')
+    # over max_bytes, so the least recently used goes
+    assert cache.get(b'b') is None
+    assert cache.get(b'a') == b'aaaa'
+    assert cache.nbytes == 8
+    fill(cache, b'd', b'd' * 7)
+    assert cache.get(b'd') is None
+    assert len(cache) == 2
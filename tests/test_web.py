@@ -0,0 +1,107 @@
+import pytest
+
+import commands
+import web
+
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+
+async def client_for(s1):
+    client = TestClient(TestServer(web.HttpServer(s1).app))
+    await client.start_server()
+    return client
+
+@pytest.mark.asyncio
+async def test_values_etag(s1):
+    s1.apply(commands.SetCommand(b'foo', 0, 0, b'bar'))
+    client = await client_for(s1)
+    try:
+        resp = await client.get('/api/values/foo')
+        assert resp.status == 200
+        assert await resp.json() == {'value': 'bar'}
+        etag = resp.headers['ETag']
+        assert resp.headers['Last-Modified']
+
+        resp = await client.get('/api/values/foo', headers={'If-None-Match': etag})
+        assert resp.status == 304
+        resp = await client.get('/api/values/foo', headers={'If-None-Match': 'W/%s, "other"' % etag})
+        assert resp.status == 304
+
+        # other keys changing leave this one's etag alone
+        s1.apply(commands.SetCommand(b'other', 0, 0, b'x'))
+        resp = await client.get('/api/values/foo', headers={'If-None-Match': etag})
+        assert resp.status == 304
+
+        s1.apply(commands.SetCommand(b'foo', 0, 0, b'baz'))
+        resp = await client.get('/api/values/foo', headers={'If-None-Match': etag})
+        assert resp.status == 200
+        assert await resp.json() == {'value': 'baz'}
+        assert resp.headers['ETag'] != etag
+
+        s1.apply(commands.DeleteCommand(b'foo'))
+        resp = await client.get('/api/values/foo', headers={'If-None-Match': etag})
+        assert resp.status == 404
+    finally:
+        await client.close()
+
+@pytest.mark.asyncio
+async def test_keys_cache(s1):
+    s1.apply(commands.SetCommand(b'foo', 0, 0, b'bar'))
+    client = await client_for(s1)
+    try:
+        hits = web.RESPONSE_CACHE.labels('hit')._value.get()
+        resp = await client.get('/api/keys')
+        assert await resp.json() == {'keys': ['foo']}
+        etag = resp.headers['ETag']
+        resp = await client.get('/api/keys')
+        assert await resp.json() == {'keys': ['foo']}
+        assert web.RESPONSE_CACHE.labels('hit')._value.get() == hits + 1
+
+        resp = await client.get('/api/keys', headers={'If-Modified-Since': resp.headers['Last-Modified']})
+        assert resp.status == 304
+
+        s1.apply(commands.SetCommand(b'other', 0, 0, b'x'))
+        resp = await client.get('/api/keys', headers={'If-None-Match': etag})
+        assert resp.status == 200
+        assert sorted((await resp.json())['keys']) == ['foo', 'other']
+    finally:
+        await client.close()
+
+def test_etag_matches():
+    assert web.etag_matches('"a-1"', '"a-1"')
+    assert web.etag_matches('W/"a-1"', '"a-1"')
+    assert web.etag_matches('"b-2", "a-1"', '"a-1"')
+    assert web.etag_matches('*', '"a-1"')
+    assert not web.etag_matches('"a-2"', '"a-1"')
+    assert not web.etag_matches('', '"a-1"')
+
+def test_response_cache_bounded():
+    cache = web.ResponseCache(size=2)
+    cache.put('/a', '1', b'a')
+    cache.put('/b', '1', b'b')
+    assert cache.get('/a', '1') == b'a'
+    cache.put('/c', '1', b'c')
+    assert cache.get('/b', '1') is None
+    assert cache.get('/a', '2') is None
+    assert cache.get('/c', '1') == b'c'
+
+@pytest.mark.asyncio
+async def test_snapshot_failure(s1, tmp_path):
+    s1.snapshot_dir = str(tmp_path)
+    # the snapshot directory already exists
+    (tmp_path / 'snap').mkdir()
+    client = await client_for(s1)
+    try:
+        resp = await client.post('/api/snapshot?name=snap')
+        assert resp.status == 202
+        await asyncio.wait([s1.snapshot_task])
+        resp = await client.get('/api/snapshot')
+        status = await resp.json()
+        assert not status['in_progress']
+        assert status['last'] is None
+        assert status['last_error']['path'] == str(tmp_path / 'snap')
+        assert 'File exists' in status['last_error']['error']
+    finally:
+        await client.close()
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+
+import metrics
+
+
+GET_CACHE = metrics.Counter('server_get_cache', 'Single item get responses by cache outcome', ['result'])
+GET_CACHE_BYTES = metrics.Gauge('server_get_cache_bytes', 'Bytes of responses held by the get cache')
+HITS = GET_CACHE.labels('hit')
+MISSES = GET_CACHE.labels('miss')
+EVICTIONS = GET_CACHE.labels('evicted')
+
+MAX_ITEMS = 10000
+MAX_BYTES = 64 * 1024 * 1024
+MAX_ITEM_SIZE = 64 * 1024
+
+END = b'END'
+
+
+class ValueCache(object):
+    # the exact reply to `get <key>`, ready to write, for keys that are read
+    # more than once. the store discards a key's entry whenever it's set or
+    # deleted, so an entry is always current
+    def __init__(self, max_items=MAX_ITEMS, max_bytes=MAX_BYTES, max_item_size=MAX_ITEM_SIZE):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_item_size = max_item_size
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        # keys that missed once. only a second miss admits a key, so a scan
+        # over cold keys doesn't flush the hot ones
+        self.seen = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        wire = self.entries.get(key)
+        if wire is None:
+            MISSES.inc()
+            return None
+        HITS.inc()
+        self.entries.move_to_end(key)
+        return wire
+
+    def put(self, key, wire):
+        if len(wire) > self.max_item_size:
+            return
+        if key not in self.seen:
+            if len(self.seen) >= self.max_items:
+                self.seen.clear()
+            self.seen.add(key)
+            return
+        self.seen.discard(key)
+        self.discard(key)
+        self.entries[key] = wire
+        self.nbytes += len(wire)
+        GET_CACHE_BYTES.inc(len(wire))
+        while len(self.entries) > self.max_items or self.nbytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= len(old)
+            GET_CACHE_BYTES.dec(len(old))
+            EVICTIONS.inc()
+
+    def discard(self, key):
+        wire = self.entries.pop(key, None)
+        if wire is not None:
+            self.nbytes -= len(wire)
+            GET_CACHE_BYTES.dec(len(wire))
+
+    def clear(self):
+        GET_CACHE_BYTES.dec(self.nbytes)
+        self.entries.clear()
+        self.seen.clear()
+        self.nbytes = 0
@@ -1,18 +1,80 @@
+from collections import OrderedDict
+from email.utils import formatdate
+import json
+
 from aiohttp import web
+from prometheus_client import Counter
 import structlog
 
+import hotkeys
+from hotkeys import HotKeys
+from profiler import SamplingProfiler
+from slowlog import SlowLog
+
 
 logger = structlog.get_logger(__name__)
 
 
+RESPONSE_CACHE = Counter('http_response_cache', 'Serialized responses served from or added to the cache', ['result'])
+NOT_MODIFIED = Counter('http_not_modified', 'Conditional requests answered with 304', ['handler'])
+
+CACHE_SIZE = 256
+
+
+def opaque_tag(tag):
+    tag = tag.strip()
+    return tag[2:] if tag.startswith('W/') else tag
+
+def etag_matches(header, etag):
+    # the weak comparison If-None-Match calls for
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return any(opaque_tag(tag) == opaque_tag(etag) for tag in header.split(','))
+
+
+class ResponseCache(object):
+    # serialized bodies by path, each valid for one etag. a hit is a dict
+    # lookup; a stale entry is simply replaced
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, path, etag):
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != etag:
+            RESPONSE_CACHE.labels('miss').inc()
+            return None
+        RESPONSE_CACHE.labels('hit').inc()
+        self.entries.move_to_end(path)
+        return entry[1]
+
+    def put(self, path, etag, body):
+        self.entries[path] = (etag, body)
+        self.entries.move_to_end(path)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
 class HttpServer(object):
-    def __init__(self, store):
+    def __init__(self, store, profiler=None, hotkeys=None, slow_log=None, cache_size=CACHE_SIZE):
         self.store = store
+        self.profiler = profiler or SamplingProfiler()
+        self.hotkeys = hotkeys or HotKeys()
+        self.slow_log = slow_log or SlowLog()
+        self.cache = ResponseCache(cache_size)
         self.app = web.Application()
         self.app.router.add_routes([
             web.get('/api/health', self.health_check),
             web.get('/api/keys', self.handle_keys),
             web.get('/api/values/{key}', self.handle_values),
+            web.get('/api/snapshot', self.handle_snapshot_status),
+            web.post('/api/snapshot', self.handle_snapshot),
+            web.get('/api/profile', self.handle_profile),
+            web.get('/api/hotkeys', self.handle_hotkeys),
+            web.get('/api/slowlog', self.handle_slowlog),
+            web.delete('/api/slowlog', self.handle_slowlog_reset),
         ])
 
     def make_handler(self):
@@ -21,8 +83,33 @@ class HttpServer(object):
     def health_check(self, request):
         return web.json_response({'statis': 'ok'})
 
+    def conditional(self, request, name, version, modified, render):
+        # answers If-None-Match/If-Modified-Since with a 304, and otherwise
+        # serves the cached body for this version when there is one
+        etag = '"%s-%d"' % (self.store.epoch, version)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': formatdate(modified, usegmt=True),
+            # let clients keep it, but revalidate every time
+            'Cache-Control': 'no-cache',
+        }
+        if 'If-None-Match' in request.headers:
+            fresh = etag_matches(request.headers['If-None-Match'], etag)
+        else:
+            since = request.if_modified_since
+            fresh = since is not None and int(modified) <= since.timestamp()
+        if fresh:
+            NOT_MODIFIED.labels(name).inc()
+            return web.Response(status=304, headers=headers)
+
+        body = self.cache.get(request.path, etag)
+        if body is None:
+            body = json.dumps(render()).encode()
+            self.cache.put(request.path, etag, body)
+        return web.Response(body=body, content_type='application/json', headers=headers)
+
     def handle_keys(self, request):
-        return web.json_response({
+        return self.conditional(request, 'keys', self.store.version, self.store.modified, lambda: {
             'keys': [k.decode() for k in self.store.keys()],
         })
 
@@ -35,10 +122,61 @@ class HttpServer(object):
             value = self.store[key.encode()]
         except KeyError:
             raise web.HTTPNotFound
+        version, modified = self.store.key_version(key.encode())
+        return self.conditional(request, 'values', version, modified, lambda: {
+            'value': self.store.compressor.decompress(value).decode(),
+        })
+
+    def handle_snapshot_status(self, request):
         return web.json_response({
-            'value': value.data.decode(),
+            'in_progress': self.store.snapshotting,
+            'last': self.store.last_snapshot,
+            'last_error': self.store.last_snapshot_error,
         })
 
+    def handle_snapshot(self, request):
+        try:
+            path = self.store.start_snapshot(request.query.get('name', None))
+        except RuntimeError as e:
+            raise web.HTTPConflict(text=str(e))
+        return web.json_response({'snapshot': path}, status=202)
+
+    async def handle_profile(self, request):
+        try:
+            seconds = float(request.query.get('seconds', 5))
+            interval = float(request.query['interval']) if 'interval' in request.query else None
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        try:
+            stacks = await self.profiler.profile(seconds, interval)
+        except RuntimeError as e:
+            raise web.HTTPConflict(text=str(e))
+
+        if request.query.get('format') == 'json':
+            return web.json_response({
+                'samples': sum(stacks.values()),
+                'stacks': dict(stacks.most_common()),
+            })
+        return web.Response(text=SamplingProfiler.format(stacks))
+
+    def handle_hotkeys(self, request):
+        try:
+            n = int(request.query.get('n', hotkeys.EXPORT))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return web.json_response(self.hotkeys.top(n))
+
+    def handle_slowlog(self, request):
+        try:
+            n = int(request.query['n']) if 'n' in request.query else None
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return web.json_response(self.slow_log.get(n))
+
+    def handle_slowlog_reset(self, request):
+        self.slow_log.reset()
+        return web.Response(status=204)
+
     async def handle_websocket(self, request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)